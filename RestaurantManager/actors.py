@@ -19,16 +19,14 @@ The **Enrichers** receive _Command_, do they part,
 and they can send _Events_ as well.
 """
 from pprint import pprint
-import uuid
+import threading
 import time
 
 
 from documents import OrderDocument
+from idempotency import IdempotencyStore
 from messages import OrderPlaced, OrderPriced, OrderPaid, FoodCooked
-
-
-def get_uuid():
-    return str(uuid.uuid4())
+from messages import PaymentDue, new_id
 
 
 class OrderPrinter:
@@ -53,7 +51,7 @@ class Waiter:
         order = OrderDocument(kwargs)
         event = OrderPlaced(
             order=order,
-            correlation_id=get_uuid(),
+            correlation_id=new_id(),
         )
         self._bus.publish('order_placed', event)
         return event
@@ -66,6 +64,7 @@ class Cook:
 
     In this code it also responsible for deduplication,
     although it could be moved out to a reactor.
+    The `cooked` store (see `idempotency`) can be shared by the cooks.
     """
 
     def __init__(self, bus, cooked, time_to_sleep, name):
@@ -76,10 +75,9 @@ class Cook:
 
     def handle(self, event):
         order = event.order
-        if order.reference in self._cooked:
+        if not self._cooked.add(order.reference):
             print('*** DUPLICATED, IGNORE ***')
             return
-        self._cooked.append(order.reference)
         time.sleep(self._time_to_sleep)
         order.ingredients = []
         order.ingredients.append(
@@ -108,52 +106,108 @@ class AssistantManager:
         self._bus = bus
 
     def handle(self, event):
+        self._bus.publish('order_priced', self._price(event))
+
+    def handle_batch(self, events):
+        publish = self._bus.publish
+        for event in events:
+            publish('order_priced', self._price(event))
+
+    def _price(self, event):
         order = event.order
         for l in order.lines:
             l.price = 12
-        self._bus.publish(
-            'order_priced',
-            OrderPriced(
-                order,
-                correlation_id=event.correlation_id,
-                causation_id=event.message_id
-            )
+        return OrderPriced(
+            order,
+            correlation_id=event.correlation_id,
+            causation_id=event.message_id
         )
 
 
 class Cashier:
-    """Enricher"""
+    """
+    Enricher
 
-    def __init__(self, bus):
-        self._orders = {}
+    The unpaid orders are kept in an index (in the order of arrival),
+    an order leaves it when it is paid. The paid orders are only
+    remembered by their reference (the last `archive_size` of them),
+    so a duplicated `TakePayment` doesn't make them outstanding again.
+    Every new outstanding order is published as `PaymentDue`,
+    so nobody has to poll the cashier.
+
+    `pay_many` settles a lot of orders at once, the `OrderPaid`
+    events are published as one batch (`publish_many`).
+    """
+
+    def __init__(self, bus, archive_size=10000):
+        self._outstanding = {}
+        self._paid = IdempotencyStore(max_size=archive_size)
         self._processed = 0
         self._bus = bus
+        self._lock = threading.Lock()
 
     def handle(self, event):
-        order = event.order
-        self._orders[order.reference] = event
+        self._take(event)
+
+    def handle_batch(self, events):
+        for event in events:
+            self._take(event)
+
+    def _take(self, event):
+        reference = event.order.reference
+        with self._lock:
+            if reference in self._paid or reference in self._outstanding:
+                return
+            self._outstanding[reference] = event
+        self._bus.publish(
+            'payment_due',
+            PaymentDue(
+                event.order,
+                correlation_id=event.correlation_id,
+                causation_id=event.message_id
+            )
+        )
 
     def pay(self, reference):
-        event = self._orders[reference]
+        with self._lock:
+            self._check_outstanding(reference)
+            paid = self._settle(reference)
+        self._bus.publish('order_paid', paid)
+
+    def pay_many(self, references):
+        """
+        Pay all of the orders or none of them: every reference is
+        checked before anything is paid
+        """
+        references = list(references)
+        if len(set(references)) != len(references):
+            raise ValueError('Duplicated references')
+        with self._lock:
+            for reference in references:
+                self._check_outstanding(reference)
+            paid = [self._settle(reference) for reference in references]
+        self._bus.publish_many('order_paid', paid)
+
+    def _check_outstanding(self, reference):
+        if reference not in self._outstanding:
+            if reference in self._paid:
+                raise ValueError(f'Order already paid {reference}')
+            raise KeyError(reference)
+
+    def _settle(self, reference):
+        event = self._outstanding.pop(reference)
+        self._paid.add(reference)
         order = event.order
         order.paid = True
         self._processed += 1
-        self._bus.publish(
-            'order_paid',
-            OrderPaid(
-                order,
-                correlation_id=event.correlation_id,
-                causation_id=event.message_id
-            )
+        return OrderPaid(
+            order,
+            correlation_id=event.correlation_id,
+            causation_id=event.message_id
         )
 
     def get_info(self):
-        return f'Processed: {self._processed}'
+        return f'Processed: {self._processed}, outstanding: {len(self._outstanding)}'
 
     def get_outstanding_orders(self):
-        orders = []
-        for event in self._orders.values():
-            order = event.order
-            if not hasattr(order, 'paid') or not order.paid:
-                orders.append(order)
-        return orders
+        return [event.order for event in list(self._outstanding.values())]
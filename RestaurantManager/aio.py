@@ -0,0 +1,245 @@
+"""
+asyncio based variant of the bus and the reactors.
+
+Every reactor here is a task (or a callback) on one event loop
+instead of an OS thread, therefore a process can host
+a lot more of them.
+
+The actors don't have to know about it:
+- `AsyncTopicBasedPubSub.publish` is a normal function and it can be
+  called from any thread, the delivery always happens on the loop
+- the handlers can be normal functions or coroutine functions
+- a blocking actor (eg. `Cook`) can be wrapped by `ExecutorAdapter`,
+  so it runs on a thread pool without blocking the loop
+"""
+import asyncio
+
+from buses import TopicBasedPubSub
+
+
+class AsyncTopicBasedPubSub(TopicBasedPubSub):
+    """
+    The same subscription tables as `TopicBasedPubSub`,
+    but the handlers are called on the event loop.
+    If a handler returns a coroutine it is scheduled as a task.
+    """
+
+    def __init__(self, loop, shards=16):
+        self._loop = loop
+        self._tasks = set()
+        super().__init__(shards)
+
+    def publish(self, topic, message):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._publish(topic, message)
+        else:
+            # Published by a thread (eg. an actor in an executor)
+            self._loop.call_soon_threadsafe(self._publish, topic, message)
+
+    def publish_many(self, topic, messages):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._publish_many(topic, messages)
+        else:
+            # One hand over to the loop for the whole batch
+            self._loop.call_soon_threadsafe(self._publish_many, topic, list(messages))
+
+    def _publish_many(self, topic, messages):
+        for message in messages:
+            self._publish(topic, message)
+
+    def _publish(self, topic, message):
+        for handler in self._handlers.get(topic, ()):
+            self._schedule(handler(message))
+        correlation_id = message.correlation_id
+        shard = self._correlations[hash(correlation_id) % len(self._correlations)]
+        for handler in shard.get(correlation_id, ()):
+            self._schedule(handler(message))
+
+    def _schedule(self, result):
+        if asyncio.iscoroutine(result):
+            task = self._loop.create_task(result)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def get_info(self):
+        return f'{super().get_info()}, {len(self._tasks)} tasks'
+
+
+class AsyncProcessor:
+    """
+    The asyncio counterpart of `conrurrency.ThreadProcessor`,
+    `run_once` is a coroutine and the loop runs in a task.
+    """
+
+    def __init__(self):
+        self._task = None
+
+    async def run_once(self):
+        raise NotImplementedError()
+
+    async def run(self):
+        while True:
+            await self.run_once()
+
+    def start(self):
+        assert self._task is None
+        self._task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+class ExecutorAdapter:
+    """
+    Runs a synchronous (blocking) handler in an executor
+
+            o
+            |
+          [===]  executor
+            |
+           |_|
+    """
+
+    def __init__(self, handler, executor=None):
+        self._handler = handler
+        self._executor = executor
+
+    async def handle(self, message):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._handler.handle, message)
+
+
+class AsyncQueueHandler(AsyncProcessor):
+    """
+    The asyncio version of `reactors.QueueHandler`.
+    The handler might be a coroutine function, in that case
+    the next message is taken when the previous one is done.
+    """
+
+    def __init__(self, handler, name, maxsize=0):
+        self._name = name
+        self._handler = handler
+        self._queue = asyncio.Queue(maxsize)
+        self._dequeue_listeners = []
+        super().__init__()
+
+    def handle(self, order):
+        self._queue.put_nowait(order)
+
+    def add_dequeue_listener(self, listener):
+        self._dequeue_listeners.append(listener)
+
+    def get_queue_size(self):
+        return self._queue.qsize()
+
+    def get_name(self):
+        return self._name
+
+    def get_info(self):
+        return f'{self.get_name()}: {self.get_queue_size()}'
+
+    async def run_once(self):
+        order = await self._queue.get()
+        for listener in self._dequeue_listeners:
+            listener(self)
+        result = self._handler.handle(order)
+        if asyncio.iscoroutine(result):
+            await result
+
+
+class AsyncMoreFairDispatcher:
+    """
+    The asyncio version of `reactors.MoreFairDispatcher`.
+    The handlers have to be `AsyncQueueHandler`s, if all of them
+    are full it waits until one of them takes a message.
+    """
+
+    def __init__(self, handlers, limit):
+        self._limit = limit
+        self._handlers = handlers
+        self._dequeued = asyncio.Event()
+        for handler in handlers:
+            handler.add_dequeue_listener(self._dequeued_from)
+
+    async def handle(self, order):
+        handler = self._pick_one_handler()
+        while handler is None:
+            self._dequeued.clear()
+            await self._dequeued.wait()
+            handler = self._pick_one_handler()
+        handler.handle(order)
+
+    def _dequeued_from(self, handler):
+        self._dequeued.set()
+
+    def _pick_one_handler(self):
+        for handler in self._handlers:
+            if handler.get_queue_size() < self._limit:
+                return handler
+
+
+class AsyncAlarmClock:
+    """
+    The asyncio version of `reactors.AlarmClock`,
+    the timers are scheduled by `loop.call_at`.
+    """
+
+    def __init__(self, bus):
+        self._bus = bus
+        self._scheduled = {}
+        self._fired = 0
+        self._cancelled = 0
+
+    def handle(self, message):
+        loop = asyncio.get_running_loop()
+        timer = loop.call_at(loop.time() + message.delay, self._fire, message)
+        self._scheduled[message.message_id] = timer
+        return timer
+
+    def handle_cancel(self, message):
+        timer = self._scheduled.pop(message.delay_message_id, None)
+        if timer is not None:
+            timer.cancel()
+            self._cancelled += 1
+
+    def _fire(self, message):
+        del self._scheduled[message.message_id]
+        self._fired += 1
+        self._bus.publish(message.topic, message.message)
+
+    def get_pending_count(self):
+        return len(self._scheduled)
+
+    def get_info(self):
+        return (
+            f'AlarmClock: {self.get_pending_count()}'
+            f' (fired: {self._fired}, cancelled: {self._cancelled})'
+        )
+
+
+class AsyncMonitor(AsyncProcessor):
+    """
+    The asyncio version of `reactors.Monitor`
+    """
+
+    def __init__(self, handlers, interval=.5):
+        self._handlers = handlers
+        self._interval = interval
+        super().__init__()
+
+    async def run_once(self):
+        print('*' * 40)
+        for handler in self._handlers:
+            print('*', handler.get_info())
+        print('*' * 40)
+        await asyncio.sleep(self._interval)
@@ -0,0 +1,764 @@
+"""
+Benchmarks of the infrastructure pieces (buses, reactors, documents).
+
+They don't assert anything, they print the numbers,
+so the different implementations can be compared.
+
+Run all of them:
+
+    python benchmarks.py
+
+or only some of them by name:
+
+    python benchmarks.py timers
+"""
+import asyncio
+import copy
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from actors import Waiter, Cook, AssistantManager, Cashier
+from documents import OrderDocument, OrderLineDocument
+from aio import AsyncTopicBasedPubSub, AsyncQueueHandler, AsyncMoreFairDispatcher
+from aio import AsyncAlarmClock, ExecutorAdapter
+from buses import TopicBasedPubSub
+from process_manager import MidgetHouse
+from reactors import MoreFairDispatcher, QueueHandler
+from reactors import RoundRobinDispatcher, ShortestExpectedDelayDispatcher
+from serialization import JSON, BINARY
+from sharding import ShardedRestaurant
+from ringbuffer import RingBuffer, RingQueue
+from eventlog import EventLog
+from idempotency import IdempotencyStore
+from metrics import Registry
+from tracing import Tracer
+from buses import EntryCollection
+from messages import DelayPublish, Message, PriceOrder, OrderPriced, new_id
+from reactors import AlarmClock
+
+
+class RecordingBus:
+    """
+    Collects the published messages with the time of the publishing
+    """
+
+    def __init__(self):
+        self.published = []
+        self._lock = threading.Lock()
+
+    def publish(self, topic, message):
+        with self._lock:
+            self.published.append((time.monotonic(), topic, message))
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0
+    index = min(len(ordered) - 1, int(len(ordered) * pct / 100))
+    return ordered[index]
+
+
+def bench_timers(count=100000, spread=2.0, lead=2.0):
+    """
+    Schedule `count` timers spread over `spread` seconds (after
+    `lead` seconds, so the scheduling itself doesn't make them late)
+    and measure how late they fire and how much CPU the clock burns.
+    """
+    bus = RecordingBus()
+    alarm_clock = AlarmClock(bus)
+    deadlines = {}
+    for indx in range(count):
+        message = DelayPublish(
+            delay=lead + spread * indx / count,
+            topic='timed_out',
+            message=indx,
+            correlation_id=indx
+        )
+        deadlines[indx] = alarm_clock.handle(message).deadline
+
+    cpu_start = time.process_time()
+    alarm_clock.start()
+    while len(bus.published) < count:
+        time.sleep(.1)
+    alarm_clock.stop()
+    cpu = time.process_time() - cpu_start
+
+    jitter = [
+        (fired - deadlines[indx]) * 1000
+        for fired, _, indx in bus.published
+    ]
+    print(f'timers: {count} timers over {spread}s')
+    print(f'  jitter p50: {percentile(jitter, 50):.3f}ms'
+          f' p99: {percentile(jitter, 99):.3f}ms'
+          f' max: {max(jitter):.3f}ms')
+    print(f'  CPU: {cpu:.3f}s')
+
+
+def bench_bus(correlations=100000, messages=200000):
+    """
+    Publish throughput while `correlations` flows are subscribed
+    by their correlation id (like the process managers do).
+    """
+    bus = TopicBasedPubSub()
+    received = []
+    bus.subscribe('order_placed', received.append)
+    for indx in range(correlations):
+        bus.subscribe_correlation(indx, received.append)
+
+    # Half of the messages belong to a live flow, half of them don't
+    batch = [Message(correlation_id=indx % (correlations * 2)) for indx in range(messages)]
+    start = time.perf_counter()
+    for message in batch:
+        bus.publish('order_placed', message)
+    elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for indx in range(correlations):
+        bus.unsubscribe_correlation(indx, received.append)
+        bus.subscribe_correlation(indx, received.append)
+    churn = time.perf_counter() - start
+
+    print(f'bus: {correlations} correlations, {messages} messages')
+    print(f'  publish: {messages / elapsed:,.0f} messages/s')
+    print(f'  unsubscribe+subscribe: {correlations / churn:,.0f} flows/s')
+    print(f'  {bus.get_info()}')
+
+
+async def _run_async_flows(orders):
+    loop = asyncio.get_running_loop()
+    bus = AsyncTopicBasedPubSub(loop)
+    cooked = IdempotencyStore()
+    cook_queues = [
+        AsyncQueueHandler(ExecutorAdapter(Cook(bus, cooked, 0, f'Cook {indx}')), f'cook{indx}Q')
+        for indx in range(3)
+    ]
+    cooks_dispatcher_queue = AsyncQueueHandler(AsyncMoreFairDispatcher(cook_queues, 5), 'MFD')
+    assman_queue = AsyncQueueHandler(AssistantManager(bus), 'assmanQ')
+    cashier = Cashier(bus)
+    alarm_clock = AsyncAlarmClock(bus)
+    midget_house = MidgetHouse(bus)
+    waiter = Waiter(bus)
+    completed = asyncio.Event()
+
+    def take_payment(message):
+        cashier.handle(message)
+        cashier.pay(message.order.reference)
+
+    def order_completed(message):
+        midget_house.handle_unsubscribe(message)
+        if midget_house.count() == 0:
+            completed.set()
+
+    bus.subscribe('cook_food', cooks_dispatcher_queue.handle)
+    bus.subscribe('price_order', assman_queue.handle)
+    bus.subscribe('take_payment', take_payment)
+    bus.subscribe('order_placed', midget_house.handle)
+    bus.subscribe('order_completed', order_completed)
+    bus.subscribe('delay_publish', alarm_clock.handle)
+    bus.subscribe('cancel_delayed_publish', alarm_clock.handle_cancel)
+    reactors = cook_queues + [cooks_dispatcher_queue, assman_queue]
+    for reactor in reactors:
+        reactor.start()
+
+    for indx in range(orders):
+        waiter.place_order(
+            paid=False,
+            cooked=False,
+            reference=f'ABC-{indx}',
+            lines=[{'name': 'Cheese Pizza', 'qty': 1}]
+        )
+    in_flight = midget_house.count()
+    await completed.wait()
+    for reactor in reactors:
+        reactor.stop()
+    return in_flight
+
+
+def bench_asyncio(orders=10000):
+    """
+    Run `orders` concurrent order flows on one event loop
+    (the cooks in an executor, without sleeping)
+    """
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    in_flight = asyncio.run(_run_async_flows(orders))
+    elapsed = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start
+    print(f'asyncio: {orders} orders, {in_flight} flows in flight at once')
+    print(f'  {orders / elapsed:,.0f} orders/s')
+    print(f'  max RSS growth: {rss / 1024:.1f}MB ({rss * 1024 / orders:,.0f} bytes/flow)')
+
+
+class Sleeper:
+    """
+    Handler which takes the given time to process a message
+    """
+
+    def __init__(self, time_to_sleep, done):
+        self._time_to_sleep = time_to_sleep
+        self._done = done
+
+    def handle(self, message):
+        time.sleep(self._time_to_sleep)
+        self._done.append(message)
+
+
+class SpinningDispatcher:
+    """
+    The original `MoreFairDispatcher`, which polls the queue sizes
+    """
+
+    def __init__(self, handlers, limit):
+        self._limit = limit
+        self._handlers = handlers
+
+    def handle(self, order):
+        handler = None
+        while handler is None:
+            handler = self._pick_one_handler()
+        handler.handle(order)
+
+    def _pick_one_handler(self):
+        for handler in self._handlers:
+            if handler.get_queue_size() < self._limit:
+                return handler
+
+
+def bench_dispatcher(messages=300, limit=2):
+    """
+    Saturated cooks (the dispatcher is waiting most of the time),
+    the polling and the event driven dispatcher compared
+    """
+    for dispatcher_class in (SpinningDispatcher, MoreFairDispatcher):
+        done = []
+        cook_queues = [
+            QueueHandler(Sleeper(time_to_sleep, done), f'cook{indx}Q')
+            for indx, time_to_sleep in enumerate((.001, .003, .005))
+        ]
+        dispatcher = dispatcher_class(cook_queues, limit)
+        for cook_queue in cook_queues:
+            cook_queue.start()
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        for indx in range(messages):
+            dispatcher.handle(indx)
+        while len(done) < messages:
+            time.sleep(.001)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        for cook_queue in cook_queues:
+            cook_queue.stop()
+        print(f'dispatcher: {dispatcher_class.__name__}, {messages} messages')
+        print(f'  {messages / elapsed:,.0f} messages/s, CPU: {cpu:.3f}s of {elapsed:.3f}s')
+
+
+class Ticket:
+    """
+    Message of the dispatcher simulation, it remembers when it was created
+    """
+
+    correlation_id = None
+
+    def __init__(self):
+        self.created = time.perf_counter()
+        self.finished = None
+
+    def copy(self):
+        return self
+
+
+class TicketCook:
+
+    def __init__(self, time_to_sleep, done):
+        self._time_to_sleep = time_to_sleep
+        self._done = done
+
+    def handle(self, ticket):
+        time.sleep(self._time_to_sleep)
+        ticket.finished = time.perf_counter()
+        self._done.append(ticket)
+
+
+def bench_weighted_dispatcher(messages=2000, rate=1000):
+    """
+    Simulation of the restaurant cooks (0.1s, 0.3s and 0.5s in `main.py`
+    scaled down by 100) with `rate` orders/s arriving,
+    the end-to-end latency percentiles of the dispatchers compared
+    """
+    dispatchers = [
+        ('RoundRobinDispatcher', lambda handlers: RoundRobinDispatcher(handlers)),
+        ('MoreFairDispatcher', lambda handlers: MoreFairDispatcher(handlers, 5)),
+        ('ShortestExpectedDelayDispatcher', ShortestExpectedDelayDispatcher),
+        ('ShortestExpectedDelayDispatcher(choices=2)',
+         lambda handlers: ShortestExpectedDelayDispatcher(handlers, choices=2)),
+    ]
+    for name, create in dispatchers:
+        done = []
+        cook_queues = [
+            QueueHandler(TicketCook(time_to_sleep, done), f'cook{indx}Q')
+            for indx, time_to_sleep in enumerate((.001, .003, .005))
+        ]
+        dispatcher_queue = QueueHandler(create(cook_queues), 'dispatcherQ')
+        for handler in cook_queues + [dispatcher_queue]:
+            handler.start()
+        start = time.perf_counter()
+        for indx in range(messages):
+            # Uniform arrival, the next order is due at `indx / rate`
+            delay = start + indx / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            dispatcher_queue.handle(Ticket())
+        while len(done) < messages:
+            time.sleep(.01)
+        for handler in cook_queues + [dispatcher_queue]:
+            handler.stop()
+        latency = [(ticket.finished - ticket.created) * 1000 for ticket in done]
+        print(f'weighted: {name}, {messages} orders at {rate}/s')
+        print(f'  latency p50: {percentile(latency, 50):.1f}ms'
+              f' p90: {percentile(latency, 90):.1f}ms'
+              f' p99: {percentile(latency, 99):.1f}ms')
+
+
+class CountingBus:
+
+    def __init__(self):
+        self.count = 0
+
+    def publish(self, topic, message):
+        self.count += 1
+
+
+def bench_batching(messages=50000):
+    """
+    The assistant manager's queue drained with different batch sizes
+    """
+    for batch_size in (1, 16, 256):
+        bus = CountingBus()
+        assman_queue = QueueHandler(AssistantManager(bus), 'assmanQ', batch_size=batch_size)
+        for indx in range(messages):
+            order = OrderDocument({'reference': f'ABC-{indx}', 'lines': [{'name': 'Pizza', 'qty': 1}]})
+            assman_queue.handle(PriceOrder(order, correlation_id=indx))
+        start = time.perf_counter()
+        assman_queue.start()
+        while bus.count < messages:
+            time.sleep(.001)
+        elapsed = time.perf_counter() - start
+        assman_queue.stop()
+        print(f'batching: batch size {batch_size}, {messages} messages')
+        print(f'  {messages / elapsed:,.0f} messages/s')
+
+
+class DeepCopyDocument(OrderDocument):
+    """
+    `OrderDocument` copied the original way
+    """
+
+    def copy(self):
+        return DeepCopyDocument(copy.deepcopy(self._src))
+
+
+def bench_document_copy(repeat=2000):
+    """
+    Multiplexing a document to 3 handlers (like `Multiplexer`),
+    each of them changes a field, or prices every line
+    """
+    for lines in (1, 10, 100):
+        src = {
+            'reference': 'ABC-1',
+            'paid': False,
+            'lines': [{'name': 'Cheese Pizza', 'qty': 1, 'extras': ['cheese']} for _ in range(lines)],
+        }
+        for document_class in (DeepCopyDocument, OrderDocument):
+            document = document_class(copy.deepcopy(src))
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for _ in range(3):
+                    document.copy().cooked = True
+            field = (time.perf_counter() - start) / repeat / 3 * 1e6
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for _ in range(3):
+                    for line in document.copy().lines:
+                        line.price = 12
+            priced = (time.perf_counter() - start) / repeat / 3 * 1e6
+            print(f'document: {document_class.__name__}, {lines} lines')
+            print(f'  copy + field: {field:.1f}us, copy + price lines: {priced:.1f}us')
+
+
+class ListLinesDocument(OrderDocument):
+    """
+    `OrderDocument` building the list of lines on every access
+    (the original way)
+    """
+
+    @property
+    def lines(self):
+        return [
+            OrderLineDocument(data, self, index)
+            for index, data in enumerate(self._src.get('lines', []))
+        ]
+
+
+def bench_pricing(lines=500, repeat=200):
+    """
+    Pricing a big order the way `AssistantManager` does,
+    then reading the total
+    """
+    for document_class in (ListLinesDocument, OrderDocument):
+        document = document_class({
+            'reference': 'ABC-1',
+            'lines': [{'name': f'Item {indx}', 'qty': 2} for indx in range(lines)],
+        })
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for line in document.lines:
+                line.price = 12
+            total = sum(line.price * line.qty for line in document.lines)
+        elapsed = (time.perf_counter() - start) / repeat * 1e6
+        print(f'pricing: {document_class.__name__}, {lines} lines (total: {total})')
+        print(f'  {elapsed:.1f}us per order')
+
+
+def bench_codec(lines=10, repeat=5000):
+    """
+    Size and encode/decode time of a priced order message
+    """
+    order = OrderDocument({
+        'reference': 'ABC-1',
+        'paid': False,
+        'cooked': True,
+        'ingredients': [{'name': 'cheese', 'qty': 3}, {'name': 'mustard', 'qty': 5}],
+        'lines': [{'name': 'Cheese Pizza', 'qty': 1, 'price': 12} for _ in range(lines)],
+    })
+    message = OrderPriced(order, correlation_id='ABC', causation_id='XYZ')
+    for codec in (JSON, BINARY):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            data = message.serialize(codec)
+        encode = (time.perf_counter() - start) / repeat * 1e6
+        start = time.perf_counter()
+        for _ in range(repeat):
+            OrderPriced.deserialize(data, codec)
+        decode = (time.perf_counter() - start) / repeat * 1e6
+        size = len(data.encode('utf-8') if isinstance(data, str) else data)
+        print(f'codec: {codec.name}, order with {lines} lines')
+        print(f'  {size} bytes, encode: {encode:.1f}us, decode: {decode:.1f}us')
+
+
+class LegacyMessage:
+    """
+    The original message: `__dict__` and a formatted uuid4 as id
+    """
+
+    def __init__(self, order, correlation_id, causation_id=None, message_id=None):
+        self.correlation_id = correlation_id
+        self.causation_id = causation_id
+        self.message_id = message_id or str(uuid.uuid4())
+        self.order = order
+
+
+def bench_messages(count=200000):
+    """
+    Creating messages (and publishing them to a subscriber)
+    """
+    order = OrderDocument({'reference': 'ABC-1'})
+    bus = TopicBasedPubSub()
+    bus.subscribe('order_priced', lambda message: None)
+    for message_class in (LegacyMessage, OrderPriced):
+        start = time.perf_counter()
+        for indx in range(count):
+            message_class(order, correlation_id=indx, causation_id=indx)
+        create = (time.perf_counter() - start) / count * 1e6
+        start = time.perf_counter()
+        for indx in range(count):
+            bus.publish('order_priced', message_class(order, correlation_id=indx, causation_id=indx))
+        publish = (time.perf_counter() - start) / count * 1e6
+        message = message_class(order, correlation_id=1)
+        size = sys.getsizeof(message)
+        if hasattr(message, '__dict__'):
+            size += sys.getsizeof(message.__dict__)
+        print(f'messages: {message_class.__name__}, {count} messages')
+        print(f'  create: {create:.2f}us, create + publish: {publish:.2f}us, {size} bytes')
+
+
+def bench_sharding(orders=3000):
+    """
+    Orders/s of the sharded restaurant (cooks without sleeping)
+    with different number of worker processes
+    """
+    print(f'sharding: {os.cpu_count()} CPUs')
+    for workers in sorted({1, 2, 4, os.cpu_count()}):
+        bus = TopicBasedPubSub()
+        waiter = Waiter(bus)
+        restaurant = ShardedRestaurant(workers, cook_times=(0, 0, 0))
+        bus.subscribe('order_placed', restaurant.handle)
+        restaurant.start()
+        start = time.perf_counter()
+        for indx in range(orders):
+            waiter.place_order(reference=f'ABC-{indx}', lines=[{'name': 'Cheese Pizza', 'qty': 1}])
+        completed = restaurant.wait_for_completed(orders, timeout=60)
+        elapsed = time.perf_counter() - start
+        restaurant.stop()
+        print(f'  {workers} workers: {completed / elapsed:,.0f} orders/s')
+
+
+def _drain(backend, count):
+    for _ in range(count):
+        backend.get()
+
+
+def bench_ringbuffer(count=20000):
+    """
+    Messages/s from this process to another one,
+    `multiprocessing.Queue` vs the shared memory ring buffer
+    """
+    message = PriceOrder(OrderDocument({'reference': 'ABC', 'lines': [{'name': 'Pizza', 'qty': 1}]}), 'id')
+    data = message.serialize(BINARY)
+    ring = RingBuffer(1 << 20)
+    backends = [
+        ('multiprocessing.Queue', multiprocessing.Queue(), lambda backend: backend.put(data)),
+        ('RingBuffer (bytes)', ring, lambda backend: backend.put(data)),
+        ('RingQueue (messages)', RingQueue(ring), lambda backend: backend.put(message)),
+    ]
+    for name, backend, put in backends:
+        consumer = multiprocessing.Process(target=_drain, args=(backend, count))
+        consumer.start()
+        start = time.perf_counter()
+        for _ in range(count):
+            put(backend)
+        consumer.join()
+        elapsed = time.perf_counter() - start
+        print(f'ringbuffer: {name:<24} {count / elapsed:>10,.0f} messages/s')
+    ring.close()
+
+
+def bench_eventlog(count=2000, publishers=(1, 4, 16)):
+    """
+    Durable appends/s of the event log by the number of publishers,
+    with group commit the more publishers share the syncs
+    """
+    payload = PriceOrder(OrderDocument({'reference': 'ABC'}), 'id').serialize(BINARY)
+    for threads in publishers:
+        with tempfile.TemporaryDirectory() as directory:
+            log = EventLog(directory)
+
+            def append():
+                for _ in range(count // threads):
+                    log.append('price_order', payload)
+
+            workers = [threading.Thread(target=append) for _ in range(threads)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            print(
+                f'eventlog: {threads:>2} publishers {len(log) / elapsed:>10,.0f} appends/s'
+                f' ({log.get_commit_count()} syncs)'
+            )
+            log.close()
+
+
+class RebuildingEntryCollection:
+    """
+    The entries are rebuilt and the data is decoded on every access
+    (as `buses.EntryCollection` used to do)
+    """
+
+    def __init__(self, data):
+        self._data = data
+
+    @property
+    def entries(self):
+        return [RebuildingEntry(entry) for entry in self._data['entries']]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class RebuildingEntry:
+
+    def __init__(self, entry):
+        self._entry = entry
+
+    @property
+    def data(self):
+        return json.loads(self._entry['data'])
+
+
+def bench_entries(count=100000):
+    """
+    Parsing a page of entries, then reading the data of every entry
+    twice (the way the bus reads a page)
+    """
+    envelope = PriceOrder(OrderDocument({'reference': 'ABC'}), 'id').to_envelope()
+    text = json.dumps({'entries': [
+        {'eventId': str(indx), 'eventType': 'price_order', 'data': json.dumps(envelope)}
+        for indx in range(count)
+    ]})
+
+    def read_rebuilding():
+        collection = RebuildingEntryCollection(json.loads(text))
+        entries = collection.entries
+        for entry in entries:
+            entry.data
+            entry.data
+        len(collection)
+
+    def read_cached(streaming):
+        collection = EntryCollection.parse(text, streaming)
+        for entry in collection:
+            entry.data
+            entry.data
+        len(collection)
+
+    for name, run in [
+        ('rebuilt on every access', read_rebuilding),
+        ('parsed once', lambda: read_cached(False)),
+        ('parsed once, streaming', lambda: read_cached(True)),
+    ]:
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        print(f'entries: {name:<24} {count / elapsed:>12,.0f} entries/s')
+
+
+def bench_idempotency(count=10_000_000, max_size=1_000_000, step=1_000_000):
+    """
+    Deduplication cost as the number of seen references grows:
+    `reference in list` grows linearly, the store stays flat
+    (and it keeps at most `max_size` references)
+    """
+    cooked = []
+    for size in (10000, 20000, 40000):
+        while len(cooked) < size:
+            cooked.append(f'ABC-{len(cooked)}')
+        start = time.perf_counter()
+        for indx in range(100):
+            f'ABC-{size + indx}' in cooked
+        elapsed = time.perf_counter() - start
+        print(f'idempotency: list at {size:>10,} references {elapsed / 100 * 1e9:>10,.0f} ns/check')
+    del cooked
+    store = IdempotencyStore(max_size=max_size)
+    for done in range(0, count, step):
+        start = time.perf_counter()
+        for indx in range(done, done + step):
+            store.add(f'ABC-{indx}')
+        elapsed = time.perf_counter() - start
+        print(
+            f'idempotency: store at {done + step:>10,} references {elapsed / step * 1e9:>10,.0f} ns/add'
+            f' ({len(store):,} kept)'
+        )
+
+
+def bench_settlement(orders=5000):
+    """
+    End of shift: paying every outstanding order one by one vs `pay_many`
+    (the paid orders go to a printer-like subscriber and to a
+    per-order correlation subscriber, as in `main.py`)
+    """
+    for name, settle in [
+        ('pay', lambda cashier, references: [cashier.pay(reference) for reference in references]),
+        ('pay_many', lambda cashier, references: cashier.pay_many(references)),
+    ]:
+        bus = TopicBasedPubSub()
+        cashier = Cashier(bus)
+        received = []
+        bus.subscribe('order_paid', received.append)
+        for indx in range(orders):
+            message = PriceOrder(OrderDocument({'reference': f'ABC-{indx}'}), correlation_id=indx)
+            bus.subscribe_correlation(indx, received.append)
+            cashier.handle(message)
+        references = [order.reference for order in cashier.get_outstanding_orders()]
+        start = time.perf_counter()
+        settle(cashier, references)
+        elapsed = time.perf_counter() - start
+        print(f'settlement: {name:<8} {orders:,} orders in {elapsed * 1000:,.1f} ms')
+
+
+def bench_metrics(count=200000):
+    """
+    Overhead of the instrumentation on the publishing
+    and the cost of recording into a histogram
+    """
+    message = Message(correlation_id='ABC')
+    for name, registry in [('without metrics', None), ('with metrics', Registry())]:
+        bus = TopicBasedPubSub(metrics=registry)
+        bus.subscribe('topic', lambda message: None)
+        start = time.perf_counter()
+        for _ in range(count):
+            bus.publish('topic', message)
+        elapsed = time.perf_counter() - start
+        print(f'metrics: publish {name:<16} {elapsed / count * 1e9:>8,.0f} ns/message')
+    histogram = Registry().histogram('latency')
+    start = time.perf_counter()
+    for indx in range(count):
+        histogram.record(indx / 1e6)
+    elapsed = time.perf_counter() - start
+    print(f'metrics: histogram record          {elapsed / count * 1e9:>8,.0f} ns/value')
+
+
+def bench_tracing(count=200000):
+    """
+    Overhead of the tracing on the publishing, every flow traced
+    and only a sample of them, the flows have their own correlation id
+    """
+    flows = [Message(correlation_id=new_id()) for _ in range(1000)]
+    tracers = [
+        ('without tracing', None),
+        ('every flow', Tracer(max_hops=count)),
+        ('every 100th flow', Tracer(max_hops=count, sample_every=100)),
+    ]
+    for name, tracer in tracers:
+        bus = TopicBasedPubSub(tracer=tracer)
+        bus.subscribe('topic', lambda message: None)
+        start = time.perf_counter()
+        for indx in range(count):
+            bus.publish('topic', flows[indx % len(flows)])
+        elapsed = time.perf_counter() - start
+        print(f'tracing: publish {name:<17} {elapsed / count * 1e9:>8,.0f} ns/message')
+    tracer = tracers[1][1]
+    start = time.perf_counter()
+    stages = tracer.get_stages()
+    elapsed = time.perf_counter() - start
+    print(f'tracing: stages of {len(flows)} flows ({count} hops) {elapsed * 1000:>8,.1f} ms')
+
+
+BENCHMARKS = {
+    'timers': bench_timers,
+    'bus': bench_bus,
+    'asyncio': bench_asyncio,
+    'dispatcher': bench_dispatcher,
+    'weighted': bench_weighted_dispatcher,
+    'batching': bench_batching,
+    'document': bench_document_copy,
+    'pricing': bench_pricing,
+    'codec': bench_codec,
+    'messages': bench_messages,
+    'sharding': bench_sharding,
+    'ringbuffer': bench_ringbuffer,
+    'eventlog': bench_eventlog,
+    'entries': bench_entries,
+    'idempotency': bench_idempotency,
+    'settlement': bench_settlement,
+    'metrics': bench_metrics,
+    'tracing': bench_tracing,
+}
+
+
+def main(envs, prog, raw_args):
+    for name in raw_args or BENCHMARKS:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(os.environ, sys.argv[0], sys.argv[1:])
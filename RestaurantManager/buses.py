@@ -1,68 +1,323 @@
 import collections
 import json
+import queue
+import re
 import threading
-import uuid
+import time
 import sys
+import traceback
 
 import requests
 
+import messages
+from messages import format_id
+from conrurrency import ThreadProcessor, OverflowQueue, BLOCK
 
 
 class TopicBasedPubSub:
-
-    def __init__(self):
-        self._handlers = collections.defaultdict(tuple)
+    """
+    Subscriptions by topic and by correlation id are kept in
+    separate tables.
+
+    The handlers of a key are stored in an immutable tuple, a change
+    replaces the whole tuple (copy-on-write), therefore publishing
+    never takes a lock and a lookup of an unknown key doesn't
+    allocate anything.
+    The correlation ids come and go with every order, so that table
+    is sharded, and the writers only lock their own shard.
+
+    With a `metrics.Registry` it counts the published messages and
+    measures the handlers by topic, with a `tracing.Tracer` it records
+    the hops of the sampled flows.
+    """
+
+    def __init__(self, shards=16, metrics=None, tracer=None):
+        self._handlers = {}
         self._lock = threading.Lock()
+        self._correlations = [{} for _ in range(shards)]
+        self._correlation_locks = [threading.Lock() for _ in range(shards)]
+        self._metrics = metrics
+        self._topic_metrics = {}
+        self._tracer = tracer
+        self._measured = metrics is not None or tracer is not None
 
     def publish(self, topic, message):
-        for handler in self._handlers[topic]:
+        if self._measured:
+            return self._publish_measured(topic, message)
+        self._deliver(topic, message)
+
+    def _deliver(self, topic, message):
+        for handler in self._handlers.get(topic, ()):
             handler(message)
         correlation_id = message.correlation_id
-        for handler in self._handlers[correlation_id]:
+        shard = self._correlations[hash(correlation_id) % len(self._correlations)]
+        for handler in shard.get(correlation_id, ()):
             handler(message)
 
-    def subscribe(self, topic, handler):
-        self._lock.acquire()
-        try:
-            self._handlers[topic] = self._handlers[topic] + (handler, )
-        finally:
-            self._lock.release()
+    def _publish_measured(self, topic, message):
+        handler_time = None
+        if self._metrics is not None:
+            instruments = self._topic_metrics.get(topic)
+            if instruments is None:
+                instruments = self._topic_metrics[topic] = (
+                    self._metrics.counter('bus_published_total', topic=topic),
+                    self._metrics.histogram('bus_handler_seconds', topic=topic),
+                )
+            published, handler_time = instruments
+            published.inc()
+        hop = None if self._tracer is None else self._tracer.start(topic, message)
+        if handler_time is None and hop is None:
+            # Not sampled
+            return self._deliver(topic, message)
+        started = first = time.perf_counter()
+        for handler in self._handlers.get(topic, ()):
+            handler(message)
+            started = _measure(handler_time, started)
+        # Looked up after the topic handlers, they might subscribe
+        correlation_id = message.correlation_id
+        shard = self._correlations[hash(correlation_id) % len(self._correlations)]
+        for handler in shard.get(correlation_id, ()):
+            handler(message)
+            started = _measure(handler_time, started)
+        if hop is not None:
+            hop.duration = started - first
+
+    def publish_many(self, topic, messages):
+        """
+        Publish the messages in order, the subscribers of the topic
+        are looked up once for all of them
+        """
+        if self._measured:
+            for message in messages:
+                self._publish_measured(topic, message)
+            return
+        handlers = self._handlers.get(topic, ())
+        correlations = self._correlations
+        for message in messages:
+            for handler in handlers:
+                handler(message)
+            correlation_id = message.correlation_id
+            for handler in correlations[hash(correlation_id) % len(correlations)].get(correlation_id, ()):
+                handler(message)
+
+    def subscribe(self, topic, handler, delivery=None):
+        """
+        By default the handler is called on the publisher's thread,
+        if a `DeliveryQueue` is given the message is put in its
+        queue and the handler is called by the delivery workers.
+
+        The key is always a topic, the correlation ids have
+        `subscribe_correlation`.
+        """
+        _check_topic(topic, 'subscribe')
+        if delivery is not None:
+            handler = _Delivered(delivery, handler)
+        with self._lock:
+            _add_handler(self._handlers, topic, handler)
 
     def unsubscribe(self, topic, handler):
-        self._lock.acquire()
-        try:
-            handlers = list(self._handlers[topic])
-            handlers.remove(handler)
-            if len(handlers) > 0:
-                self._handlers[topic] = tuple(handlers)
-            else:
-                del self._handlers[topic]
-        finally:
-            self._lock.release()
+        _check_topic(topic, 'unsubscribe')
+        with self._lock:
+            _remove_handler(self._handlers, topic, handler)
+
+    def subscribe_correlation(self, correlation_id, handler):
+        index = hash(correlation_id) % len(self._correlations)
+        with self._correlation_locks[index]:
+            _add_handler(self._correlations[index], correlation_id, handler)
+
+    def unsubscribe_correlation(self, correlation_id, handler):
+        index = hash(correlation_id) % len(self._correlations)
+        with self._correlation_locks[index]:
+            _remove_handler(self._correlations[index], correlation_id, handler)
+
+    def get_correlation_count(self):
+        return sum(len(shard) for shard in self._correlations)
 
     def get_info(self):
-        return f'BUS: {len(self._handlers)}'
+        return f'BUS: {len(self._handlers)} topics, {self.get_correlation_count()} correlations'
 
 
+class DeliveryQueue:
+    """
+    Asynchronous delivery of the published messages
+
+    It has a bounded queue served by a pool of worker threads,
+    so a slow handler doesn't hold up the publisher.
+    One instance can serve one subscriber or it can be shared by
+    every subscriber of a topic.
+    If the queue is full the overflow policy decides
+    (see `conrurrency.OverflowQueue`).
+    """
+
+    def __init__(self, name, maxsize=1000, overflow=BLOCK, workers=1):
+        self._name = name
+        self._queue = OverflowQueue(maxsize, overflow)
+        self._workers = [_DeliveryWorker(self._queue) for _ in range(workers)]
+
+    def deliver(self, handler, message):
+        self._queue.put((handler, message))
+
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+
+    def stop(self):
+        for worker in self._workers:
+            worker.stop()
+
+    def get_queue_size(self):
+        return self._queue.qsize()
+
+    def get_failed_count(self):
+        return sum(worker.failed for worker in self._workers)
+
+    def get_info(self):
+        return (
+            f'{self._name}: {self.get_queue_size()}'
+            f' (dropped: {self._queue.get_dropped_count()}, failed: {self.get_failed_count()})'
+        )
+
+
+class _DeliveryWorker(ThreadProcessor):
+
+    def __init__(self, queue_):
+        self._queue = queue_
+        self.failed = 0
+        super().__init__()
+
+    def run_once(self):
+        try:
+            handler, message = self._queue.get(timeout=1)
+        except queue.Empty:
+            return
+        try:
+            handler(message)
+        except Exception:
+            # The worker goes on with the next message
+            self.failed += 1
+            traceback.print_exc()
+
+
+class _Delivered:
+    """
+    Handler which hands over the message to a `DeliveryQueue`.
+    It compares equal to the original handler, so it can be unsubscribed
+    the same way.
+    """
+
+    def __init__(self, delivery, handler):
+        self._delivery = delivery
+        self._handler = handler
+
+    def __call__(self, message):
+        self._delivery.deliver(self._handler, message)
+
+    def __eq__(self, other):
+        if isinstance(other, _Delivered):
+            return self._handler == other._handler
+        return self._handler == other
+
+    def __hash__(self):
+        return hash(self._handler)
+
+
+def _check_topic(topic, method):
+    # Catches the old way of subscribing to a correlation id
+    # (the string ids can't be told apart from a topic)
+    if not isinstance(topic, str):
+        raise TypeError(f'{method} takes a topic, not {topic!r}, use {method}_correlation')
+
+
+def _measure(handler_time, started):
+    now = time.perf_counter()
+    if handler_time is not None:
+        handler_time.record(now - started)
+    return now
+
+
+def _add_handler(table, key, handler):
+    table[key] = table.get(key, ()) + (handler, )
 
-class ESTopicBasedPubSub:
 
-    def __init__(self, eventstore):
+def _remove_handler(table, key, handler):
+    handlers = list(table[key])
+    handlers.remove(handler)
+    if len(handlers) > 0:
+        table[key] = tuple(handlers)
+    else:
+        del table[key]
+
+
+class ESTopicBasedPubSub:
+    """
+    Bus on EventStore, the messages are appended to a stream
+    and read back by a competing consumer subscription.
+
+    Publishing doesn't wait for EventStore: the messages are collected
+    and a background flusher appends them in batches (a batch is sent
+    when it is full or `linger` seconds after its first message).
+    A failed append is retried `retries` times with exponential backoff
+    (the event ids make the retries idempotent), then the batch is kept
+    for the next flush, `flush` raises the error and `get_info` shows it.
+    The HTTP connections are reused (`requests.Session`).
+
+    Reading takes up to `prefetch` entries at once, the handled
+    entries are acked, the failed ones are nacked in bulk.
+    With `streaming` the entries of a page are dispatched while
+    the page is parsed (for big pages).
+    """
+
+    def __init__(self, eventstore, stream='orders', subscription='dddws',
+                 batch_size=100, linger=.005, prefetch=20, auth=('admin', 'changeit'),
+                 session=None, streaming=False, retries=3, backoff=.1):
         self._handlers = collections.defaultdict(tuple)
         self._lock = threading.Lock()
         self._eventstore = eventstore
+        self._stream = stream
+        self._subscription = subscription
+        self._prefetch = prefetch
+        self._streaming = streaming
+        self._auth = auth
+        self._session = session or requests.Session()
+        self._flusher = _Flusher(self._append, batch_size, linger, retries, backoff)
+        self._reader = None
         self._running = False
 
     def publish(self, topic, message):
-        requests.post(
-            f'{self._eventstore}/streams/orders',
-            headers={
-                'Content-Type': 'application/json',
-                'ES-EventType': topic,
-                'ES-EventId': str(uuid.uuid4())
-            },
-            data=message.serialize()
+        self._flusher.add([self._event(topic, message)])
+
+    def publish_many(self, topic, messages):
+        self._flusher.add([self._event(topic, message) for message in messages])
+
+    def _event(self, topic, message):
+        return {
+            'eventId': format_id(message.message_id),
+            'eventType': topic,
+            'data': message.to_envelope(),
+        }
+
+    def flush(self):
+        """
+        Append the collected messages right away,
+        raises the error if they can't be appended
+        """
+        self._flusher.flush()
+
+    def _append(self, events):
+        r = self._session.post(
+            f'{self._eventstore}/streams/{self._stream}',
+            headers={'Content-Type': 'application/vnd.eventstore.events+json'},
+            data=json.dumps(events)
         )
+        if r.status_code != 201:
+            raise AppendError(f'{r.status_code}: {r.text}')
+
+    def get_info(self):
+        flusher = self._flusher
+        info = f'ES BUS: {flusher.get_pending_count()} pending, failed appends: {flusher.failures}'
+        if flusher.error is not None:
+            info += f' (last error: {flusher.error})'
+        return info
 
     def subscribe(self, topic, handler):
         self._lock.acquire()
@@ -76,50 +331,71 @@ class ESTopicBasedPubSub:
             handler(message)
 
     def dispatch_entry(self, entry):
-        topic = entry.event_type
-        message = entry.data
+        """
+        Returns whether the entry is handled
+        """
         try:
-            self.dispatch(topic, message)
-        except:
-            pass
-        pass
+            self.dispatch(entry.event_type, messages.decode_envelope(entry.data))
+        except Exception:
+            return False
+        return True
 
     def start(self):
-        self._create_permanent_subscription('orders')
-
-        print(entry_collection.entries[0].data)
-        sys.exit(0)
-        pass
+        self._create_permanent_subscription(self._stream)
+        self._flusher.start()
+        self._reader = threading.Thread(target=self.run)
+        self._reader.start()
 
     def run(self):
         assert not self._running
         self._running = True
         while self._running:
             entries = self._read_from_subscription()
+            handled, failed = [], []
             for entry in entries:
-                self.dispatch_entry(entry)
+                (handled if self.dispatch_entry(entry) else failed).append(entry)
+            self._ack_entries(handled)
+            self._nack_entries(failed)
+            if not handled and not failed:
+                time.sleep(.1)
         self._running = False
 
     def stop(self):
         self._running = False
+        if self._reader is not None:
+            self._reader.join()
+            self._reader = None
+        self._flusher.stop()
 
-    def _ack_entry(self, entry):
-        pass
+    def _ack_entries(self, entries):
+        self._send_ids('ack', entries)
 
-    def _nack_entry(self, entry):
-        pass
+    def _nack_entries(self, entries):
+        self._send_ids('nack', entries, action='Retry')
+
+    def _send_ids(self, operation, entries, **params):
+        if not entries:
+            return
+        params['ids'] = ','.join(entry.event_id for entry in entries)
+        self._session.post(
+            f'{self._subscription_url()}/{operation}',
+            params=params,
+            auth=self._auth
+        )
+
+    def _subscription_url(self):
+        return f'{self._eventstore}/subscriptions/{self._stream}/{self._subscription}'
 
     def _create_permanent_subscription(self, stream):
-        subscription_name = 'dddws'
-        r = requests.put(
-            f'{self._eventstore}/subscriptions/{stream}/{subscription_name}',
+        r = self._session.put(
+            f'{self._eventstore}/subscriptions/{stream}/{self._subscription}',
             headers={
                 'Content-Type': 'application/json',
             },
             data=json.dumps({
 
             }),
-            auth=('admin', 'changeit')
+            auth=self._auth
         )
         if r.status_code == 409:
             return
@@ -128,41 +404,227 @@ class ESTopicBasedPubSub:
             sys.exit(-1)
 
     def _read_from_subscription(self):
-        subscription_name = 'dddws'
-        stream = 'orders'
-        embed = 'body'
-        url = f'{self._eventstore}/subscriptions/{stream}/{subscription_name}?embed={embed}'
-        print('URL:', url)
-        r = requests.get(
-            url, 
+        r = self._session.get(
+            f'{self._subscription_url()}/{self._prefetch}',
+            params={'embed': 'body'},
             headers={
                 'Accept': 'application/vnd.eventstore.competingatom+json'
-            }
+            },
+            auth=self._auth
         )
         if r.status_code != 200:
             print(f'***** ERROR {r.status_code} *************')
             print(r.text)
             sys.exit(-1)
-        return EntryCollection(r.json())
+        return EntryCollection.parse(r.text, self._streaming)
+
+
+class AppendError(Exception):
+    pass
+
+
+class _Flusher(ThreadProcessor):
+    """
+    Collects the events and hands them over to `append` in batches,
+    an event is kept until its batch is appended
+    """
+
+    def __init__(self, append, batch_size, linger, retries=3, backoff=.1):
+        self._append = append
+        self._batch_size = batch_size
+        self._linger = linger
+        self._retries = retries
+        self._backoff = backoff
+        self.failures = 0
+        self.error = None
+        self._events = []
+        self._added = threading.Condition()
+        # The batches are sent one at a time, so they keep their order
+        self._sending = threading.Lock()
+        super().__init__()
+
+    def add(self, events):
+        with self._added:
+            empty = not self._events
+            self._events.extend(events)
+            if empty or len(self._events) >= self._batch_size:
+                self._added.notify()
+
+    def run_once(self):
+        with self._added:
+            if not self._added.wait_for(lambda: self._events, timeout=1):
+                return
+            # Let the batch fill up
+            self._added.wait_for(lambda: len(self._events) >= self._batch_size, self._linger)
+        try:
+            self.flush()
+        except Exception:
+            # Kept, the next round tries again
+            pass
+
+    def flush(self):
+        with self._sending:
+            while True:
+                with self._added:
+                    events = self._events[:self._batch_size]
+                if not events:
+                    return
+                self._send(events)
+                with self._added:
+                    # Only this removes events, the new ones are at the end
+                    del self._events[:len(events)]
+
+    def _send(self, events):
+        delay = self._backoff
+        for attempt in range(self._retries + 1):
+            try:
+                self._append(events)
+            except Exception as error:
+                self.failures += 1
+                self.error = error
+                if attempt == self._retries:
+                    raise
+                time.sleep(delay)
+                delay *= 2
+            else:
+                self.error = None
+                return
+
+    def get_pending_count(self):
+        return len(self._events)
+
+    def stop(self):
+        super().stop()
+        self.flush()
 
 
 class EntryCollection:
+    """
+    A page of entries read from EventStore
+
+    The entries are created on the first access and kept.
+    `parse` with `streaming=True` doesn't parse the whole page up front,
+    the entries are parsed one by one as they are iterated,
+    so a big page can be handled while it is being parsed.
+    """
 
     def __init__(self, data):
         self._data = data
+        self._entries = None
+
+    @classmethod
+    def parse(cls, text, streaming=False):
+        if streaming:
+            return StreamingEntryCollection(text)
+        return cls(json.loads(text))
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = [Entry(entry) for entry in self._data['entries']]
+        return self._entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self._data['entries'])
+
+
+class StreamingEntryCollection(EntryCollection):
+
+    def __init__(self, text):
+        super().__init__(None)
+        self._parsed = []
+        self._pending = _iter_entries(text)
 
     @property
     def entries(self):
-        return [Entry(entry) for entry in self._data['entries']]
+        while self._parse_next():
+            pass
+        return self._parsed
+
+    def _parse_next(self):
+        if self._pending is None:
+            return False
+        try:
+            self._parsed.append(Entry(next(self._pending)))
+        except StopIteration:
+            self._pending = None
+            return False
+        return True
+
+    def __iter__(self):
+        # By index, the entries might be parsed meanwhile
+        # (eg. `len` in the loop), those are in `_parsed` too
+        indx = 0
+        while indx < len(self._parsed) or self._parse_next():
+            yield self._parsed[indx]
+            indx += 1
 
     def __len__(self):
         return len(self.entries)
 
 
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+def _iter_entries(text):
+    """
+    The items of the `entries` array of a page, one by one,
+    the other keys of the page are skipped
+    """
+    position = _expect(text, 0, '{')
+    while text[position] != '}':
+        key, position = _decoder.raw_decode(text, position)
+        position = _expect(text, position, ':')
+        if key != 'entries':
+            _, position = _decoder.raw_decode(text, position)
+        else:
+            position = _expect(text, position, '[')
+            while text[position] != ']':
+                entry, position = _decoder.raw_decode(text, position)
+                yield entry
+                position = _skip_separator(text, position, ']')
+            position = _skip(text, position + 1)
+        position = _skip_separator(text, position, '}')
+
+
+def _skip(text, position):
+    return _whitespace.match(text, position).end()
+
+
+def _expect(text, position, char):
+    position = _skip(text, position)
+    if text[position] != char:
+        raise ValueError(f'Expected {char!r} at position {position}')
+    return _skip(text, position + 1)
+
+
+def _skip_separator(text, position, end):
+    position = _skip(text, position)
+    if text[position] == ',':
+        return _skip(text, position + 1)
+    if text[position] != end:
+        raise ValueError(f'Expected , or {end!r} at position {position}')
+    return position
+
+
+# The data of an entry which hasn't been decoded yet
+# (`None` is a valid payload)
+_NOT_DECODED = object()
+
+
 class Entry:
 
     def __init__(self, entry):
         self._entry = entry
+        self._data = _NOT_DECODED
+
+    @property
+    def event_id(self):
+        return self._entry['eventId']
 
     @property
     def event_type(self):
@@ -174,7 +636,10 @@ class Entry:
 
     @property
     def data(self):
-        return json.loads(self._entry['data'])
+        # Decoded once, on the first access
+        if self._data is _NOT_DECODED:
+            self._data = json.loads(self._entry['data'])
+        return self._data
 
     @property
     def links(self):
@@ -1,4 +1,18 @@
+import os
+import pickle
+import queue
+import struct
+import tempfile
 import threading
+import time
+
+
+# Overflow policies of the bounded queues
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+REJECT = 'reject'
+SPILL = 'spill'
 
 
 class ThreadProcessor:
@@ -22,3 +36,153 @@ class ThreadProcessor:
 
     def stop(self):
         self._running = False
+
+
+class OverflowQueue(queue.Queue):
+    """
+    Bounded queue with a configurable overflow policy
+
+    - BLOCK: the producer waits for free space (as `queue.Queue` does),
+      at most `timeout` seconds, then `queue.Full` is raised
+    - DROP_OLDEST: the oldest item is thrown away to make space
+    - DROP_NEWEST: the new item is thrown away
+    - REJECT: `queue.Full` is raised immediately
+    - SPILL: the items over the limit are written to a temporary file
+      (in `spill_directory`) and read back as the queue drains,
+      the items have to be picklable
+    """
+
+    def __init__(self, maxsize=0, overflow=BLOCK, timeout=None, spill_directory=None):
+        super().__init__(maxsize)
+        self._overflow = overflow
+        self._timeout = timeout
+        self._spill_directory = spill_directory
+        self._dropped = 0
+        self._high_water_mark = 0
+
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self._spill = None
+
+    def put(self, item, block=True, timeout=None):
+        if self._overflow == BLOCK:
+            if timeout is None:
+                timeout = self._timeout
+            return super().put(item, block, timeout)
+        with self.not_full:
+            if self._overflow == SPILL:
+                self._put_or_spill(item)
+            elif 0 < self.maxsize <= self._qsize():
+                if self._overflow == REJECT:
+                    raise queue.Full
+                self._dropped += 1
+                if self._overflow == DROP_NEWEST:
+                    return
+                self._get()
+                self._put(item)
+            else:
+                self._put(item)
+                self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _put_or_spill(self, item):
+        # Once something is spilled every new item goes after it,
+        # so the order is kept
+        if 0 < self.maxsize <= len(self.queue) or self._spill:
+            if self._spill is None:
+                self._spill = SpillFile(self._spill_directory)
+            self._spill.append(item)
+            self._update_high_water_mark()
+        else:
+            self._put(item)
+        self.unfinished_tasks += 1
+
+    def get_many(self, max_items, timeout=None, linger=0):
+        """
+        Take up to `max_items` items under one lock.
+        It waits `timeout` for the first item (raises `queue.Empty`),
+        then at most `linger` seconds for the rest of the batch.
+        """
+        with self.not_empty:
+            if not self._qsize():
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while not self._qsize():
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise queue.Empty
+                    self.not_empty.wait(remaining)
+            if linger > 0:
+                deadline = time.monotonic() + linger
+                while self._qsize() < max_items:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.not_empty.wait(remaining)
+            items = [self._get() for _ in range(min(max_items, self._qsize()))]
+            self.not_full.notify(len(items))
+            return items
+
+    def _qsize(self):
+        if self._spill:
+            return len(self.queue) + len(self._spill)
+        return len(self.queue)
+
+    def _put(self, item):
+        super()._put(item)
+        self._update_high_water_mark()
+
+    def _get(self):
+        item = super()._get()
+        if self._spill:
+            self.queue.append(self._spill.pop())
+        return item
+
+    def _update_high_water_mark(self):
+        size = self._qsize()
+        if size > self._high_water_mark:
+            self._high_water_mark = size
+
+    def get_spilled_count(self):
+        return len(self._spill) if self._spill else 0
+
+    def get_dropped_count(self):
+        return self._dropped
+
+    def get_high_water_mark(self):
+        return self._high_water_mark
+
+
+class SpillFile:
+    """
+    FIFO of pickled items in a temporary file
+    """
+
+    _header = struct.Struct('>I')
+
+    def __init__(self, directory=None):
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self._read_position = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, item):
+        data = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(self._header.pack(len(data)))
+        self._file.write(data)
+        self._count += 1
+
+    def pop(self):
+        self._file.seek(self._read_position)
+        size, = self._header.unpack(self._file.read(self._header.size))
+        item = pickle.loads(self._file.read(size))
+        self._read_position += self._header.size + size
+        self._count -= 1
+        if self._count == 0:
+            # Everything is read back, the file can start over
+            self._file.seek(0)
+            self._file.truncate()
+            self._read_position = 0
+        return item
@@ -7,46 +7,158 @@ but have to be able to
 - make a copy of the document
 - modify some part of the document
 without understanding the whole.
+
+Copies are copy-on-write: a copy shares the nested values
+(lists, dicts) with the original, and a document copies
+a nested value (or a single line) only when it is touched.
 """
 import json
-import copy
+
+from serialization import JSON
+
+
+_CONTAINERS = (dict, list)
+
+
+def _copy(value):
+    # The documents are JSON-like, copying only the dicts and the lists
+    # is a lot cheaper than `copy.deepcopy`
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    return value
+
+
+class _Ownership:
+    """
+    What is private to a document: the keys of the nested values
+    (`None` if nothing is shared with other copies) and the indexes
+    of the private lines (`None` if the list of lines and all of the
+    lines in it are private, or nothing is shared).
+    A copy revokes it, the document starts a new one then.
+    """
+
+    __slots__ = ('names', 'lines', 'revoked')
+
+    def __init__(self, names=None):
+        self.names = names
+        self.lines = None
+        self.revoked = False
 
 
 class OrderDocument:
 
     def __init__(self, src=None):
         self._src = src or {}
+        self._ownership = _Ownership()
+        self._lines_view = None
 
     def __hasattr__(self, name):
         return name in self._src
 
     def __getattr__(self, name):
+        if name.startswith('_'):
+            # Private and special attributes are never part of the document
+            # (eg. pickle looks for `__setstate__` before `_src` exists)
+            raise AttributeError(name)
         try:
-            return self._src[name]
+            value = self._src[name]
         except KeyError:
             raise AttributeError(f'Attribute not found {name}')
+        if isinstance(value, _CONTAINERS) and self._is_shared(name):
+            # The caller may change it in place, so it can't be shared anymore
+            value = self._own(name, _copy(value))
+        return value
 
     def __setattr__(self, name, value):
         if name.startswith('_'):
             super().__setattr__(name, value)
         else:
-            self._src[name] = value
+            if name == 'lines':
+                self._get_ownership().lines = None
+                if self._lines_view is not None:
+                    self._lines_view._invalidate()
+            self._own(name, value)
 
-    def serialize(self):
-        return json.dumps(self._src)
+    def serialize(self, codec=JSON):
+        return codec.encode(self._src)
+
+    @classmethod
+    def deserialize(cls, data, codec=JSON):
+        return cls(codec.decode(data))
 
     def copy(self):
-        new_src = copy.deepcopy(self._src)
-        return OrderDocument(new_src)
+        # The top level is copied right away (it's small),
+        # the nested values are shared by both documents from now on.
+        # The copy has its own ownership, the source's one is only
+        # revoked (the same flag from any thread), so the documents
+        # can be copied from many threads at the same time
+        new_document = OrderDocument(dict(self._src))
+        new_document._ownership = _Ownership(set())
+        self._ownership.revoked = True
+        return new_document
 
     def add_line(self, **data):
-        if 'lines' not in self._src:
-            self._src['lines'] = []
-        self._src['lines'].append(data)
+        lines = self._lines_for_write()
+        lines.append(data)
+        owned_lines = self._get_ownership().lines
+        if owned_lines is not None:
+            owned_lines.add(len(lines) - 1)
+        if self._lines_view is not None:
+            self._lines_view._invalidate()
 
     @property
     def lines(self):
-        return [OrderLineDocument(kw) for kw in self._src.get('lines', [])]
+        if self._lines_view is None:
+            self._lines_view = OrderLines(self)
+        return self._lines_view
+
+    def _get_ownership(self):
+        ownership = self._ownership
+        if ownership.revoked:
+            # Copied since, everything is shared
+            ownership = self._ownership = _Ownership(set())
+        return ownership
+
+    def _is_shared(self, name):
+        names = self._get_ownership().names
+        return names is not None and name not in names
+
+    def _own(self, name, value):
+        self._src[name] = value
+        names = self._get_ownership().names
+        if names is not None:
+            names.add(name)
+        return value
+
+    def _lines_for_write(self):
+        # The list of lines is made private, but the lines
+        # in it are still shared
+        lines = self._src.get('lines', [])
+        ownership = self._get_ownership()
+        if not self._is_shared('lines'):
+            self._src['lines'] = lines
+        elif ownership.lines is None:
+            self._src['lines'] = lines = list(lines)
+            ownership.lines = set()
+        return lines
+
+    def _is_line_shared(self, index):
+        owned_lines = self._get_ownership().lines
+        return self._is_shared('lines') and (
+            owned_lines is None or index not in owned_lines
+        )
+
+    def _line(self, index):
+        return self._src['lines'][index]
+
+    def _own_line(self, index):
+        lines = self._lines_for_write()
+        if self._is_line_shared(index):
+            lines[index] = _copy(lines[index])
+            self._get_ownership().lines.add(index)
+        return lines[index]
 
     def __str__(self):
         return json.dumps(self._src)
@@ -55,16 +167,75 @@ class OrderDocument:
         return 'OrderDocument({!r})'.format(self._src)
 
 
+class OrderLines:
+    """
+    Live view of the lines of an `OrderDocument`
+
+    The line objects are created once and reused by every access,
+    they always read the current line of the document.
+    """
+
+    __slots__ = ('_document', '_lines')
+
+    def __init__(self, document):
+        self._document = document
+        self._lines = None
+
+    def _invalidate(self):
+        self._lines = None
+
+    def _get_lines(self):
+        lines = self._lines
+        if lines is None or len(lines) != len(self):
+            document = self._document
+            lines = self._lines = [
+                OrderLineDocument(None, document, index)
+                for index in range(len(self))
+            ]
+        return lines
+
+    def __len__(self):
+        return len(self._document._src.get('lines', ()))
+
+    def __iter__(self):
+        return iter(self._get_lines())
+
+    def __getitem__(self, index):
+        return self._get_lines()[index]
+
+    def __repr__(self):
+        return 'OrderLines({!r})'.format(self._document._src.get('lines', []))
+
+
 class OrderLineDocument:
+    """
+    A line of an `OrderDocument`, the changes are written to the
+    line of the document (which makes the line private if it
+    has been shared by copies)
+    """
+
+    __slots__ = ('_data', '_document', '_index')
 
-    def __init__(self, data):
+    def __init__(self, data, document=None, index=None):
         self._data = data
+        self._document = document
+        self._index = index
 
     def __getattr__(self, name):
-        return self._data[name]
+        if name.startswith('_'):
+            raise AttributeError(name)
+        document = self._document
+        if document is None:
+            return self._data[name]
+        value = document._line(self._index)[name]
+        if isinstance(value, _CONTAINERS) and document._is_line_shared(self._index):
+            value = document._own_line(self._index)[name]
+        return value
 
     def __setattr__(self, name, value):
         if name.startswith('_'):
             super().__setattr__(name, value)
-        else:
+        elif self._document is None:
             self._data[name] = value
+        else:
+            self._document._own_line(self._index)[name] = value
@@ -0,0 +1,396 @@
+"""
+Durable, append-only event log on the local disk,
+and a bus on top of it (`EventLogPubSub`), it works offline.
+
+The log is a directory of segment files, every segment
+is preallocated and memory mapped, the records are written to
+and read from the mapping.
+
+    00000000000000000000.log  | records 0..n-1
+    0000000000000000000n.log  | records n..
+    cursors/<consumer>        | the next record of the consumer
+
+A record:
+
+    [length: 4][crc32: 4][topic length: 2][topic][payload]
+
+The zero header marks the end of the records of a segment,
+a torn record (bad checksum) at the end is dropped on opening.
+
+The appends are durable when `append` returns (`sync=True`):
+the publishers waiting for the disk are committed together by
+one of them (group commit), so one `msync` covers many appends.
+"""
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+
+import messages
+from buses import TopicBasedPubSub
+from conrurrency import ThreadProcessor
+from serialization import BINARY
+
+
+_header = struct.Struct('>IIH')
+
+
+class _Segment:
+
+    def __init__(self, path, base, size):
+        self.path = path
+        self.base = base
+        # Byte position of every record in the segment
+        self.positions = array('Q')
+        self.end = 0
+        self.synced = 0
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.truncate(size)
+        self._file = open(path, 'r+b')
+        self.size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), self.size)
+
+    def scan(self):
+        """
+        Find the records of an existing segment,
+        yields the topic of every record
+        """
+        position = 0
+        while position + _header.size <= self.size:
+            length, crc, topic_length = _header.unpack_from(self._map, position)
+            if length == 0 and crc == 0:
+                break
+            start = position + _header.size
+            end = start + topic_length + length
+            if end > self.size or zlib.crc32(self._map[start:end]) != crc:
+                # Torn write, the rest of the segment is cleared
+                self._map[position:self.size] = bytes(self.size - position)
+                break
+            self.positions.append(position)
+            yield self._map[start:start + topic_length].decode('utf-8')
+            position = end
+        self.end = self.synced = position
+
+    def fits(self, size):
+        return self.end + size <= self.size
+
+    def append(self, topic, payload):
+        body = topic + payload
+        _header.pack_into(self._map, self.end, len(payload), zlib.crc32(body), len(topic))
+        start = self.end + _header.size
+        self._map[start:start + len(body)] = body
+        self.positions.append(self.end)
+        self.end = start + len(body)
+
+    def read(self, index):
+        position = self.positions[index]
+        length, _, topic_length = _header.unpack_from(self._map, position)
+        start = position + _header.size
+        topic = self._map[start:start + topic_length].decode('utf-8')
+        start += topic_length
+        return topic, self._map[start:start + length]
+
+    def sync(self, end=None):
+        end = self.end if end is None else end
+        if end > self.synced:
+            # msync works on whole pages
+            start = self.synced - self.synced % mmap.PAGESIZE
+            self._map.flush(start, end - start)
+            self.synced = end
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class EventLog:
+    """
+    The records get a sequential offset (from 0) in the log,
+    the offsets of the records of a topic are indexed.
+
+    With `sync=False` the appends are only written to the page cache,
+    `flush` (or `close`) makes them durable.
+    `commit_delay` is the time the committing publisher waits for
+    others to join the commit.
+    """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, sync=True, commit_delay=0):
+        self._directory = directory
+        self._segment_size = segment_size
+        self._sync = sync
+        self._commit_delay = commit_delay
+        self._lock = threading.Lock()
+        self._appended = threading.Condition(self._lock)
+        self._commit = threading.Condition()
+        self._committing = False
+        self._committed = 0
+        self._commits = 0
+        self._topics = {}
+        self._segments = []
+        self._bases = []
+        self._count = 0
+        os.makedirs(directory, exist_ok=True)
+        self._open()
+
+    def _open(self):
+        names = sorted(name for name in os.listdir(self._directory) if name.endswith('.log'))
+        for name in names:
+            # The older segments might be dropped already
+            self._count = int(name[:-len('.log')])
+            segment = _Segment(os.path.join(self._directory, name), self._count, self._segment_size)
+            for topic in segment.scan():
+                self._index(topic, self._count)
+                self._count += 1
+            self._add_segment(segment)
+        if not self._segments:
+            self._roll()
+        self._committed = self._count
+
+    def _add_segment(self, segment):
+        self._segments.append(segment)
+        self._bases.append(segment.base)
+
+    def _roll(self):
+        path = os.path.join(self._directory, f'{self._count:020d}.log')
+        self._add_segment(_Segment(path, self._count, self._segment_size))
+
+    def _index(self, topic, offset):
+        offsets = self._topics.get(topic)
+        if offsets is None:
+            offsets = self._topics[topic] = array('Q')
+        offsets.append(offset)
+
+    def append(self, topic, payload):
+        """
+        Append a record, returns its offset
+        """
+        return self.append_many(topic, [payload])
+
+    def append_many(self, topic, payloads):
+        """
+        Append records of a topic in one go (one commit for all of them),
+        returns the offset of the first one
+        """
+        encoded = topic.encode('utf-8')
+        for payload in payloads:
+            size = _header.size + len(encoded) + len(payload)
+            if size > self._segment_size:
+                raise ValueError(f'Record of {size} bytes is bigger than a segment')
+        with self._lock:
+            first = self._count
+            for payload in payloads:
+                segment = self._segments[-1]
+                if not segment.fits(_header.size + len(encoded) + len(payload)):
+                    segment.sync()
+                    self._roll()
+                    segment = self._segments[-1]
+                segment.append(encoded, payload)
+                self._index(topic, self._count)
+                self._count += 1
+            count = self._count
+            self._appended.notify_all()
+        if self._sync:
+            self._wait_for_commit(count)
+        return first
+
+    def _wait_for_commit(self, count):
+        with self._commit:
+            while self._committed < count:
+                if self._committing:
+                    # Somebody else is committing, maybe our record too
+                    self._commit.wait()
+                    continue
+                self._committing = True
+                self._commit.release()
+                try:
+                    committed = self._flush()
+                finally:
+                    self._commit.acquire()
+                    self._committing = False
+                self._committed = max(self._committed, committed)
+                self._commit.notify_all()
+
+    def _flush(self):
+        if self._commit_delay:
+            time.sleep(self._commit_delay)
+        with self._lock:
+            segment = self._segments[-1]
+            count = self._count
+            end = segment.end
+        segment.sync(end)
+        self._commits += 1
+        return count
+
+    def flush(self):
+        self._wait_for_commit(self._count)
+
+    def drop_before(self, offset):
+        """
+        Delete the segments which have only records before `offset`
+        (eg. they are covered by a snapshot)
+        """
+        with self._lock:
+            while len(self._segments) > 1 and self._bases[1] <= offset:
+                segment = self._segments.pop(0)
+                self._bases.pop(0)
+                segment.close()
+                os.remove(segment.path)
+            for offsets in self._topics.values():
+                del offsets[:bisect.bisect_left(offsets, self._bases[0])]
+
+    def get_first_offset(self):
+        return self._bases[0]
+
+    def read(self, offset):
+        """
+        The topic and the payload of the record
+        """
+        if not self._bases[0] <= offset < self._count:
+            raise IndexError(offset)
+        segment = self._segments[bisect.bisect_right(self._bases, offset) - 1]
+        return segment.read(offset - segment.base)
+
+    def read_topic(self, topic, start=0):
+        """
+        The offsets and the payloads of the records of a topic
+        from the `start` offset
+        """
+        offsets = self._topics.get(topic, ())
+        for indx in range(bisect.bisect_left(offsets, start), len(offsets)):
+            yield offsets[indx], self.read(offsets[indx])[1]
+
+    def wait(self, offset, timeout=None):
+        """
+        Wait until the record of the `offset` is durable
+        (appended, with `sync=False`)
+        """
+        if not self._sync:
+            with self._appended:
+                return self._appended.wait_for(lambda: self._count > offset, timeout)
+        with self._commit:
+            return self._commit.wait_for(lambda: self._committed > offset, timeout)
+
+    def get_durable_count(self):
+        """
+        The number of the records which survive a crash
+        (all of them, with `sync=False`)
+        """
+        return self._committed if self._sync else self._count
+
+    def get_cursor(self, name):
+        return Cursor(os.path.join(self._directory, 'cursors'), name)
+
+    def get_topic_count(self, topic):
+        return len(self._topics.get(topic, ()))
+
+    def get_commit_count(self):
+        return self._commits
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        if self._sync:
+            self.flush()
+        for segment in self._segments:
+            segment.sync()
+            segment.close()
+
+
+class Cursor:
+    """
+    The position of a consumer in the log, it is saved by `commit`
+    """
+
+    def __init__(self, directory, name):
+        self._path = os.path.join(directory, name)
+        os.makedirs(directory, exist_ok=True)
+        self.position = 0
+        if os.path.exists(self._path):
+            with open(self._path) as f:
+                self.position = int(f.read())
+        self._committed = self.position
+
+    def commit(self):
+        if self.position == self._committed:
+            return
+        temporary = f'{self._path}.tmp'
+        with open(temporary, 'w') as f:
+            f.write(str(self.position))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self._path)
+        self._committed = self.position
+
+
+class EventLogPubSub(ThreadProcessor):
+    """
+    Bus on an `EventLog`, the published messages are written to the log,
+    and the bus thread delivers them to the subscribers.
+
+    The position of the bus in the log is saved, after a restart
+    the messages which hasn't been delivered yet are delivered
+    (at least once).
+    """
+
+    def __init__(self, directory, consumer='bus', codec=BINARY, batch_size=100, metrics=None,
+                 tracer=None, **log_options):
+        self._log = EventLog(directory, **log_options)
+        self._cursor = self._log.get_cursor(consumer)
+        # The cursor is never saved past the durable records,
+        # but the end of the log could be lost anyway (eg. a torn write)
+        self._cursor.position = min(self._cursor.position, len(self._log))
+        self._codec = codec
+        self._batch_size = batch_size
+        self._subscriptions = TopicBasedPubSub(metrics=metrics, tracer=tracer)
+        super().__init__()
+
+    def publish(self, topic, message):
+        self._log.append(topic, self._codec.encode_bytes(message.to_envelope()))
+
+    def publish_many(self, topic, messages):
+        self._log.append_many(topic, [self._codec.encode_bytes(message.to_envelope()) for message in messages])
+
+    def subscribe(self, topic, handler):
+        self._subscriptions.subscribe(topic, handler)
+
+    def unsubscribe(self, topic, handler):
+        self._subscriptions.unsubscribe(topic, handler)
+
+    def subscribe_correlation(self, correlation_id, handler):
+        self._subscriptions.subscribe_correlation(correlation_id, handler)
+
+    def unsubscribe_correlation(self, correlation_id, handler):
+        self._subscriptions.unsubscribe_correlation(correlation_id, handler)
+
+    def run_once(self):
+        cursor = self._cursor
+        if not self._log.wait(cursor.position, timeout=1):
+            return
+        # Only the durable records are delivered, otherwise after a crash
+        # the cursor could point past the end of the log
+        end = min(self._log.get_durable_count(), cursor.position + self._batch_size)
+        while cursor.position < end:
+            topic, payload = self._log.read(cursor.position)
+            message = messages.decode_envelope(self._codec.decode_bytes(payload))
+            self._subscriptions.publish(topic, message)
+            cursor.position += 1
+        cursor.commit()
+
+    def get_lag(self):
+        return len(self._log) - self._cursor.position
+
+    def get_info(self):
+        return (
+            f'EventLog BUS: {len(self._log)} records, lag: {self.get_lag()},'
+            f' commits: {self._log.get_commit_count()}'
+        )
+
+    def close(self):
+        self._cursor.commit()
+        self._log.close()
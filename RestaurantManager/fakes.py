@@ -0,0 +1,22 @@
+"""
+Test doubles shared by the tests
+"""
+
+
+class FakeBus:
+    """
+    Records the published messages instead of delivering them
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.published_many = []
+
+    def publish(self, topic, message):
+        self.messages.append((topic, message))
+
+    def publish_many(self, topic, messages):
+        self.published_many.append((topic, list(messages)))
+
+    def topics(self):
+        return [topic for topic, _ in self.messages]
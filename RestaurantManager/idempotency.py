@@ -0,0 +1,198 @@
+"""
+Deduplication: the stores remember the keys (eg. order references)
+which have been seen already.
+
+- `IdempotencyStore`: thread-safe hash set, the keys can expire after
+  `ttl` seconds without being seen and/or the least recently seen
+  keys are evicted over `max_size` keys, so the memory is bounded
+- `PersistentIdempotencyStore`: the same, but the keys are written
+  to a file as well, so they survive a restart
+- `BloomFilter`: a store can have one in front of it, it answers
+  most of the "never seen" lookups without touching the store
+  (it has to have room for `max_size` keys, without `max_size`
+  it grows with the store)
+
+    if not store.add(order.reference):
+        return  # duplicated
+"""
+import collections
+import hashlib
+import math
+import os
+import threading
+import time
+
+
+class IdempotencyStore:
+
+    def __init__(self, max_size=None, ttl=None, bloom=None, clock=time.monotonic):
+        if bloom is not None and max_size is not None and bloom.capacity < max_size:
+            # It would be full again right after every rebuild
+            raise ValueError(f'Bloom filter of {bloom.capacity} keys for a store of {max_size} keys')
+        self._max_size = max_size
+        self._ttl = ttl
+        self._bloom = bloom
+        self._clock = clock
+        # Key -> last seen, the least recently seen first
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._evicted = 0
+
+    def add(self, key):
+        """
+        Remember the key, returns True if it hasn't been seen yet
+        """
+        now = self._clock()
+        with self._lock:
+            new = not self._contains(key, now)
+            self._keys[key] = now
+            self._keys.move_to_end(key)
+            if new:
+                self._added(key, now)
+                if self._bloom is not None:
+                    self._bloom.add(key)
+            self._evict(now)
+        return new
+
+    def _added(self, key, now):
+        pass
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._contains(key, self._clock())
+
+    def _contains(self, key, now):
+        if self._bloom is not None and key not in self._bloom:
+            return False
+        seen = self._keys.get(key)
+        if seen is None:
+            return False
+        return self._ttl is None or now - seen < self._ttl
+
+    def _evict(self, now):
+        keys = self._keys
+        if self._max_size is not None:
+            while len(keys) > self._max_size:
+                keys.popitem(last=False)
+                self._evicted += 1
+        if self._ttl is not None:
+            while keys and now - next(iter(keys.values())) >= self._ttl:
+                keys.popitem(last=False)
+                self._evicted += 1
+        if self._bloom is not None and self._bloom.is_full():
+            # The evicted keys are still in the filter, it is rebuilt
+            # before it gives too many false positives.
+            # It has room for at least as many new keys as the live ones,
+            # so the rebuilds don't follow each other
+            if 2 * len(keys) > self._bloom.capacity:
+                self._bloom = self._bloom.resized(2 * len(keys))
+            else:
+                self._bloom.clear()
+            for key in keys:
+                self._bloom.add(key)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get_info(self):
+        return f'IdempotencyStore: {len(self)} (evicted: {self._evicted})'
+
+
+class PersistentIdempotencyStore(IdempotencyStore):
+    """
+    The keys (strings) are appended to a file with the time they were
+    seen, the file is read back on start. If the file grows over
+    twice the size of the live keys it is rewritten.
+    The time is the wall clock time, so the `ttl` goes on
+    while the application doesn't run.
+    """
+
+    def __init__(self, path, max_size=None, ttl=None, bloom=None):
+        super().__init__(max_size, ttl, bloom, clock=time.time)
+        self._path = path
+        self._lines = 0
+        if os.path.exists(path):
+            self._load()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def _load(self):
+        with open(self._path, encoding='utf-8') as f:
+            for line in f:
+                seen, _, key = line.rstrip('\n').partition('\t')
+                self._keys[key] = float(seen)
+                self._keys.move_to_end(key)
+                self._lines += 1
+        now = self._clock()
+        self._evict(now)
+        if self._bloom is not None:
+            for key in self._keys:
+                self._bloom.add(key)
+
+    def _added(self, key, now):
+        self._file.write(f'{now}\t{key}\n')
+        self._file.flush()
+        self._lines += 1
+        if self._lines > 2 * len(self._keys) + 1000:
+            self._compact()
+
+    def _compact(self):
+        temporary = f'{self._path}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as f:
+            for key, seen in self._keys.items():
+                f.write(f'{seen}\t{key}\n')
+        self._file.close()
+        os.replace(temporary, self._path)
+        self._file = open(self._path, 'a', encoding='utf-8')
+        self._lines = len(self._keys)
+
+    def close(self):
+        self._file.close()
+
+
+class BloomFilter:
+    """
+    Set without false negatives, but with about `error_rate` false
+    positives up to `capacity` keys (then `is_full`).
+    It can't forget a key, only all of them (`clear`).
+    """
+
+    def __init__(self, capacity, error_rate=.01):
+        self.capacity = capacity
+        self._error_rate = error_rate
+        self._size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._hashes = max(1, round(self._size / capacity * math.log(2)))
+        self._bits = bytearray((self._size + 7) // 8)
+        self._count = 0
+
+    def _positions(self, key):
+        # Double hashing, two 64 bit halves of one digest
+        digest = hashlib.blake2b(str(key).encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little')
+        return [(first + indx * second) % self._size for indx in range(self._hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self._count += 1
+
+    def __contains__(self, key):
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def is_full(self):
+        return self._count > self.capacity
+
+    def resized(self, capacity):
+        """
+        An empty filter with the same error rate
+        """
+        return BloomFilter(capacity, self._error_rate)
+
+    def clear(self):
+        self._bits = bytearray(len(self._bits))
+        self._count = 0
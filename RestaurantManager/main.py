@@ -43,29 +43,45 @@ The expected flow:
            (*)         | STOP
 """
 import os
+import queue
 import sys
-import time
 
 from buses import TopicBasedPubSub
+from eventlog import EventLogPubSub
+from idempotency import IdempotencyStore
+from metrics import Registry, FlowLatency
+from tracing import Tracer
 from messages import OrderPlaced, OrderPriced, OrderPaid, FoodCooked
 from actors import OrderPrinter, Cashier, Cook, Waiter, AssistantManager
 from reactors import QueueHandler, MoreFairDispatcher
 from reactors import Chaos
 from reactors import Monitor, AlarmClock
-from process_manager import MidgetHouse
+from process_manager import MidgetHouse, MidgetStore
 
 
 def main(envs, prog, raw_args):
+    # The measurements of the infrastructure
+    metrics = Registry()
+    # The hops of every 10th order flow
+    tracer = Tracer(sample_every=10)
+
     # The backbone of the application, the messaging system
-    bus = TopicBasedPubSub()
+    # With the `EVENT_LOG` environment variable the messages go through
+    # a durable log in that directory (delivered by the bus thread)
+    durable = 'EVENT_LOG' in envs
+    if durable:
+        bus = EventLogPubSub(envs['EVENT_LOG'], metrics=metrics, tracer=tracer)
+    else:
+        bus = TopicBasedPubSub(metrics=metrics, tracer=tracer)
 
     # Actors
     # They might have bus as an input or any other infrastructure
     # requirement, but they don't know each other, therefore the order
     # of instantiation doesn't matter.
 
-    # Cook has a shared state, the cooked food (for deduplication)
-    cooked = []
+    # Cook has a shared state, the cooked food (for deduplication),
+    # a reference is remembered for an hour
+    cooked = IdempotencyStore(ttl=3600)
     cook1 = Cook(bus, cooked, .1, 'Cook 1')
     cook2 = Cook(bus, cooked, .3, 'Cook 2')
     cook3 = Cook(bus, cooked, .5, 'Cook 3')
@@ -75,24 +91,36 @@ def main(envs, prog, raw_args):
     assman = AssistantManager(bus)
 
 
-    assman_queue = QueueHandler(assman, 'assmanQ')
-    cook1_queue = QueueHandler(cook1, 'cook1Q')
-    cook2_queue = QueueHandler(cook2, 'cook2Q')
-    cook3_queue = QueueHandler(cook3, 'cook3Q')
+    assman_queue = QueueHandler(assman, 'assmanQ', batch_size=16, metrics=metrics)
+    cook1_queue = QueueHandler(cook1, 'cook1Q', metrics=metrics)
+    cook2_queue = QueueHandler(cook2, 'cook2Q', metrics=metrics)
+    cook3_queue = QueueHandler(cook3, 'cook3Q', metrics=metrics)
     
     # multiplexer = RoundRobinDispatcher([cook1_queue, cook2_queue, cook3_queue])
-    cooks_dispatcher = MoreFairDispatcher([cook1_queue, cook2_queue, cook3_queue], 5)
-    cooks_dispatcher_queue = QueueHandler(cooks_dispatcher, 'MFD')
+    # cooks_dispatcher = ShortestExpectedDelayDispatcher([cook1_queue, cook2_queue, cook3_queue])
+    cooks_dispatcher = MoreFairDispatcher([cook1_queue, cook2_queue, cook3_queue], 5, metrics=metrics)
+    cooks_dispatcher_queue = QueueHandler(cooks_dispatcher, 'MFD', capacity=1000, metrics=metrics)
     cooks_chaos = Chaos(cooks_dispatcher_queue, 0.3, 0.3)
 
-    alarm_clock = AlarmClock(bus)
+    alarm_clock = AlarmClock(bus, metrics=metrics)
+
+    # Measures the whole flow of the orders
+    order_latency = FlowLatency(metrics)
 
-    midget_house = MidgetHouse(bus)
+    # With the durable bus the process managers are durable too.
+    # Their journal isn't synced on every message: the mapped pages
+    # survive a crash of the application, the snapshots are synced
+    if durable:
+        midget_store = MidgetStore(os.path.join(envs['EVENT_LOG'], 'process_managers'), sync=False)
+        midget_house = MidgetHouse(bus, midget_store)
+    else:
+        midget_house = MidgetHouse(bus)
 
     monitor = Monitor([
         cook1_queue, cook2_queue, cook3_queue,
         assman_queue, cashier,
-        cooks_dispatcher_queue, midget_house, bus
+        cooks_dispatcher_queue, cooks_dispatcher, midget_house, alarm_clock, bus,
+        metrics, tracer
     ])
 
 
@@ -105,6 +133,10 @@ def main(envs, prog, raw_args):
     # Cashier responds to the `TakePayment` Command
     bus.subscribe('take_payment', cashier.handle)
 
+    # The customers pay when the cashier tells that the payment is due
+    payments_due = queue.Queue()
+    bus.subscribe('payment_due', payments_due.put)
+
     # Printer prints the document
     bus.subscribe('order_paid', printer.handle)
 
@@ -113,12 +145,18 @@ def main(envs, prog, raw_args):
     # These are the *Start* and *End* signals of the process manager
     bus.subscribe('order_placed', midget_house.handle)
     bus.subscribe('order_completed', midget_house.handle_unsubscribe)
+    bus.subscribe('order_placed', order_latency.handle_start)
+    bus.subscribe('order_completed', order_latency.handle_end)
 
-    # The alarm clock responds the `DelayPublished` command
+    # The alarm clock responds the `DelayPublished` and
+    # the `CancelDelayedPublish` commands
     bus.subscribe('delay_publish', alarm_clock.handle)
+    bus.subscribe('cancel_delayed_publish', alarm_clock.handle_cancel)
 
     # Start
     # Start all of the services, fire up queues
+    if durable:
+        bus.start()
     monitor.start()
     cook1_queue.start()
     cook2_queue.start()
@@ -141,16 +179,19 @@ def main(envs, prog, raw_args):
             reference=f'ABC-{indx}',
             lines=[{'name': 'Cheese Pizza', 'qty': 1}]
         )
-        bus.subscribe(event.correlation_id, printer.handle)
+        bus.subscribe_correlation(event.correlation_id, printer.handle)
 
 
-    paid_total = 0
-    while paid_total < 101 and midget_house.count() > 0:
-        for order in cashier.get_outstanding_orders():
-            cashier.pay(order.reference)
-            paid_total += 1
-        print(f'Wait for more orders to come...')
-        time.sleep(1)
+    while midget_house.count() > 0:
+        try:
+            due = [payments_due.get(timeout=1)]
+        except queue.Empty:
+            print(f'Wait for more orders to come...')
+            continue
+        # Everybody at the till pays at once
+        while not payments_due.empty():
+            due.append(payments_due.get_nowait())
+        cashier.pay_many(message.order.reference for message in due)
 
     cook1_queue.stop()
     cook2_queue.stop()
@@ -159,6 +200,19 @@ def main(envs, prog, raw_args):
     cooks_dispatcher_queue.stop()
     monitor.stop()
     alarm_clock.stop()
+    if durable:
+        bus.stop()
+        bus.close()
+        midget_store.close()
+
+    print(metrics.exposition())
+
+    # Where the orders spent their time, and the slowest traced order
+    for stage, (count, seconds) in tracer.get_stages().items():
+        print(f'{stage}: {seconds / count * 1000:.3f}ms on average ({count} orders)')
+    traces = tracer.get_traces()
+    if traces:
+        print(max(traces, key=lambda trace: trace.get_duration()).format())
 
 
 if __name__ == '__main__':
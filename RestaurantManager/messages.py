@@ -12,71 +12,266 @@ CorrelationId:
   The first message in the flow (which doesn't have causation id)
   creates the CorrelationId. Every subsequent message should
   use the same CorrelationId.
+
+Every message class is registered by its name (the type tag), so an
+envelope can be turned back into the message (`decode_envelope`).
+The envelope has a schema version as well, if a class changes its
+version, the upcasters registered for the older versions
+(`register_upcaster`) bring the old envelopes up to date.
+
+The ids generated here are 128 bit integers: a random per-process
+prefix and a counter. They are cheap to create and formatted
+(as UUID strings) only when the message is serialized.
 """
-import json
+import itertools
+import os
+import random
 import uuid
 
+from documents import OrderDocument
+from serialization import JSON
+
+
+# Type tag -> message class
+MESSAGE_TYPES = {}
+
+# (type tag, version) -> function which turns an envelope of that
+# version into an envelope of the next version
+UPCASTERS = {}
+
+
+def _reset_ids():
+    global _id_prefix, _id_counter
+    _id_prefix = random.getrandbits(64) << 64
+    _id_counter = itertools.count(1)
+
+
+_reset_ids()
+# A forked process has to have its own prefix
+os.register_at_fork(after_in_child=_reset_ids)
+
+
+def new_id():
+    return _id_prefix | next(_id_counter)
+
+
+def format_id(value):
+    if isinstance(value, int):
+        return str(uuid.UUID(int=value))
+    return value
+
+
+def parse_id(value):
+    # Ids from other sources (eg. plain strings) are kept as they are
+    if isinstance(value, str) and len(value) == 36:
+        try:
+            return uuid.UUID(value).int
+        except ValueError:
+            pass
+    return value
+
+
 class Message:
+
+    __slots__ = ('correlation_id', 'causation_id', 'message_id')
+
+    version = 1
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # The name is the type tag, another class with the same name
+        # would take over the envelopes of this one
+        if cls.__name__ in MESSAGE_TYPES:
+            raise TypeError(f'Message type {cls.__name__} is already registered')
+        MESSAGE_TYPES[cls.__name__] = cls
+
     def __init__(self, correlation_id, causation_id=None, message_id=None):
         self.correlation_id = correlation_id
         self.causation_id = causation_id
-        self.message_id = message_id or str(uuid.uuid4())
+        self.message_id = new_id() if message_id is None else message_id
+
+    def to_envelope(self):
+        return {
+            'type': type(self).__name__,
+            'version': self.version,
+            'message_id': format_id(self.message_id),
+            'correlation_id': format_id(self.correlation_id),
+            'causation_id': format_id(self.causation_id),
+        }
+
+    @classmethod
+    def from_envelope(cls, envelope):
+        return cls(
+            correlation_id=parse_id(envelope['correlation_id']),
+            causation_id=parse_id(envelope['causation_id']),
+            message_id=parse_id(envelope['message_id']),
+        )
+
+    def serialize(self, codec=JSON):
+        return codec.encode(self.to_envelope())
+
+    @classmethod
+    def deserialize(cls, data, codec=JSON):
+        message = decode_envelope(codec.decode(data))
+        if not isinstance(message, cls):
+            raise TypeError(f'Expected {cls.__name__}, got {type(message).__name__}')
+        return message
+
+
+MESSAGE_TYPES[Message.__name__] = Message
+
+
+def register_upcaster(type_tag, version):
+    def decorator(upcaster):
+        if (type_tag, version) in UPCASTERS:
+            raise ValueError(f'Upcaster of {type_tag} version {version} is already registered')
+        UPCASTERS[(type_tag, version)] = upcaster
+        return upcaster
+    return decorator
+
+
+def decode_envelope(envelope):
+    try:
+        cls = MESSAGE_TYPES[envelope['type']]
+    except KeyError:
+        raise ValueError(f'Unknown message type {envelope["type"]}')
+    version = envelope.get('version', 1)
+    while version < cls.version:
+        envelope = UPCASTERS[(envelope['type'], version)](envelope)
+        version += 1
+    return cls.from_envelope(envelope)
+
+
+def deserialize(data, codec=JSON):
+    return decode_envelope(codec.decode(data))
+
+
+def serialize_many(messages, codec=JSON):
+    """
+    A batch of messages in one go (eg. to write them to disk)
+    """
+    return codec.encode([message.to_envelope() for message in messages])
+
+
+def deserialize_many(data, codec=JSON):
+    return [decode_envelope(envelope) for envelope in codec.decode(data)]
+
 
 class OrderBased(Message):
 
+    __slots__ = ('order', )
+
     def __init__(self, order, correlation_id, causation_id=None, message_id=None):
         super().__init__(correlation_id, causation_id, message_id)
         self.order = order
 
-    def serialize(self):
-        return json.dumps({'order': self.order._src})
+    def to_envelope(self):
+        envelope = super().to_envelope()
+        envelope['order'] = self.order._src
+        return envelope
+
+    @classmethod
+    def from_envelope(cls, envelope):
+        return cls(
+            OrderDocument(envelope['order']),
+            correlation_id=parse_id(envelope['correlation_id']),
+            causation_id=parse_id(envelope['causation_id']),
+            message_id=parse_id(envelope['message_id']),
+        )
 
 class Command(Message):
-    pass
+    __slots__ = ()
 
 class Event(Message):
-    pass
+    __slots__ = ()
 
 
 class CookFood(Command, OrderBased):
-    pass
+    __slots__ = ()
 
 
 class PriceOrder(Command, OrderBased):
-    pass
+    __slots__ = ()
 
 
 class TakePayment(Command, OrderBased):
-    pass
+    __slots__ = ()
 
 
 class DelayPublish(Command, Message):
 
+    __slots__ = ('delay', 'message', 'topic')
+
     def __init__(self, delay, topic, message, correlation_id, causation_id=None, message_id=None):
         self.delay = delay
         self.message = message
         self.topic = topic
         super().__init__(correlation_id, causation_id, message_id)
 
+    def to_envelope(self):
+        envelope = super().to_envelope()
+        envelope['delay'] = self.delay
+        envelope['topic'] = self.topic
+        envelope['message'] = self.message.to_envelope()
+        return envelope
+
+    @classmethod
+    def from_envelope(cls, envelope):
+        return cls(
+            envelope['delay'],
+            envelope['topic'],
+            decode_envelope(envelope['message']),
+            correlation_id=parse_id(envelope['correlation_id']),
+            causation_id=parse_id(envelope['causation_id']),
+            message_id=parse_id(envelope['message_id']),
+        )
+
+
+class CancelDelayedPublish(Command, Message):
+
+    __slots__ = ('delay_message_id', )
+
+    def __init__(self, delay_message_id, correlation_id, causation_id=None, message_id=None):
+        self.delay_message_id = delay_message_id
+        super().__init__(correlation_id, causation_id, message_id)
+
+    def to_envelope(self):
+        envelope = super().to_envelope()
+        envelope['delay_message_id'] = format_id(self.delay_message_id)
+        return envelope
+
+    @classmethod
+    def from_envelope(cls, envelope):
+        return cls(
+            parse_id(envelope['delay_message_id']),
+            correlation_id=parse_id(envelope['correlation_id']),
+            causation_id=parse_id(envelope['causation_id']),
+            message_id=parse_id(envelope['message_id']),
+        )
+
 
 class CookTimedOut(Event, OrderBased):
-    pass
+    __slots__ = ()
 
 
 class OrderPlaced(Event, OrderBased):
-    pass
+    __slots__ = ()
 
 
 class FoodCooked(Event, OrderBased):
-    pass
+    __slots__ = ()
 
 
 class OrderPriced(Event, OrderBased):
-    pass
+    __slots__ = ()
+
+
+class PaymentDue(Event, OrderBased):
+    __slots__ = ()
 
 
 class OrderPaid(Event, OrderBased):
-    pass
+    __slots__ = ()
 
 class OrderCompleted(Event, OrderBased):
-    pass
+    __slots__ = ()
@@ -0,0 +1,244 @@
+"""
+Metrics: counters, gauges and latency histograms in a `Registry`.
+
+The components take the registry as an optional `metrics` argument,
+without it they don't measure anything. The instruments are looked up
+once (by name and labels) and kept by the component, so recording
+a value is a lock and an addition.
+
+    registry = Registry()
+    bus = TopicBasedPubSub(metrics=registry)
+    ...
+    registry.snapshot()     # plain dict
+    registry.exposition()   # text, one line per value
+
+The histograms are HDR-style: the buckets are exact up to
+`2 ** (precision + 1)` microseconds, above that the relative
+error is at most `2 ** -precision`, whatever the magnitude is.
+"""
+import collections
+import threading
+import time
+
+
+class Counter:
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def snapshot(self):
+        return self._value
+
+
+class Gauge:
+    """
+    A value which goes up and down, or a function
+    which is called when the value is needed
+    """
+
+    def __init__(self, function=None):
+        self._value = 0
+        self._function = function
+
+    def set(self, value):
+        self._value = value
+
+    @property
+    def value(self):
+        if self._function is not None:
+            return self._function()
+        return self._value
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    """
+    Distribution of durations (in seconds), recorded in microseconds
+    """
+
+    quantiles = (.5, .9, .99, .999)
+
+    def __init__(self, precision=5):
+        self._precision = precision
+        self._sub_buckets = 1 << precision
+        self._exact = 2 << precision
+        # Buckets up to about 10 days, it grows if needed
+        self._counts = [0] * self._bucket(10 * 24 * 3600 * 10 ** 6)
+        self._count = 0
+        self._sum = 0
+        self._min = None
+        self._max = 0
+        self._lock = threading.Lock()
+
+    def _bucket(self, value):
+        if value < self._exact:
+            return value
+        shift = value.bit_length() - self._precision - 1
+        return shift * self._sub_buckets + (value >> shift)
+
+    def _lower_bound(self, bucket):
+        if bucket < self._exact:
+            return bucket
+        shift = bucket // self._sub_buckets - 1
+        return (bucket - shift * self._sub_buckets) << shift
+
+    def record(self, seconds):
+        value = int(seconds * 1e6)
+        if value < self._exact:
+            bucket = value if value > 0 else 0
+        else:
+            shift = value.bit_length() - self._precision - 1
+            bucket = shift * self._sub_buckets + (value >> shift)
+        with self._lock:
+            try:
+                self._counts[bucket] += 1
+            except IndexError:
+                self._counts.extend([0] * (bucket + 1 - len(self._counts)))
+                self._counts[bucket] += 1
+            self._count += 1
+            self._sum += seconds
+            if seconds > self._max:
+                self._max = seconds
+            if self._min is None or seconds < self._min:
+                self._min = seconds
+
+    @property
+    def count(self):
+        return self._count
+
+    def percentile(self, quantile):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._count
+        if total == 0:
+            return 0
+        rank = quantile * total
+        seen = 0
+        for bucket, count in enumerate(counts):
+            seen += count
+            if count and seen >= rank:
+                break
+        # The middle of the bucket
+        lower = self._lower_bound(bucket)
+        upper = self._lower_bound(bucket + 1)
+        return (lower + upper) / 2 / 1e6
+
+    def snapshot(self):
+        snapshot = {
+            'count': self._count,
+            'sum': self._sum,
+            'min': self._min or 0,
+            'max': self._max,
+        }
+        for quantile in self.quantiles:
+            snapshot[f'p{quantile * 100:g}'] = self.percentile(quantile)
+        return snapshot
+
+
+class Registry:
+    """
+    The instruments by name and labels
+    """
+
+    def __init__(self):
+        self._instruments = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name, function=None, **labels):
+        return self._get(Gauge, name, labels, function)
+
+    def histogram(self, name, **labels):
+        return self._get(Histogram, name, labels)
+
+    def _get(self, kind, name, labels, *args):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            instrument = self._instruments.get(key)
+            if instrument is None:
+                instrument = self._instruments[key] = kind(*args)
+        if not isinstance(instrument, kind):
+            raise TypeError(f'{name} is a {type(instrument).__name__}')
+        return instrument
+
+    def snapshot(self):
+        """
+        `{name: {labels: value}}`, the value of a histogram is a dict
+        """
+        snapshot = {}
+        for (name, labels), instrument in sorted(self._items()):
+            snapshot.setdefault(name, {})[labels] = instrument.snapshot()
+        return snapshot
+
+    def exposition(self):
+        """
+        Text format, one `name{labels} value` line per value
+        (the histograms by their count, sum and quantiles)
+        """
+        lines = []
+        for (name, labels), instrument in sorted(self._items()):
+            if isinstance(instrument, Histogram):
+                snapshot = instrument.snapshot()
+                for quantile in instrument.quantiles:
+                    value = snapshot[f'p{quantile * 100:g}']
+                    lines.append(_line(name, labels + (('quantile', quantile), ), value))
+                lines.append(_line(f'{name}_count', labels, snapshot['count']))
+                lines.append(_line(f'{name}_sum', labels, snapshot['sum']))
+            else:
+                lines.append(_line(name, labels, instrument.value))
+        return '\n'.join(lines) + '\n'
+
+    def _items(self):
+        with self._lock:
+            return list(self._instruments.items())
+
+    def get_info(self):
+        return f'Metrics: {len(self._instruments)} series'
+
+
+def _line(name, labels, value):
+    if labels:
+        name += '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+    return f'{name} {value:g}' if isinstance(value, float) else f'{name} {value}'
+
+
+class FlowLatency:
+    """
+    Time from the start to the end of the flows (eg. from `OrderPlaced`
+    to `OrderCompleted`) by correlation id.
+    At most `max_flows` flows are followed, the oldest is dropped
+    if a new one starts.
+    """
+
+    def __init__(self, registry, name='order_latency_seconds', max_flows=100000):
+        self._histogram = registry.histogram(name)
+        self._dropped = registry.counter(f'{name}_dropped')
+        self._max_flows = max_flows
+        self._started = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def handle_start(self, message):
+        with self._lock:
+            self._started[message.correlation_id] = time.perf_counter()
+            if len(self._started) > self._max_flows:
+                self._started.popitem(last=False)
+                self._dropped.inc()
+
+    def handle_end(self, message):
+        with self._lock:
+            started = self._started.pop(message.correlation_id, None)
+        if started is not None:
+            self._histogram.record(time.perf_counter() - started)
@@ -1,11 +1,20 @@
+import collections
 import functools
-
+import os
+import threading
+import time
+
+import messages
+from eventlog import EventLog
+from idempotency import IdempotencyStore
+from messages import format_id
+from serialization import BINARY
 from messages import OrderPlaced, CookFood
 from messages import FoodCooked, PriceOrder
 from messages import OrderPriced, TakePayment
 from messages import OrderPaid
 from messages import OrderCompleted
-from messages import DelayPublish, CookTimedOut
+from messages import DelayPublish, CancelDelayedPublish, CookTimedOut
 
 
 def methoddispatch(func):
@@ -21,65 +30,402 @@ class MidgetHouse:
     """
     The Main Process Manager which fires up the individual process managers
     I guess it's an Actor!
+
+    With a `MidgetStore` the process managers are event sourced:
+    every message they apply is written to the store, and the house
+    takes a snapshot of them every `snapshot_interval` messages.
+    A new house on the same store rehydrates the process managers
+    from the last snapshot and the messages after it.
+    The process managers idle for `idle_time` seconds are evicted
+    to the store, and loaded again by their next message.
     """
 
-    def __init__(self, bus):
+    def __init__(self, bus, store=None, snapshot_interval=1000, idle_time=None):
         self._bus = bus
         # Keeps record of sub process managers
         self._midgets = {}
+        self._store = store
+        self._snapshot_interval = snapshot_interval
+        self._idle_time = idle_time
+        # Correlation id -> last used, the least recently used first,
+        # so the idle ones are at the front
+        self._last_used = collections.OrderedDict()
+        # Saved to the store only
+        self._evicted = set()
+        # Loaded from the store, but the saved state is still there
+        self._loaded = set()
+        self._lock = threading.Lock()
+        self._recovering = False
+        if store is not None:
+            self._recover()
 
     def handle(self, message):
         # Message in this case is the start signal
         # It creates the rest of the flow
         # The flow itself related to the CorrelationId
-        midget = MidgetForRegular(self._bus)
-        self._midgets[message.correlation_id] = midget
+        midget = self._create()
+        with self._lock:
+            self._midgets[message.correlation_id] = midget
+            self._touch(message.correlation_id)
 
         # It subscribe itself to *Every*
         # messages which sent with the correlation_id
         # of the message
-        self._bus.subscribe(message.correlation_id, self.handle_by_correlation_id)
+        self._bus.subscribe_correlation(message.correlation_id, self.handle_by_correlation_id)
 
         # It basically ties the flow to the correlation id
 
+    def _create(self, state=None):
+        return MidgetForRegular(self._bus, state, None if self._store is None else self._journal)
+
+    def _journal(self, message):
+        if self._recovering:
+            return
+        if self._store.append(message) % self._snapshot_interval == 0:
+            self.snapshot()
+
     def handle_by_correlation_id(self, message):
         # Based on the correlation_id it is able to delegate the
         # message processing to the SubProcessManager
-        if message.correlation_id in self._midgets:
-            midget = self._midgets[message.correlation_id]
-            midget.handle(message)
+        midget = self._acquire(message.correlation_id)
+        if midget is not None:
+            try:
+                midget.handle(message)
+            finally:
+                self._release(midget)
+        if self._idle_time is not None:
+            self.evict_idle()
+
+    def _acquire(self, correlation_id):
+        """
+        The process manager locked for handling a message, or None
+        """
+        while True:
+            midget = self._get(correlation_id)
+            if midget is None:
+                return None
+            midget.lock.acquire()
+            if not midget.evicted:
+                midget.handling += 1
+                return midget
+            # Evicted before we got it, its saved state is loaded instead
+            midget.lock.release()
+
+    def _release(self, midget):
+        midget.handling -= 1
+        midget.lock.release()
+
+    def _get(self, correlation_id):
+        midget = self._midgets.get(correlation_id)
+        if midget is None and correlation_id in self._evicted:
+            with self._lock:
+                midget = self._midgets.get(correlation_id)
+                if midget is None and correlation_id in self._evicted:
+                    midget = self._create(self._store.load(correlation_id))
+                    self._midgets[correlation_id] = midget
+                    self._evicted.discard(correlation_id)
+                    self._loaded.add(correlation_id)
+        if midget is not None:
+            with self._lock:
+                self._touch(correlation_id)
+        return midget
+
+    def _touch(self, correlation_id):
+        self._last_used[correlation_id] = time.monotonic()
+        self._last_used.move_to_end(correlation_id)
 
     def handle_unsubscribe(self, message):
         # When the stop signal received it tears down
-        # the sub process managers
-        if message.correlation_id in self._midgets:
-            del self._midgets[message.correlation_id]
-            self._bus.unsubscribe(message.correlation_id, self.handle_by_correlation_id)
+        # the sub process managers, they still receive the stop signal
+        # so they can clean up (eg. cancel their timeouts)
+        midget = self._acquire(message.correlation_id)
+        if midget is not None:
+            try:
+                midget.handle(message)
+                self._remove(message.correlation_id)
+            finally:
+                self._release(midget)
+            self._bus.unsubscribe_correlation(message.correlation_id, self.handle_by_correlation_id)
+
+    def _remove(self, correlation_id):
+        with self._lock:
+            self._midgets.pop(correlation_id, None)
+            self._last_used.pop(correlation_id, None)
+        if correlation_id in self._loaded:
+            self._loaded.discard(correlation_id)
+            self._store.forget(correlation_id)
+
+    def evict_idle(self, now=None):
+        """
+        Save the idle process managers to the store and forget them
+        """
+        now = time.monotonic() if now is None else now
+        busy = []
+        with self._lock:
+            # Only the front is looked at, it stops at the first busy one
+            while self._last_used:
+                correlation_id, last_used = next(iter(self._last_used.items()))
+                if now - last_used < self._idle_time:
+                    break
+                del self._last_used[correlation_id]
+                midget = self._midgets.get(correlation_id)
+                if midget is None:
+                    continue
+                # Not waited for (a handler might wait for the house),
+                # the one handling a message right now isn't idle anyway
+                if not midget.lock.acquire(blocking=False):
+                    busy.append(correlation_id)
+                    continue
+                try:
+                    if midget.handling:
+                        busy.append(correlation_id)
+                        continue
+                    self._store.evict(correlation_id, midget.snapshot())
+                    midget.evicted = True
+                    del self._midgets[correlation_id]
+                    self._evicted.add(correlation_id)
+                    self._loaded.discard(correlation_id)
+                finally:
+                    midget.lock.release()
+            for correlation_id in busy:
+                self._touch(correlation_id)
+
+    def snapshot(self):
+        # The position is taken first, so the state might be a bit newer
+        # than the position, replaying a message again doesn't change it
+        offset = self._store.get_position()
+        with self._lock:
+            loaded, self._loaded = self._loaded, set()
+            states = {
+                correlation_id: midget.snapshot()
+                for correlation_id, midget in list(self._midgets.items())
+            }
+        self._store.save_snapshot(offset, states)
+        # The snapshot is newer than the evicted state of these
+        for correlation_id in loaded:
+            self._store.forget(correlation_id)
+
+    def _recover(self):
+        self._recovering = True
+        offset, states = self._store.load_snapshot()
+        self._midgets = {
+            correlation_id: self._create(state)
+            for correlation_id, state in states.items()
+        }
+        self._evicted = self._store.get_evicted() - set(self._midgets)
+        for message in self._store.read(offset):
+            correlation_id = message.correlation_id
+            # An evicted one is loaded by `_get` from its saved state
+            if (
+                isinstance(message, OrderPlaced)
+                and correlation_id not in self._midgets
+                and correlation_id not in self._evicted
+            ):
+                self._midgets[correlation_id] = self._create()
+            midget = self._get(correlation_id)
+            if midget is None:
+                continue
+            midget.apply(message)
+            if isinstance(message, OrderCompleted):
+                self._remove(correlation_id)
+        self._recovering = False
+        for correlation_id in set(self._midgets) | self._evicted:
+            self._touch(correlation_id)
+            self._bus.subscribe_correlation(correlation_id, self.handle_by_correlation_id)
 
     def get_info(self):
-        return f'MidgetHouse: {len(self._midgets)}'
+        return f'MidgetHouse: {len(self._midgets)} (evicted: {len(self._evicted)})'
 
     def count(self):
-        return len(self._midgets)
+        return len(self._midgets) + len(self._evicted)
+
+
+class MidgetStore:
+    """
+    Journal, snapshot and evicted process managers of a `MidgetHouse`
+    in a directory
+
+        journal/    | the messages applied by the process managers (`EventLog`)
+        snapshot    | the state of the process managers and the journal position
+        evicted/    | the state of an evicted process manager per file
+    """
+
+    def __init__(self, directory, codec=BINARY, **log_options):
+        self._directory = directory
+        self._codec = codec
+        self._journal = EventLog(os.path.join(directory, 'journal'), **log_options)
+        self._evicted = os.path.join(directory, 'evicted')
+        os.makedirs(self._evicted, exist_ok=True)
+
+    def append(self, message):
+        """
+        Returns the number of the messages in the journal
+        """
+        return self._journal.append('midget', self._codec.encode_bytes(message.to_envelope())) + 1
+
+    def get_position(self):
+        return len(self._journal)
+
+    def read(self, offset):
+        for position in range(max(offset, self._journal.get_first_offset()), len(self._journal)):
+            _, payload = self._journal.read(position)
+            yield messages.decode_envelope(self._codec.decode_bytes(payload))
+
+    def save_snapshot(self, offset, states):
+        path = os.path.join(self._directory, 'snapshot')
+        self._write(path, {
+            'offset': offset,
+            'midgets': [[correlation_id, state] for correlation_id, state in states.items()],
+        })
+        # The journal before the snapshot isn't needed anymore
+        self._journal.drop_before(offset)
+
+    def load_snapshot(self):
+        path = os.path.join(self._directory, 'snapshot')
+        if not os.path.exists(path):
+            return 0, {}
+        snapshot = self._read(path)
+        return snapshot['offset'], {
+            correlation_id: state for correlation_id, state in snapshot['midgets']
+        }
+
+    def evict(self, correlation_id, state):
+        self._write(self._evicted_path(correlation_id), [correlation_id, state])
+
+    def load(self, correlation_id):
+        return self._read(self._evicted_path(correlation_id))[1]
+
+    def forget(self, correlation_id):
+        try:
+            os.remove(self._evicted_path(correlation_id))
+        except FileNotFoundError:
+            pass
+
+    def get_evicted(self):
+        return {
+            self._read(os.path.join(self._evicted, name))[0]
+            for name in os.listdir(self._evicted)
+            if not name.endswith('.tmp')
+        }
+
+    def _evicted_path(self, correlation_id):
+        return os.path.join(self._evicted, str(format_id(correlation_id)))
+
+    def _write(self, path, value):
+        temporary = f'{path}.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(self._codec.encode_bytes(value))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return self._codec.decode_bytes(f.read())
+
+    def close(self):
+        self._journal.close()
 
 
 class MidgetForRegular:
+    """
+    The process manager of the regular flow
+
+    `apply` changes the state only (it is used to rehydrate the
+    process manager too), `handle` applies the message and then
+    takes the next step of the flow (publishes the messages).
+    The messages it publishes are applied as well, therefore
+    the state can be rebuilt from the applied messages alone.
+    Only the messages the state depends on are journaled.
+    """
 
-    def __init__(self, bus):
+    _journaled = (
+        OrderPlaced, FoodCooked, DelayPublish, CancelDelayedPublish,
+        CookTimedOut, OrderCompleted
+    )
+
+    def __init__(self, bus, state=None, journal=None, cooked=None):
         self._bus = bus
+        # For the house: one thread handles the messages at a time
+        # (the same thread can publish to the same flow, reentrant),
+        # and it isn't evicted meanwhile
+        self.lock = threading.RLock()
+        self.handling = 0
+        self.evicted = False
         self.handle = functools.singledispatch(self.handle)
         self.handle.register(OrderPlaced, self.handle_order_placed)
         self.handle.register(FoodCooked, self.handle_food_cooked)
         self.handle.register(OrderPriced, self.handle_order_priced)
         self.handle.register(OrderPaid, self.handle_order_paid)
         self.handle.register(CookTimedOut, self.handle_cook_timedout)
-        self._cooked = []
+        self.handle.register(OrderCompleted, self.handle_order_completed)
+        self._apply = functools.singledispatch(self._apply)
+        self._apply.register(FoodCooked, self._apply_food_cooked)
+        self._apply.register(DelayPublish, self._apply_delay_publish)
+        self._apply.register(CancelDelayedPublish, self._apply_cancel_delayed_publish)
+        self._apply.register(CookTimedOut, self._apply_cook_timedout)
+        self._journal = journal
+        # The ids of the published messages, they come back
+        # through the bus, but they are applied already
+        self._published = set()
+        state = state or {}
+        # For deduplication it manages it's own state
+        # and stores the cooked food references
+        self._cooked = IdempotencyStore() if cooked is None else cooked
+        for reference in state.get('cooked', ()):
+            self._cooked.add(reference)
+        # The message id of the pending timeout
+        self._timeout = state.get('timeout')
+
+    def snapshot(self):
+        return {'cooked': list(self._cooked), 'timeout': self._timeout}
+
+    def apply(self, message):
+        self._apply(message)
+        if self._journal is not None and isinstance(message, self._journaled):
+            self._journal(message)
+
+    def _apply(self, message):
+        return
+
+    def _apply_food_cooked(self, message):
+        self._cooked.add(message.order.reference)
+
+    def _apply_delay_publish(self, message):
+        self._timeout = message.message_id
+
+    def _apply_cancel_delayed_publish(self, message):
+        if self._timeout == message.delay_message_id:
+            self._timeout = None
+
+    def _apply_cook_timedout(self, message):
+        # The timer has fired, nothing to cancel
+        self._timeout = None
+
+    def _publish(self, topic, message):
+        self.apply(message)
+        self._published.add(message.message_id)
+        self._bus.publish(topic, message)
+
+    def _is_echo(self, message):
+        # The published messages come back through the bus,
+        # but they are applied already
+        if message.message_id in self._published:
+            self._published.discard(message.message_id)
+            return True
+        return False
 
     def handle(self, message):
         # Ignore messages that we don't want to process
-        return
+        # (apart from the state change)
+        if not self._is_echo(message):
+            self.apply(message)
 
     def handle_order_placed(self, message):
+        self.apply(message)
+        self._place_order(message)
+
+    def _place_order(self, message):
         # Deduplication
         if message.order.reference in self._cooked:
             # If the food cooked we don't have to do
@@ -103,32 +449,31 @@ class MidgetForRegular:
         # We send the timeout event in the future
         # and at the time we can check whether the
         # event has been processed as we expected
-        self._bus.publish(
-            'delay_publish',
-            DelayPublish(
-                delay=10,
-                topic='timed_out',
-                message=timeout,
-                correlation_id=message.correlation_id,
-                causation_id=message.message_id
-            )
+        delay = DelayPublish(
+            delay=10,
+            topic='timed_out',
+            message=timeout,
+            correlation_id=message.correlation_id,
+            causation_id=message.message_id
         )
+        self._publish('delay_publish', delay)
         # We send the command to do the action
-        self._bus.publish(
+        self._publish(
             'cook_food',
             cmd
         )
 
     def handle_cook_timedout(self, message):
         # In case of timeout we just do the action again
-        self.handle_order_placed(message)
+        self.apply(message)
+        self._place_order(message)
         return
 
     def handle_food_cooked(self, message):
-        # For deduplication it manages it's own state
-        # and stores the cooked food references
-        self._cooked.append(message.order.reference)
-        self._bus.publish(
+        self.apply(message)
+        # The food arrived, we don't need the timeout anymore
+        self._cancel_timeout(message)
+        self._publish(
             'price_order',
             PriceOrder(
                 message.order,
@@ -138,7 +483,8 @@ class MidgetForRegular:
         )
 
     def handle_order_priced(self, message):
-        self._bus.publish(
+        self.apply(message)
+        self._publish(
             'take_payment',
             TakePayment(
                 message.order,
@@ -148,12 +494,13 @@ class MidgetForRegular:
         )
 
     def handle_order_paid(self, message):
+        self.apply(message)
         # This is a technical but important step.
         # In this flow, once the order paid the
         # order considered being completed.
         # In this case we send the `order_completed`
         # event which is the stop signal of the process manager
-        self._bus.publish(
+        self._publish(
             'order_completed',
             OrderCompleted(
                 message.order,
@@ -162,6 +509,24 @@ class MidgetForRegular:
             )
         )
 
+    def handle_order_completed(self, message):
+        if not self._is_echo(message):
+            self.apply(message)
+        self._cancel_timeout(message)
+
+    def _cancel_timeout(self, message):
+        # Completed flows shouldn't leave timers behind
+        # in the alarm clock
+        if self._timeout is None:
+            return
+        self._publish(
+            'cancel_delayed_publish',
+            CancelDelayedPublish(
+                delay_message_id=self._timeout,
+                correlation_id=message.correlation_id,
+                causation_id=message.message_id
+            )
+        )
 
 
 class MidgetForDoggy:
@@ -2,9 +2,10 @@
 Reactors should be composed together to achieve the expected
 infrastructure.
 """
-from conrurrency import ThreadProcessor
+from conrurrency import ThreadProcessor, OverflowQueue, BLOCK
 import collections
-import datetime
+import heapq
+import itertools
 import os
 import queue
 import random
@@ -76,22 +77,140 @@ class MoreFairDispatcher:
     -> [ ] [o] [o]
        [o] [o] [o]
         ^
+
+    The handlers have to be `QueueHandler`s, the dispatcher
+    sleeps until one of them takes a message out of its queue.
+    From the handlers under the limit it picks the one with
+    the shortest queue, on tie the one which drained the most so far.
     """
 
-    def __init__(self, handlers, limit):
+    def __init__(self, handlers, limit, metrics=None):
         self._limit = limit
         self._handlers = handlers
+        self._wait_histogram = None if metrics is None else metrics.histogram('dispatcher_wait_seconds')
+        self._condition = threading.Condition()
+        self._drained = {id(handler): 0 for handler in handlers}
+        self._selected = {id(handler): 0 for handler in handlers}
+        self._waits = 0
+        self._wait_time = 0
+        self._max_wait_time = 0
+        for handler in handlers:
+            handler.add_dequeue_listener(self._dequeued)
 
     def handle(self, order):
-        handler = None
-        while handler is None:
+        waited = 0
+        with self._condition:
             handler = self._pick_one_handler()
+            if handler is None:
+                started = time.monotonic()
+                while handler is None:
+                    self._condition.wait(1)
+                    handler = self._pick_one_handler()
+                waited = time.monotonic() - started
+                self._record_wait(waited)
+            self._selected[id(handler)] += 1
+        if self._wait_histogram is not None:
+            self._wait_histogram.record(waited)
         handler.handle(order)
 
+    def _dequeued(self, handler):
+        with self._condition:
+            self._drained[id(handler)] += 1
+            self._condition.notify()
+
     def _pick_one_handler(self):
+        best = None
+        best_key = None
         for handler in self._handlers:
-            if handler.get_queue_size() < self._limit:
-                return handler
+            size = handler.get_queue_size()
+            if size >= self._limit:
+                continue
+            key = (size, -self._drained[id(handler)])
+            if best is None or key < best_key:
+                best, best_key = handler, key
+        return best
+
+    def _record_wait(self, waited):
+        self._waits += 1
+        self._wait_time += waited
+        self._max_wait_time = max(self._max_wait_time, waited)
+
+    def get_fairness(self):
+        """
+        Jain's fairness index of the selections,
+        1.0 if every handler got the same amount
+        """
+        counts = list(self._selected.values())
+        square_sum = sum(count * count for count in counts)
+        if square_sum == 0:
+            return 1.0
+        return sum(counts) ** 2 / (len(counts) * square_sum)
+
+    def get_metrics(self):
+        return {
+            'waits': self._waits,
+            'wait_time': self._wait_time,
+            'max_wait_time': self._max_wait_time,
+            'selected': [self._selected[id(handler)] for handler in self._handlers],
+            'fairness': self.get_fairness(),
+        }
+
+    def get_info(self):
+        return (
+            f'MoreFairDispatcher: waits {self._waits}'
+            f' ({self._wait_time:.3f}s, max {self._max_wait_time:.3f}s),'
+            f' fairness {self.get_fairness():.2f}'
+        )
+
+
+class ShortestExpectedDelayDispatcher:
+    """
+    Send the incoming message to the handler which is expected
+    to finish it the earliest.
+
+    The handlers have to be `QueueHandler`s, they measure
+    their service time (exponentially weighted moving average),
+    the expected delay is `(queue size + 1) * service time`.
+    With `choices` only that many randomly picked handlers are
+    compared (power of N choices), otherwise all of them.
+
+            o
+            |
+            x
+             \
+              \
+               \
+    ---- --- --- ----
+       [ ] [ ] [ ]
+       [o] [ ] [o]
+       [o] [o] [o]
+       fast    slow
+    """
+
+    def __init__(self, handlers, choices=None):
+        self._handlers = list(handlers)
+        if choices is not None and not 1 <= choices <= len(self._handlers):
+            raise ValueError(f'choices has to be between 1 and {len(self._handlers)}, not {choices}')
+        self._choices = choices
+
+    def handle(self, order):
+        if self._choices is None:
+            candidates = self._handlers
+        else:
+            candidates = random.sample(self._handlers, self._choices)
+        # A handler without measurement is expected to be as fast as
+        # the measured ones on average, without any measurement
+        # the shortest queue wins
+        service_times = [handler.get_service_time() for handler in self._handlers]
+        measured = [service_time for service_time in service_times if service_time]
+        prior = sum(measured) / len(measured) if measured else 1
+        handler = min(candidates, key=lambda handler: self._expected_delay(handler, prior))
+        handler.handle(order)
+
+    def _expected_delay(self, handler, prior):
+        queue_size = handler.get_queue_size()
+        # On a tie the shorter queue wins
+        return (queue_size + 1) * (handler.get_service_time() or prior), queue_size
 
 
 class QueueHandler(ThreadProcessor):
@@ -101,6 +220,25 @@ class QueueHandler(ThreadProcessor):
     In the same time it forwards the messages one by one
     to the handler synchronously.
 
+    With `batch_size` over 1 it takes up to that many messages
+    at once (waiting at most `batch_timeout` seconds for them)
+    and forwards them to the `handle_batch` method of the handler,
+    or one by one if the handler doesn't have one.
+
+    With a `capacity` the queue is bounded and the `overflow` policy
+    decides what happens when it is full (see `conrurrency.OverflowQueue`).
+    The default is to block the publisher, at most `put_timeout` seconds,
+    then `queue.Full` is raised to the publisher: the backpressure is
+    propagated through the bus.
+
+    The queue can be replaced by a `backend` with the same interface,
+    eg. a `ringbuffer.RingQueue`, so the handler can run in another
+    process than the publishers.
+
+    With a `metrics.Registry` it measures the handling time, the size
+    of the queue, and the time the messages wait in the queue
+    (only with the default queue, the message is queued with its time).
+
             o
            [ ]
            [ ]
@@ -112,30 +250,111 @@ class QueueHandler(ThreadProcessor):
     """
 
 
-    def __init__(self, handler, name):
+    def __init__(self, handler, name, smoothing=.2, batch_size=1, batch_timeout=0,
+                 capacity=0, overflow=BLOCK, put_timeout=None, spill_directory=None,
+                 backend=None, metrics=None):
         self._name = name
         self._handler = handler
-        self._queue = queue.Queue()
+        self._capacity = capacity
+        self._batch_size = batch_size
+        self._batch_timeout = batch_timeout
+        self._handle_batch = getattr(handler, 'handle_batch', None) if batch_size > 1 else None
+        self._timed = metrics is not None and backend is None
+        if backend is None:
+            backend = OverflowQueue(capacity, overflow, put_timeout, spill_directory)
+        self._queue = backend
+        self._wait_histogram = None
+        self._handle_histogram = None
+        if metrics is not None:
+            self._wait_histogram = metrics.histogram('queue_wait_seconds', queue=name)
+            self._handle_histogram = metrics.histogram('queue_handle_seconds', queue=name)
+            metrics.gauge('queue_size', self.get_queue_size, queue=name)
+        self._dequeue_listeners = []
+        self._smoothing = smoothing
+        self._service_time = 0
         super().__init__()
 
     def handle(self, order):
-        self._queue.put(order)
+        self._queue.put((time.perf_counter(), order) if self._timed else order)
+
+    def add_dequeue_listener(self, listener):
+        """
+        The listener is called with the queue handler
+        every time a message is taken out of the queue
+        """
+        self._dequeue_listeners.append(listener)
 
     def get_queue_size(self):
         return self._queue.qsize()
 
+    def get_service_time(self):
+        """
+        Exponentially weighted moving average of the handling time
+        """
+        return self._service_time
+
+    def get_high_water_mark(self):
+        return self._queue.get_high_water_mark()
+
+    def get_dropped_count(self):
+        return self._queue.get_dropped_count()
+
     def get_name(self):
         return self._name
 
     def get_info(self):
-        return f'{self.get_name()}: {self.get_queue_size()}'
+        if not self._capacity:
+            return f'{self.get_name()}: {self.get_queue_size()}'
+        return (
+            f'{self.get_name()}: {self.get_queue_size()}/{self._capacity}'
+            f' (high-water: {self.get_high_water_mark()},'
+            f' dropped: {self.get_dropped_count()},'
+            f' spilled: {self._queue.get_spilled_count()})'
+        )
 
     def run_once(self):
+        if self._batch_size > 1:
+            return self._run_batch()
         try:
             order = self._queue.get(timeout=1)
         except queue.Empty:
             return
+        for listener in self._dequeue_listeners:
+            listener(self)
+        started = time.perf_counter()
+        if self._timed:
+            enqueued, order = order
+            self._wait_histogram.record(started - enqueued)
         self._handler.handle(order)
+        self._update_service_time(time.perf_counter() - started)
+
+    def _run_batch(self):
+        try:
+            orders = self._queue.get_many(self._batch_size, timeout=1, linger=self._batch_timeout)
+        except queue.Empty:
+            return
+        for listener in self._dequeue_listeners:
+            for _ in orders:
+                listener(self)
+        started = time.perf_counter()
+        if self._timed:
+            for enqueued, _ in orders:
+                self._wait_histogram.record(started - enqueued)
+            orders = [order for _, order in orders]
+        if self._handle_batch is not None:
+            self._handle_batch(orders)
+        else:
+            for order in orders:
+                self._handler.handle(order)
+        self._update_service_time((time.perf_counter() - started) / len(orders))
+
+    def _update_service_time(self, elapsed):
+        if self._handle_histogram is not None:
+            self._handle_histogram.record(elapsed)
+        if self._service_time == 0:
+            self._service_time = elapsed
+        else:
+            self._service_time += self._smoothing * (elapsed - self._service_time)
 
 
 class AlarmClock(ThreadProcessor):
@@ -155,27 +374,121 @@ class AlarmClock(ThreadProcessor):
             |
             |
             o
+
+
+    Pending timers are kept in a min-heap ordered by the deadline,
+    the thread sleeps on a condition until the earliest one is due
+    (or an earlier one arrives), so it never scans the whole set.
+
+    A scheduled message can be cancelled by the `CancelDelayedPublish`
+    command (referring the `DelayPublish` by its message id).
+
+    With a `metrics.Registry` it measures how late the timers fire.
     """
 
-    def __init__(self, bus):
-        self._messages = []
+    def __init__(self, bus, metrics=None):
+        self._timers = []
+        self._scheduled = {}
+        self._dead = 0
+        self._fired = 0
+        self._cancelled = 0
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
         self._bus = bus
+        self._lateness = None if metrics is None else metrics.histogram('alarm_clock_lateness_seconds')
         super().__init__()
 
     def handle(self, message):
-        when = datetime.datetime.utcnow() + datetime.timedelta(seconds=message.delay)
-        self._messages.append((when, message))
+        timer = Timer(time.monotonic() + message.delay, message)
+        with self._condition:
+            self._scheduled[message.message_id] = timer
+            heapq.heappush(self._timers, (timer.deadline, next(self._sequence), timer))
+            if self._timers[0][2] is timer:
+                # New earliest deadline, the sleeping thread has to recalculate
+                self._condition.notify()
+        return timer
+
+    def handle_cancel(self, message):
+        with self._condition:
+            timer = self._scheduled.get(message.delay_message_id)
+            if timer is not None:
+                self._cancel(timer)
+
+    def cancel(self, timer):
+        with self._condition:
+            if not timer.cancelled and self._scheduled.get(timer.message.message_id) is timer:
+                self._cancel(timer)
+
+    def _cancel(self, timer):
+        # The entry stays in the heap and it is thrown away
+        # once it gets to the top, so cancellation is O(1).
+        # If the dead entries are the majority the heap is rebuilt,
+        # so they don't pile up in front of the live ones.
+        del self._scheduled[timer.message.message_id]
+        timer.cancel()
+        self._cancelled += 1
+        self._dead += 1
+        if self._dead * 2 > len(self._timers):
+            self._timers = [entry for entry in self._timers if not entry[2].cancelled]
+            heapq.heapify(self._timers)
+            self._dead = 0
+
+    def get_pending_count(self):
+        return len(self._timers) - self._dead
+
+    def get_fired_count(self):
+        return self._fired
+
+    def get_cancelled_count(self):
+        return self._cancelled
+
+    def get_info(self):
+        return (
+            f'AlarmClock: {self.get_pending_count()}'
+            f' (fired: {self._fired}, cancelled: {self._cancelled})'
+        )
 
     def run_once(self):
-        now = datetime.datetime.utcnow()
-        for element in list(self._messages):
-            when, message = element
-            if now > when:
-                self._bus.publish(message.topic, message.message)
-                self._messages.remove(element)
-                print('******* WAKE **********')
-        time.sleep(1)
+        due = []
+        with self._condition:
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                _, _, timer = heapq.heappop(self._timers)
+                if timer.cancelled:
+                    self._dead -= 1
+                else:
+                    del self._scheduled[timer.message.message_id]
+                    due.append(timer.message)
+                    if self._lateness is not None:
+                        self._lateness.record(now - timer.deadline)
+            self._fired += len(due)
+            if not due and self._running:
+                timeout = self._timers[0][0] - now if self._timers else None
+                self._condition.wait(timeout)
+        for message in due:
+            self._bus.publish(message.topic, message.message)
+
+    def stop(self):
+        with self._condition:
+            super().stop()
+            self._condition.notify()
+
+
+class Timer:
+    """
+    Handle of a scheduled message, it can be used to cancel it
+    """
+
+    __slots__ = ('deadline', 'message', 'cancelled')
+
+    def __init__(self, deadline, message):
+        self.deadline = deadline
+        self.message = message
+        self.cancelled = False
 
+    def cancel(self):
+        self.cancelled = True
+        self.message = None
 
 
 class Chaos:
@@ -0,0 +1,285 @@
+"""
+Ring buffer transport in shared memory, so the reactors
+can live in different processes.
+
+`RingBuffer` carries byte records in a `multiprocessing.shared_memory`
+block. A record is written straight into the shared memory and it is
+read through a `memoryview` of it, there is no intermediate copy.
+It has one consumer, and one producer (or more with `producers=True`,
+then the producers take a lock).
+
+On top of it:
+- `RingQueue` is a message queue, it can be the backend of a
+  `QueueHandler` (the messages are serialized by a codec)
+- `RingPublisher` is a bus to publish on (eg. for a remote actor)
+- `RingForwarder` publishes the messages of a `RingPublisher`
+  on a real bus
+
+             parent process          |     child process
+                                     |
+    bus --> RingQueue.put ====== ring =====> QueueHandler --> Cook
+                                     |                         |
+    bus <-- RingForwarder <===== ring ====== RingPublisher <---
+"""
+import multiprocessing
+import queue
+import struct
+import time
+from multiprocessing import shared_memory
+
+import messages
+from conrurrency import ThreadProcessor
+from serialization import BINARY
+
+
+class RingBuffer:
+
+    # head, tail (byte positions), written, read (record counters)
+    _header = struct.Struct('>QQQQ')
+    _length = struct.Struct('>I')
+    _padding = 0xffffffff
+
+    def __init__(self, capacity, producers=False, name=None):
+        self._owner = name is None
+        if self._owner:
+            self._memory = shared_memory.SharedMemory(create=True, size=self._header.size + capacity)
+            self._header.pack_into(self._memory.buf, 0, 0, 0, 0, 0)
+        else:
+            self._memory = shared_memory.SharedMemory(name=name)
+        self._capacity = capacity
+        self._data = self._memory.buf[self._header.size:]
+        self._items = multiprocessing.Semaphore(0)
+        self._lock = multiprocessing.Lock() if producers else None
+        self._high_water_mark = 0
+
+    def __reduce__(self):
+        # A spawned process attaches to the same memory block
+        return (_attach, (self._memory.name, self._capacity, self._items, self._lock))
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def put(self, data, timeout=None):
+        """
+        Write a record, if there is no space it waits at most
+        `timeout` seconds then raises `queue.Full`
+        """
+        if self._lock is None:
+            self._put(data, timeout)
+        else:
+            with self._lock:
+                self._put(data, timeout)
+        self._items.release()
+
+    def _put(self, data, timeout):
+        size = self._length.size + len(data)
+        if size > self._capacity:
+            raise ValueError(f'Record of {len(data)} bytes is bigger than the buffer')
+        head, tail, written, read = self._header.unpack_from(self._memory.buf)
+        index = tail % self._capacity
+        skip = self._capacity - index
+        if skip >= size:
+            skip = 0
+        self._wait_for_space(skip + size, timeout)
+        if skip:
+            # Not enough space before the end, the record starts over
+            # at the beginning (the rest is padding)
+            if skip >= self._length.size:
+                self._length.pack_into(self._data, index, self._padding)
+            index = 0
+        self._length.pack_into(self._data, index, len(data))
+        start = index + self._length.size
+        self._data[start:start + len(data)] = data
+        # The position is published after the record is written
+        struct.pack_into('>QQ', self._memory.buf, 8, tail + skip + size, written + 1)
+        if written + 1 - read > self._high_water_mark:
+            self._high_water_mark = written + 1 - read
+
+    def _wait_for_space(self, size, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        pause = .0001
+        while True:
+            head, tail, _, _ = self._header.unpack_from(self._memory.buf)
+            if self._capacity - (tail - head) >= size:
+                return
+            if deadline is not None and time.monotonic() >= deadline:
+                raise queue.Full
+            time.sleep(pause)
+            pause = min(pause * 2, .01)
+
+    def get_view(self, timeout=None):
+        """
+        Wait for the next record (raises `queue.Empty` on timeout)
+        and return a memoryview of it in the shared memory.
+        The view is valid until `release` is called.
+        """
+        if not self._items.acquire(timeout=timeout):
+            raise queue.Empty
+        return self._view()
+
+    def get_view_nowait(self):
+        if not self._items.acquire(False):
+            raise queue.Empty
+        return self._view()
+
+    def _view(self):
+        head = self._header.unpack_from(self._memory.buf)[0]
+        index = head % self._capacity
+        if self._is_padding(index, self._capacity - index):
+            index = 0
+        length, = self._length.unpack_from(self._data, index)
+        start = index + self._length.size
+        return self._data[start:start + length]
+
+    def release(self, view):
+        """
+        The record is processed, its space can be reused
+        """
+        head, _, _, read = self._header.unpack_from(self._memory.buf)
+        index = head % self._capacity
+        size = self._length.size + len(view)
+        rest = self._capacity - index
+        if self._is_padding(index, rest):
+            head += rest
+        view.release()
+        struct.pack_into('>Q', self._memory.buf, 0, head + size)
+        struct.pack_into('>Q', self._memory.buf, 24, read + 1)
+
+    def _is_padding(self, index, rest):
+        # The end of the buffer is skipped if the record didn't fit in
+        if rest < self._length.size:
+            return True
+        return self._length.unpack_from(self._data, index)[0] == self._padding
+
+    def get(self, timeout=None):
+        view = self.get_view(timeout)
+        try:
+            return bytes(view)
+        finally:
+            self.release(view)
+
+    def qsize(self):
+        _, _, written, read = self._header.unpack_from(self._memory.buf)
+        return written - read
+
+    def get_high_water_mark(self):
+        return self._high_water_mark
+
+    def close(self):
+        self._data.release()
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
+
+
+def _attach(name, capacity, items, lock):
+    ring = RingBuffer.__new__(RingBuffer)
+    ring._owner = False
+    ring._memory = shared_memory.SharedMemory(name=name)
+    ring._capacity = capacity
+    ring._data = ring._memory.buf[RingBuffer._header.size:]
+    ring._items = items
+    ring._lock = lock
+    ring._high_water_mark = 0
+    return ring
+
+
+class RingQueue:
+    """
+    Message queue on a `RingBuffer`, it has the interface
+    `QueueHandler` needs from its queue
+    """
+
+    def __init__(self, ring, codec=BINARY, timeout=None):
+        self._ring = ring
+        self._codec = codec
+        self._timeout = timeout
+
+    def put(self, message, block=True, timeout=None):
+        if timeout is None:
+            timeout = self._timeout if block else 0
+        self._ring.put(self._codec.encode_bytes(message.to_envelope()), timeout)
+
+    def handle(self, message):
+        self.put(message)
+
+    def get(self, block=True, timeout=None):
+        view = self._ring.get_view(timeout) if block else self._ring.get_view_nowait()
+        return self._decode(view)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def get_many(self, max_items, timeout=None, linger=0):
+        items = [self.get(timeout=timeout)]
+        deadline = time.monotonic() + linger
+        while len(items) < max_items:
+            remaining = deadline - time.monotonic()
+            try:
+                items.append(self.get(timeout=remaining) if remaining > 0 else self.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _decode(self, view):
+        try:
+            return messages.decode_envelope(self._codec.decode_bytes(view))
+        finally:
+            self._ring.release(view)
+
+    def qsize(self):
+        return self._ring.qsize()
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def get_high_water_mark(self):
+        return self._ring.get_high_water_mark()
+
+    def get_dropped_count(self):
+        return 0
+
+    def get_spilled_count(self):
+        return 0
+
+
+class RingPublisher:
+    """
+    Bus on a `RingBuffer`, the published messages are
+    delivered by a `RingForwarder` on the other side
+    """
+
+    def __init__(self, ring, codec=BINARY):
+        self._ring = ring
+        self._codec = codec
+
+    def publish(self, topic, message):
+        self._ring.put(self._codec.encode_bytes([topic, message.to_envelope()]))
+
+    def publish_many(self, topic, messages):
+        for message in messages:
+            self.publish(topic, message)
+
+
+class RingForwarder(ThreadProcessor):
+    """
+    Reads the messages of a `RingPublisher` and publishes them on the bus
+    """
+
+    def __init__(self, ring, bus, codec=BINARY):
+        self._ring = ring
+        self._bus = bus
+        self._codec = codec
+        super().__init__()
+
+    def run_once(self):
+        try:
+            view = self._ring.get_view(timeout=1)
+        except queue.Empty:
+            return
+        try:
+            topic, envelope = self._codec.decode_bytes(view)
+        finally:
+            self._ring.release(view)
+        self._bus.publish(topic, messages.decode_envelope(envelope))
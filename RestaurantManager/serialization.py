@@ -0,0 +1,336 @@
+"""
+Codecs turn the plain values of the documents and the message
+envelopes (dicts, lists, strings, numbers, booleans, None)
+into a wire format and back.
+
+- `JSON`: the default, text based (`json.dumps` compatible)
+- `BINARY`: compact binary format, a subset of MessagePack
+  (with an extension type for the 128 bit integers),
+  implemented in-tree, no dependency required
+
+The codecs don't know anything about the documents, whatever
+is in the document (even the unknown fields) is round-tripped.
+
+`encode_bytes` and `decode_bytes` are for the transports which
+work with bytes only (eg. shared memory), the text is UTF-8 there
+and the data to decode can be a `memoryview`.
+"""
+import json
+import struct
+
+
+class JSONCodec:
+
+    name = 'json'
+
+    def encode(self, value):
+        return json.dumps(value)
+
+    def decode(self, data):
+        return json.loads(data)
+
+    def encode_bytes(self, value):
+        return self.encode(value).encode('utf-8')
+
+    def decode_bytes(self, data):
+        return self.decode(bytes(data))
+
+
+class BinaryCodec:
+    """
+    MessagePack subset: nil, bool, int, float64, str, bin,
+    array, map, and the ext type 1 (fixext 16) for
+    integers up to 128 bit (eg. message ids)
+    """
+
+    name = 'binary'
+
+    def encode(self, value):
+        chunks = []
+        _encode(value, chunks)
+        return b''.join(chunks)
+
+    def decode(self, data):
+        value, position = _decode(bytes(data), 0)
+        if position != len(data):
+            raise ValueError(f'Extra data after position {position}')
+        return value
+
+    encode_bytes = encode
+    decode_bytes = decode
+
+
+JSON = JSONCodec()
+BINARY = BinaryCodec()
+
+CODECS = {codec.name: codec for codec in (JSON, BINARY)}
+
+
+def get_codec(name):
+    return CODECS[name]
+
+
+_BIG_INT_EXT = 1
+
+_uint8 = struct.Struct('>B')
+_uint16 = struct.Struct('>H')
+_uint32 = struct.Struct('>I')
+_uint64 = struct.Struct('>Q')
+_int8 = struct.Struct('>b')
+_int16 = struct.Struct('>h')
+_int32 = struct.Struct('>i')
+_int64 = struct.Struct('>q')
+_float64 = struct.Struct('>d')
+
+
+def _encode(value, chunks):
+    value_type = type(value)
+    # The most common cases first, without a function call
+    if value_type is str and len(value) < 0x20:
+        encoded = _short_strings.get(value)
+        if encoded is None:
+            encoded = _cache_short_string(value)
+        chunks.append(encoded)
+        return
+    if value_type is int and 0 <= value < 0x80:
+        chunks.append(_FIXINTS[value])
+        return
+    encoder = _ENCODERS.get(value_type)
+    if encoder is None:
+        raise TypeError(f'Object of type {value_type.__name__} is not serializable')
+    encoder(value, chunks)
+
+
+# The field names (and the other short strings) repeat a lot,
+# their encoded form is cached
+_SHORT_STRINGS_LIMIT = 4096
+_short_strings = {}
+_FIXINTS = [bytes((value, )) for value in range(0x80)]
+
+
+def _cache_short_string(value):
+    chunks = []
+    _encode_str(value, chunks)
+    encoded = b''.join(chunks)
+    if len(_short_strings) < _SHORT_STRINGS_LIMIT:
+        _short_strings[value] = encoded
+    return encoded
+
+
+def _encode_none(value, chunks):
+    chunks.append(b'\xc0')
+
+
+def _encode_bool(value, chunks):
+    chunks.append(b'\xc3' if value else b'\xc2')
+
+
+def _encode_int(value, chunks):
+    if 0 <= value < 0x80:
+        chunks.append(_uint8.pack(value))
+    elif -0x20 <= value < 0:
+        chunks.append(_int8.pack(value))
+    elif 0 <= value < 0x10000000000000000:
+        if value < 0x100:
+            chunks.append(b'\xcc' + _uint8.pack(value))
+        elif value < 0x10000:
+            chunks.append(b'\xcd' + _uint16.pack(value))
+        elif value < 0x100000000:
+            chunks.append(b'\xce' + _uint32.pack(value))
+        else:
+            chunks.append(b'\xcf' + _uint64.pack(value))
+    elif -0x8000000000000000 <= value < 0:
+        if value >= -0x80:
+            chunks.append(b'\xd0' + _int8.pack(value))
+        elif value >= -0x8000:
+            chunks.append(b'\xd1' + _int16.pack(value))
+        elif value >= -0x80000000:
+            chunks.append(b'\xd2' + _int32.pack(value))
+        else:
+            chunks.append(b'\xd3' + _int64.pack(value))
+    elif 0 <= value < 1 << 128:
+        chunks.append(b'\xd8\x01' + value.to_bytes(16, 'big'))
+    else:
+        raise OverflowError(f'Integer out of range {value}')
+
+
+def _encode_float(value, chunks):
+    chunks.append(b'\xcb' + _float64.pack(value))
+
+
+def _encode_str(value, chunks):
+    data = value.encode('utf-8')
+    size = len(data)
+    if size < 0x20:
+        chunks.append(_uint8.pack(0xa0 | size))
+    elif size < 0x100:
+        chunks.append(b'\xd9' + _uint8.pack(size))
+    elif size < 0x10000:
+        chunks.append(b'\xda' + _uint16.pack(size))
+    else:
+        chunks.append(b'\xdb' + _uint32.pack(size))
+    chunks.append(data)
+
+
+def _encode_bytes(value, chunks):
+    size = len(value)
+    if size < 0x100:
+        chunks.append(b'\xc4' + _uint8.pack(size))
+    elif size < 0x10000:
+        chunks.append(b'\xc5' + _uint16.pack(size))
+    else:
+        chunks.append(b'\xc6' + _uint32.pack(size))
+    chunks.append(bytes(value))
+
+
+def _encode_list(value, chunks):
+    size = len(value)
+    if size < 0x10:
+        chunks.append(_FIXARRAYS[size])
+    elif size < 0x10000:
+        chunks.append(b'\xdc' + _uint16.pack(size))
+    else:
+        chunks.append(b'\xdd' + _uint32.pack(size))
+    for item in value:
+        _encode(item, chunks)
+
+
+def _encode_dict(value, chunks):
+    size = len(value)
+    if size < 0x10:
+        chunks.append(_FIXMAPS[size])
+    elif size < 0x10000:
+        chunks.append(b'\xde' + _uint16.pack(size))
+    else:
+        chunks.append(b'\xdf' + _uint32.pack(size))
+    for key, item in value.items():
+        _encode(key, chunks)
+        _encode(item, chunks)
+
+
+_FIXARRAYS = [bytes((0x90 | size, )) for size in range(0x10)]
+_FIXMAPS = [bytes((0x80 | size, )) for size in range(0x10)]
+
+
+_ENCODERS = {
+    type(None): _encode_none,
+    bool: _encode_bool,
+    int: _encode_int,
+    float: _encode_float,
+    str: _encode_str,
+    bytes: _encode_bytes,
+    bytearray: _encode_bytes,
+    list: _encode_list,
+    tuple: _encode_list,
+    dict: _encode_dict,
+}
+
+
+def _decode(data, position):
+    marker = data[position]
+    position += 1
+    if marker < 0x80:
+        return marker, position
+    if marker >= 0xe0:
+        return marker - 0x100, position
+    if 0xa0 <= marker < 0xc0:
+        end = position + (marker & 0x1f)
+        raw = data[position:end]
+        value = _decoded_short_strings.get(raw)
+        if value is None:
+            value = raw.decode('utf-8')
+            if len(_decoded_short_strings) < _SHORT_STRINGS_LIMIT:
+                _decoded_short_strings[raw] = value
+        return value, end
+    if 0x90 <= marker < 0xa0:
+        return _decode_list(data, position, marker & 0x0f)
+    if 0x80 <= marker < 0x90:
+        return _decode_dict(data, position, marker & 0x0f)
+    try:
+        decoder = _DECODERS[marker]
+    except KeyError:
+        raise ValueError(f'Unknown marker 0x{marker:02x} at position {position - 1}')
+    return decoder(data, position)
+
+
+_decoded_short_strings = {}
+
+
+def _unpack(fmt):
+    def decoder(data, position):
+        return fmt.unpack_from(data, position)[0], position + fmt.size
+    return decoder
+
+
+def _decode_str(fmt):
+    def decoder(data, position):
+        size = fmt.unpack_from(data, position)[0]
+        position += fmt.size
+        return str(data[position:position + size], 'utf-8'), position + size
+    return decoder
+
+
+def _decode_bytes(fmt):
+    def decoder(data, position):
+        size = fmt.unpack_from(data, position)[0]
+        position += fmt.size
+        return bytes(data[position:position + size]), position + size
+    return decoder
+
+
+def _decode_sized(fmt, decode_items):
+    def decoder(data, position):
+        size = fmt.unpack_from(data, position)[0]
+        return decode_items(data, position + fmt.size, size)
+    return decoder
+
+
+def _decode_list(data, position, size):
+    items = []
+    for _ in range(size):
+        item, position = _decode(data, position)
+        items.append(item)
+    return items, position
+
+
+def _decode_dict(data, position, size):
+    items = {}
+    for _ in range(size):
+        key, position = _decode(data, position)
+        items[key], position = _decode(data, position)
+    return items, position
+
+
+def _decode_ext16(data, position):
+    ext_type = data[position]
+    if ext_type != _BIG_INT_EXT:
+        raise ValueError(f'Unknown extension type {ext_type}')
+    end = position + 17
+    return int.from_bytes(data[position + 1:end], 'big'), end
+
+
+_DECODERS = {
+    0xc0: lambda data, position: (None, position),
+    0xc2: lambda data, position: (False, position),
+    0xc3: lambda data, position: (True, position),
+    0xc4: _decode_bytes(_uint8),
+    0xc5: _decode_bytes(_uint16),
+    0xc6: _decode_bytes(_uint32),
+    0xcb: _unpack(_float64),
+    0xcc: _unpack(_uint8),
+    0xcd: _unpack(_uint16),
+    0xce: _unpack(_uint32),
+    0xcf: _unpack(_uint64),
+    0xd0: _unpack(_int8),
+    0xd1: _unpack(_int16),
+    0xd2: _unpack(_int32),
+    0xd3: _unpack(_int64),
+    0xd8: _decode_ext16,
+    0xd9: _decode_str(_uint8),
+    0xda: _decode_str(_uint16),
+    0xdb: _decode_str(_uint32),
+    0xdc: _decode_sized(_uint16, _decode_list),
+    0xdd: _decode_sized(_uint32, _decode_list),
+    0xde: _decode_sized(_uint16, _decode_dict),
+    0xdf: _decode_sized(_uint32, _decode_dict),
+}
@@ -0,0 +1,163 @@
+"""
+Sharded restaurant: the order flows are partitioned by their
+correlation id across worker processes, so the GIL doesn't limit
+the throughput.
+
+                 (W)           | Waiter (front process)
+                  |
+                  x            | ShardedRestaurant, routes by correlation id
+                / | \\
+    ---------- --- ----------
+    |  worker  |  |  worker  |  | every worker has its own bus,
+    | (*)(C)(A)|  | (*)(C)(A)|  | process manager, cooks, assistant
+    ----------    ----------    | manager and cashier
+
+Every message of a flow is handled in the same worker, so the same
+process manager sees the whole flow.
+The messages cross the process boundary serialized by the binary codec.
+In the workers the payments are settled right away (there is
+nobody at the till), the completed flows are reported back.
+
+Usage:
+
+    python sharding.py [workers] [orders]
+"""
+import multiprocessing
+import os
+import queue
+import sys
+import time
+
+import messages
+from actors import Cashier, Cook, Waiter, AssistantManager
+from buses import TopicBasedPubSub
+from idempotency import IdempotencyStore
+from process_manager import MidgetHouse
+from reactors import QueueHandler, MoreFairDispatcher, AlarmClock
+from serialization import BINARY
+
+
+class ShardedRestaurant:
+    """
+    Front router, it subscribes to the start of the flows (`order_placed`)
+    and forwards them to the worker which owns the correlation id
+    """
+
+    def __init__(self, workers, cook_times=(.1, .3, .5)):
+        self._inboxes = [multiprocessing.Queue() for _ in range(workers)]
+        self._outbox = multiprocessing.Queue()
+        self._processes = [
+            multiprocessing.Process(
+                target=run_worker,
+                args=(inbox, self._outbox, cook_times),
+                daemon=True
+            )
+            for inbox in self._inboxes
+        ]
+        self._completed = 0
+
+    def handle(self, message):
+        inbox = self._inboxes[hash(message.correlation_id) % len(self._inboxes)]
+        inbox.put(message.serialize(BINARY))
+
+    def start(self):
+        for process in self._processes:
+            process.start()
+
+    def stop(self):
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for process in self._processes:
+            process.join()
+
+    def wait_for_completed(self, count, timeout=None):
+        """
+        Wait until `count` flows are completed,
+        returns the number of completed flows so far
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._completed < count:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                break
+            try:
+                self._completed += self._outbox.get(timeout=remaining)
+            except queue.Empty:
+                break
+        return self._completed
+
+    def get_info(self):
+        return f'ShardedRestaurant: {len(self._processes)} workers, completed: {self._completed}'
+
+
+def run_worker(inbox, outbox, cook_times):
+    """
+    The pipeline of one worker process
+    """
+    bus = TopicBasedPubSub()
+    cooked = IdempotencyStore(ttl=3600)
+    cook_queues = [
+        QueueHandler(Cook(bus, cooked, time_to_sleep, f'Cook {indx}'), f'cook{indx}Q')
+        for indx, time_to_sleep in enumerate(cook_times)
+    ]
+    cooks_dispatcher_queue = QueueHandler(MoreFairDispatcher(cook_queues, 5), 'MFD')
+    assman_queue = QueueHandler(AssistantManager(bus), 'assmanQ', batch_size=16)
+    cashier = Cashier(bus)
+    alarm_clock = AlarmClock(bus)
+    midget_house = MidgetHouse(bus)
+    reactors = cook_queues + [cooks_dispatcher_queue, assman_queue, alarm_clock]
+
+    def take_payment(message):
+        cashier.handle(message)
+        cashier.pay(message.order.reference)
+
+    def order_completed(message):
+        midget_house.handle_unsubscribe(message)
+        outbox.put(1)
+
+    bus.subscribe('cook_food', cooks_dispatcher_queue.handle)
+    bus.subscribe('price_order', assman_queue.handle)
+    bus.subscribe('take_payment', take_payment)
+    bus.subscribe('order_placed', midget_house.handle)
+    bus.subscribe('order_completed', order_completed)
+    bus.subscribe('delay_publish', alarm_clock.handle)
+    bus.subscribe('cancel_delayed_publish', alarm_clock.handle_cancel)
+
+    for reactor in reactors:
+        reactor.start()
+    try:
+        while True:
+            data = inbox.get()
+            if data is None:
+                break
+            bus.publish('order_placed', messages.deserialize(data, BINARY))
+    finally:
+        for reactor in reactors:
+            reactor.stop()
+
+
+def main(envs, prog, raw_args):
+    workers = int(raw_args[0]) if raw_args else os.cpu_count()
+    orders = int(raw_args[1]) if len(raw_args) > 1 else 100
+
+    bus = TopicBasedPubSub()
+    waiter = Waiter(bus)
+    restaurant = ShardedRestaurant(workers)
+    bus.subscribe('order_placed', restaurant.handle)
+    restaurant.start()
+
+    for indx in range(orders):
+        waiter.place_order(
+            paid=False,
+            cooked=False,
+            reference=f'ABC-{indx}',
+            lines=[{'name': 'Cheese Pizza', 'qty': 1}]
+        )
+    while restaurant.wait_for_completed(orders, timeout=1) < orders:
+        print(restaurant.get_info())
+    print(restaurant.get_info())
+    restaurant.stop()
+
+
+if __name__ == '__main__':
+    main(os.environ, sys.argv[0], sys.argv[1:])
@@ -0,0 +1,92 @@
+import pytest
+
+from actors import Cashier
+from documents import OrderDocument
+from fakes import FakeBus
+from messages import TakePayment, PaymentDue, OrderPaid
+
+
+def take_payment(reference):
+    return TakePayment(OrderDocument({'reference': reference, 'paid': False}), correlation_id=reference)
+
+
+class TestCashier:
+
+    def test_new_order_is_outstanding_and_payment_due(self):
+        bus = FakeBus()
+        cashier = Cashier(bus)
+
+        cashier.handle(take_payment('ABC'))
+
+        assert [order.reference for order in cashier.get_outstanding_orders()] == ['ABC']
+        assert bus.topics() == ['payment_due']
+        assert type(bus.messages[0][1]) is PaymentDue
+
+    def test_paid_order_leaves_the_index(self):
+        bus = FakeBus()
+        cashier = Cashier(bus)
+        cashier.handle_batch([take_payment('ABC'), take_payment('DEF')])
+
+        cashier.pay('ABC')
+
+        assert [order.reference for order in cashier.get_outstanding_orders()] == ['DEF']
+        _, paid = bus.messages[-1]
+        assert type(paid) is OrderPaid
+        assert paid.order.paid is True
+        assert cashier.get_info() == 'Processed: 1, outstanding: 1'
+
+    def test_duplicated_payment_request_is_ignored(self):
+        bus = FakeBus()
+        cashier = Cashier(bus)
+        cashier.handle(take_payment('ABC'))
+        cashier.handle(take_payment('ABC'))
+        cashier.pay('ABC')
+
+        cashier.handle(take_payment('ABC'))
+
+        assert bus.topics() == ['payment_due', 'order_paid']
+        with pytest.raises(ValueError):
+            cashier.pay('ABC')
+
+    def test_unknown_order_cannot_be_paid(self):
+        cashier = Cashier(FakeBus())
+
+        with pytest.raises(KeyError):
+            cashier.pay('ABC')
+
+    def test_memory_is_bounded(self):
+        cashier = Cashier(FakeBus(), archive_size=10)
+        for indx in range(100):
+            cashier.handle(take_payment(f'ABC-{indx}'))
+            cashier.pay(f'ABC-{indx}')
+
+        assert cashier.get_outstanding_orders() == []
+        assert len(cashier._paid) == 10
+
+    def test_pay_many(self):
+        bus = FakeBus()
+        cashier = Cashier(bus)
+        for reference in ('ABC', 'DEF', 'GHI'):
+            cashier.handle(take_payment(reference))
+        bus.messages.clear()
+
+        cashier.pay_many(['ABC', 'GHI'])
+
+        assert [order.reference for order in cashier.get_outstanding_orders()] == ['DEF']
+        [(topic, paid)] = bus.published_many
+        assert topic == 'order_paid'
+        assert [message.order.reference for message in paid] == ['ABC', 'GHI']
+
+    @pytest.mark.parametrize('references', [['ABC', 'XYZ'], ['ABC', 'ABC'], ['ABC', 'PAID']])
+    def test_pay_many_pays_nothing_if_any_is_invalid(self, references):
+        bus = FakeBus()
+        cashier = Cashier(bus)
+        for reference in ('ABC', 'PAID'):
+            cashier.handle(take_payment(reference))
+        cashier.pay('PAID')
+
+        with pytest.raises((KeyError, ValueError)):
+            cashier.pay_many(references)
+
+        assert [order.reference for order in cashier.get_outstanding_orders()] == ['ABC']
+        assert cashier.get_info() == 'Processed: 1, outstanding: 1'
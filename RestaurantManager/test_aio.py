@@ -0,0 +1,123 @@
+import asyncio
+import threading
+
+from aio import AsyncTopicBasedPubSub, AsyncQueueHandler, AsyncMoreFairDispatcher
+from aio import AsyncAlarmClock, ExecutorAdapter
+from messages import Message, DelayPublish, CancelDelayedPublish
+
+
+class Recorder:
+
+    def __init__(self):
+        self.messages = []
+        self.threads = []
+
+    def handle(self, message):
+        self.messages.append(message)
+        self.threads.append(threading.get_ident())
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class TestAsyncTopicBasedPubSub:
+
+    def test_publish_from_a_thread_is_delivered_on_the_loop(self):
+        recorder = Recorder()
+
+        async def scenario():
+            bus = AsyncTopicBasedPubSub(asyncio.get_running_loop())
+            bus.subscribe('topic', recorder.handle)
+            thread = threading.Thread(
+                target=bus.publish,
+                args=('topic', Message(correlation_id='ABC'))
+            )
+            thread.start()
+            thread.join()
+            await asyncio.sleep(.01)
+            return threading.get_ident()
+
+        loop_thread = run(scenario())
+
+        assert recorder.threads == [loop_thread]
+
+    def test_coroutine_handlers_are_scheduled(self):
+        recorder = Recorder()
+
+        async def handle(message):
+            recorder.handle(message)
+
+        async def scenario():
+            bus = AsyncTopicBasedPubSub(asyncio.get_running_loop())
+            bus.subscribe_correlation('ABC', handle)
+            bus.publish('topic', Message(correlation_id='ABC'))
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+
+        run(scenario())
+
+        assert len(recorder.messages) == 1
+
+    def test_publish_many_from_a_thread(self):
+        recorder = Recorder()
+        sent = [Message(correlation_id='ABC') for _ in range(3)]
+
+        async def scenario():
+            bus = AsyncTopicBasedPubSub(asyncio.get_running_loop())
+            bus.subscribe('topic', recorder.handle)
+            thread = threading.Thread(target=bus.publish_many, args=('topic', sent))
+            thread.start()
+            thread.join()
+            await asyncio.sleep(.01)
+            return threading.get_ident()
+
+        loop_thread = run(scenario())
+
+        assert recorder.messages == sent
+        assert recorder.threads == [loop_thread] * 3
+
+
+class TestAsyncReactors:
+
+    def test_dispatcher_waits_for_free_queue(self):
+        recorders = [Recorder(), Recorder()]
+
+        async def scenario():
+            queues = [
+                AsyncQueueHandler(ExecutorAdapter(recorder), f'Q{indx}')
+                for indx, recorder in enumerate(recorders)
+            ]
+            dispatcher_queue = AsyncQueueHandler(AsyncMoreFairDispatcher(queues, 1), 'MFD')
+            for handler in [dispatcher_queue] + queues:
+                handler.start()
+            for _ in range(10):
+                dispatcher_queue.handle(Message(correlation_id='ABC'))
+            while sum(len(recorder.messages) for recorder in recorders) < 10:
+                await asyncio.sleep(.01)
+            for handler in [dispatcher_queue] + queues:
+                handler.stop()
+
+        run(scenario())
+
+        assert all(recorder.messages for recorder in recorders)
+
+    def test_alarm_clock_fires_and_cancels(self):
+        recorder = Recorder()
+
+        async def scenario():
+            bus = AsyncTopicBasedPubSub(asyncio.get_running_loop())
+            bus.subscribe('timed_out', recorder.handle)
+            alarm_clock = AsyncAlarmClock(bus)
+            fired = Message(correlation_id='ABC')
+            cancelled = DelayPublish(0, 'timed_out', Message(correlation_id='ABC'), 'ABC')
+            alarm_clock.handle(DelayPublish(0, 'timed_out', fired, 'ABC'))
+            alarm_clock.handle(cancelled)
+            alarm_clock.handle_cancel(CancelDelayedPublish(cancelled.message_id, 'ABC'))
+            await asyncio.sleep(.01)
+            return fired, alarm_clock.get_info()
+
+        fired, info = run(scenario())
+
+        assert recorder.messages == [fired]
+        assert info == 'AlarmClock: 0 (fired: 1, cancelled: 1)'
@@ -0,0 +1,395 @@
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+from buses import TopicBasedPubSub, DeliveryQueue, ESTopicBasedPubSub, EntryCollection, AppendError
+from conrurrency import DROP_OLDEST, REJECT
+from messages import Message, format_id, new_id
+
+
+class Recorder:
+
+    def __init__(self):
+        self.messages = []
+
+    def handle(self, message):
+        self.messages.append(message)
+
+
+class TestTopicBasedPubSub:
+
+    def test_publish_to_topic_and_correlation_subscribers(self):
+        bus = TopicBasedPubSub()
+        by_topic = Recorder()
+        by_correlation = Recorder()
+        bus.subscribe('topic', by_topic.handle)
+        bus.subscribe_correlation('ABC', by_correlation.handle)
+
+        message = Message(correlation_id='ABC')
+        bus.publish('topic', message)
+        bus.publish('other', Message(correlation_id='XYZ'))
+
+        assert by_topic.messages == [message]
+        assert by_correlation.messages == [message]
+
+    def test_publish_doesnt_create_subscriptions(self):
+        bus = TopicBasedPubSub()
+
+        bus.publish('topic', Message(correlation_id='ABC'))
+
+        assert bus.get_info() == 'BUS: 0 topics, 0 correlations'
+
+    def test_unsubscribe_correlation(self):
+        bus = TopicBasedPubSub()
+        recorder = Recorder()
+        bus.subscribe_correlation('ABC', recorder.handle)
+        bus.subscribe_correlation('XYZ', recorder.handle)
+
+        bus.unsubscribe_correlation('ABC', recorder.handle)
+        bus.publish('topic', Message(correlation_id='ABC'))
+
+        assert recorder.messages == []
+        assert bus.get_correlation_count() == 1
+
+    def test_subscribe_takes_only_topics(self):
+        bus = TopicBasedPubSub()
+        recorder = Recorder()
+
+        with pytest.raises(TypeError):
+            bus.subscribe(new_id(), recorder.handle)
+        with pytest.raises(TypeError):
+            bus.unsubscribe(new_id(), recorder.handle)
+
+        assert bus.get_info() == 'BUS: 0 topics, 0 correlations'
+
+
+class TestDeliveryQueue:
+
+    def test_slow_handler_doesnt_block_the_publisher(self):
+        bus = TopicBasedPubSub()
+        delivery = DeliveryQueue('slow', maxsize=10)
+        recorder = Recorder()
+        released = threading.Event()
+
+        def slow(message):
+            released.wait(1)
+            recorder.handle(message)
+
+        bus.subscribe('topic', slow, delivery)
+        delivery.start()
+        try:
+            start = time.monotonic()
+            bus.publish('topic', Message(correlation_id='ABC'))
+            bus.publish('topic', Message(correlation_id='ABC'))
+            assert time.monotonic() - start < .5
+            released.set()
+            time.sleep(.1)
+        finally:
+            delivery.stop()
+
+        assert len(recorder.messages) == 2
+
+    def test_drop_oldest_when_full(self):
+        bus = TopicBasedPubSub()
+        delivery = DeliveryQueue('drop', maxsize=2, overflow=DROP_OLDEST)
+        recorder = Recorder()
+        bus.subscribe('topic', recorder.handle, delivery)
+
+        messages = [Message(correlation_id='ABC') for _ in range(3)]
+        for message in messages:
+            bus.publish('topic', message)
+
+        assert delivery.get_queue_size() == 2
+        assert delivery.get_info() == 'drop: 2 (dropped: 1, failed: 0)'
+
+    def test_reject_when_full(self):
+        bus = TopicBasedPubSub()
+        delivery = DeliveryQueue('reject', maxsize=1, overflow=REJECT)
+        bus.subscribe('topic', Recorder().handle, delivery)
+
+        bus.publish('topic', Message(correlation_id='ABC'))
+        with pytest.raises(queue.Full):
+            bus.publish('topic', Message(correlation_id='ABC'))
+
+    def test_failing_handler_doesnt_stop_the_delivery(self):
+        bus = TopicBasedPubSub()
+        delivery = DeliveryQueue('failing')
+        recorder = Recorder()
+
+        def failing(message):
+            if message.correlation_id == 'BAD':
+                raise RuntimeError('Failed')
+            recorder.handle(message)
+
+        bus.subscribe('topic', failing, delivery)
+        delivery.start()
+        try:
+            bus.publish('topic', Message(correlation_id='BAD'))
+            bus.publish('topic', Message(correlation_id='ABC'))
+            deadline = time.monotonic() + 5
+            while not recorder.messages and time.monotonic() < deadline:
+                time.sleep(.01)
+        finally:
+            delivery.stop()
+
+        assert [message.correlation_id for message in recorder.messages] == ['ABC']
+        assert delivery.get_failed_count() == 1
+
+    def test_unsubscribe_delivered_handler(self):
+        bus = TopicBasedPubSub()
+        delivery = DeliveryQueue('unsubscribe')
+        recorder = Recorder()
+        bus.subscribe('topic', recorder.handle, delivery)
+
+        bus.unsubscribe('topic', recorder.handle)
+        bus.publish('topic', Message(correlation_id='ABC'))
+
+        assert delivery.get_queue_size() == 0
+
+
+class FakeEventStore(ThreadingHTTPServer):
+    """
+    Stand-in for the HTTP API of EventStore: one stream and
+    a competing consumer subscription on it
+    """
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeEventStoreRequestHandler)
+        self.events = []
+        self.appends = 0
+        # The next this many appends fail
+        self.failing = 0
+        self.read = 0
+        self.acked = []
+        self.nacked = []
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeEventStoreRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if url.path.endswith('/ack'):
+            self.server.acked.extend(parse_qs(url.query)['ids'][0].split(','))
+        elif url.path.endswith('/nack'):
+            self.server.nacked.extend(parse_qs(url.query)['ids'][0].split(','))
+        elif self.server.failing:
+            self.server.failing -= 1
+            self._respond(500, b'Unavailable')
+            return
+        else:
+            assert self.headers['Content-Type'] == 'application/vnd.eventstore.events+json'
+            self.server.appends += 1
+            self.server.events.extend(json.loads(body))
+        self._respond(201 if url.path.startswith('/streams') else 202)
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._respond(201)
+
+    def do_GET(self):
+        count = int(urlparse(self.path).path.rsplit('/', 1)[1])
+        events = self.server.events[self.server.read:self.server.read + count]
+        self.server.read += len(events)
+        entries = [
+            {'eventId': event['eventId'], 'eventType': event['eventType'], 'data': json.dumps(event['data'])}
+            for event in events
+        ]
+        self._respond(200, json.dumps({'entries': entries}).encode())
+
+    def _respond(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestESTopicBasedPubSub:
+
+    def test_messages_are_appended_in_batches(self):
+        with FakeEventStore() as eventstore:
+            bus = ESTopicBasedPubSub(eventstore.url, batch_size=100, linger=.05)
+            bus.start()
+            sent = [Message(correlation_id='ABC') for _ in range(1000)]
+            for message in sent:
+                bus.publish('topic', message)
+            bus.flush()
+            bus.stop()
+
+        assert [event['eventId'] for event in eventstore.events] == [format_id(message.message_id) for message in sent]
+        assert eventstore.events[0]['eventType'] == 'topic'
+        assert eventstore.appends <= 10
+
+    def test_failed_append_is_retried(self):
+        with FakeEventStore() as eventstore:
+            eventstore.failing = 2
+            bus = ESTopicBasedPubSub(eventstore.url, backoff=.01)
+            sent = [Message(correlation_id='ABC') for _ in range(3)]
+            bus.publish_many('topic', sent)
+            bus.flush()
+
+        assert [event['eventId'] for event in eventstore.events] == [format_id(message.message_id) for message in sent]
+        assert bus.get_info() == 'ES BUS: 0 pending, failed appends: 2'
+
+    def test_batch_is_kept_when_the_append_keeps_failing(self):
+        with FakeEventStore() as eventstore:
+            eventstore.failing = 2
+            bus = ESTopicBasedPubSub(eventstore.url, retries=1, backoff=.01)
+            sent = [Message(correlation_id='ABC') for _ in range(3)]
+            bus.publish_many('topic', sent)
+            with pytest.raises(AppendError):
+                bus.flush()
+            assert bus.get_info().startswith('ES BUS: 3 pending, failed appends: 2 (last error: 500')
+            bus.flush()
+
+        assert len(eventstore.events) == 3
+
+    def test_entries_are_dispatched_and_acked(self):
+        with FakeEventStore() as eventstore:
+            bus = ESTopicBasedPubSub(eventstore.url, prefetch=5)
+            received = []
+            bus.subscribe('topic', received.append)
+            bus.subscribe('failing', lambda message: 1 / 0)
+            bus.start()
+            ok = [Message(correlation_id='ABC') for _ in range(7)]
+            failing = Message(correlation_id='DEF')
+            for message in ok:
+                bus.publish('topic', message)
+            bus.publish('failing', failing)
+            deadline = time.monotonic() + 5
+            while len(eventstore.acked) + len(eventstore.nacked) < 8 and time.monotonic() < deadline:
+                time.sleep(.01)
+            bus.stop()
+
+        assert [message.message_id for message in received] == [message.message_id for message in ok]
+        assert eventstore.acked == [format_id(message.message_id) for message in ok]
+        assert eventstore.nacked == [format_id(failing.message_id)]
+
+
+    def test_streaming_read(self):
+        with FakeEventStore() as eventstore:
+            bus = ESTopicBasedPubSub(eventstore.url, streaming=True)
+            received = []
+            bus.subscribe('topic', received.append)
+            bus.start()
+            sent = [Message(correlation_id='ABC') for _ in range(3)]
+            for message in sent:
+                bus.publish('topic', message)
+            deadline = time.monotonic() + 5
+            while len(eventstore.acked) < 3 and time.monotonic() < deadline:
+                time.sleep(.01)
+            bus.stop()
+
+        assert [message.message_id for message in received] == [message.message_id for message in sent]
+
+
+PAGE = json.dumps({
+    'title': 'All events',
+    'links': [{'uri': 'http://localhost', 'relation': 'self'}],
+    'entries': [
+        {'eventId': f'id-{indx}', 'eventType': 'topic', 'data': json.dumps({'indx': indx})}
+        for indx in range(3)
+    ],
+    'headOfStream': False,
+}, indent=2)
+
+
+class TestEntryCollection:
+
+    def test_entries_are_created_once(self):
+        collection = EntryCollection.parse(PAGE)
+
+        assert len(collection) == 3
+        assert collection.entries is collection.entries
+        assert collection.entries[0] is list(collection)[0]
+
+    def test_data_is_decoded_once(self):
+        entry = EntryCollection.parse(PAGE).entries[1]
+
+        assert entry.data == {'indx': 1}
+        assert entry.data is entry.data
+
+    @pytest.mark.parametrize('text', [PAGE, json.dumps(json.loads(PAGE)), '{"entries": []}', '{}'])
+    def test_streaming_parse_gives_the_same_entries(self, text):
+        eager = EntryCollection.parse(text) if 'entries' in text else []
+        streaming = EntryCollection.parse(text, streaming=True)
+
+        assert [entry.event_id for entry in streaming] == [entry.event_id for entry in eager]
+
+    def test_streaming_parse_is_lazy(self):
+        collection = EntryCollection.parse(PAGE[:PAGE.index('id-1') - 20], streaming=True)
+
+        assert next(iter(collection)).event_id == 'id-0'
+
+    def test_streamed_entries_are_kept(self):
+        collection = EntryCollection.parse(PAGE, streaming=True)
+        first = next(iter(collection))
+
+        assert list(collection)[0] is first
+        assert len(collection) == 3
+        assert [entry.data['indx'] for entry in collection] == [0, 1, 2]
+
+    def test_len_while_streaming_doesnt_stop_the_loop(self):
+        collection = EntryCollection.parse(PAGE, streaming=True)
+
+        iterated = [(entry.event_id, len(collection)) for entry in collection]
+
+        assert iterated == [('id-0', 3), ('id-1', 3), ('id-2', 3)]
+
+    def test_null_data_is_decoded_once(self, monkeypatch):
+        entry = EntryCollection.parse('{"entries": [{"eventId": "id-0", "data": "null"}]}').entries[0]
+        decoded = []
+        monkeypatch.setattr(json, 'loads', lambda text: decoded.append(text))
+
+        assert entry.data is None
+        assert entry.data is None
+        assert decoded == ['null']
+
+
+class TestPublishMany:
+
+    def test_messages_are_delivered_in_order(self):
+        bus = TopicBasedPubSub()
+        by_topic = Recorder()
+        by_correlation = Recorder()
+        bus.subscribe('topic', by_topic.handle)
+        bus.subscribe_correlation('DEF', by_correlation.handle)
+        sent = [Message(correlation_id='ABC'), Message(correlation_id='DEF'), Message(correlation_id='GHI')]
+
+        bus.publish_many('topic', sent)
+
+        assert by_topic.messages == sent
+        assert by_correlation.messages == [sent[1]]
+
+    def test_es_bus_appends_the_batch(self):
+        with FakeEventStore() as eventstore:
+            bus = ESTopicBasedPubSub(eventstore.url, batch_size=100, linger=1)
+            sent = [Message(correlation_id='ABC') for _ in range(50)]
+            bus.publish_many('topic', sent)
+            bus.flush()
+
+        assert eventstore.appends == 1
+        assert len(eventstore.events) == 50
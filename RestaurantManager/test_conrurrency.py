@@ -0,0 +1,71 @@
+import queue
+
+import pytest
+
+from conrurrency import OverflowQueue, BLOCK, DROP_OLDEST, DROP_NEWEST, REJECT, SPILL
+
+
+def fill(overflow_queue, items):
+    for item in items:
+        overflow_queue.put(item)
+
+
+def drain(overflow_queue):
+    items = []
+    while not overflow_queue.empty():
+        items.append(overflow_queue.get_nowait())
+    return items
+
+
+class TestOverflowQueue:
+
+    def test_block_with_timeout_raises_full(self):
+        overflow_queue = OverflowQueue(1, BLOCK, timeout=.01)
+        overflow_queue.put(1)
+
+        with pytest.raises(queue.Full):
+            overflow_queue.put(2)
+
+    def test_drop_oldest(self):
+        overflow_queue = OverflowQueue(2, DROP_OLDEST)
+
+        fill(overflow_queue, [1, 2, 3])
+
+        assert drain(overflow_queue) == [2, 3]
+        assert overflow_queue.get_dropped_count() == 1
+
+    def test_drop_newest(self):
+        overflow_queue = OverflowQueue(2, DROP_NEWEST)
+
+        fill(overflow_queue, [1, 2, 3])
+
+        assert drain(overflow_queue) == [1, 2]
+        assert overflow_queue.get_dropped_count() == 1
+
+    def test_reject(self):
+        overflow_queue = OverflowQueue(1, REJECT)
+        overflow_queue.put(1)
+
+        with pytest.raises(queue.Full):
+            overflow_queue.put(2)
+
+    def test_spill_keeps_the_order(self, tmpdir):
+        overflow_queue = OverflowQueue(2, SPILL, spill_directory=str(tmpdir))
+
+        fill(overflow_queue, [1, 2, 3, 4])
+        assert overflow_queue.qsize() == 4
+        assert overflow_queue.get_spilled_count() == 2
+        assert overflow_queue.get_nowait() == 1
+        overflow_queue.put(5)
+
+        assert drain(overflow_queue) == [2, 3, 4, 5]
+        assert overflow_queue.get_high_water_mark() == 4
+
+    def test_get_many(self):
+        overflow_queue = OverflowQueue()
+        fill(overflow_queue, [1, 2, 3])
+
+        assert overflow_queue.get_many(2, timeout=0) == [1, 2]
+        assert overflow_queue.get_many(2, timeout=0) == [3]
+        with pytest.raises(queue.Empty):
+            overflow_queue.get_many(2, timeout=0)
@@ -1,3 +1,5 @@
+import threading
+
 from documents import OrderDocument, OrderLineDocument
 
 
@@ -42,3 +44,104 @@ class TestDocument:
         doc = OrderDocument(src)
 
         assert doc.serialize() == src
+
+
+class TestCopyOnWrite:
+
+    def create(self):
+        return OrderDocument({
+            'reference': 'ABC-123',
+            'lines': [{'name': 'Pizza', 'qty': 1}, {'name': 'Salad', 'qty': 2}],
+            'unknown': {'nested': [1]},
+        })
+
+    def test_copy_shares_until_written(self):
+        doc = self.create()
+
+        copied = doc.copy()
+
+        assert copied._src['unknown'] is doc._src['unknown']
+        assert copied.serialize() == doc.serialize()
+
+    def test_field_change_doesnt_affect_the_original(self):
+        doc = self.create()
+        copied = doc.copy()
+
+        copied.reference = '321-CBA'
+        copied.unknown['nested'].append(2)
+
+        assert doc.reference == 'ABC-123'
+        assert doc.unknown == {'nested': [1]}
+        assert copied.unknown == {'nested': [1, 2]}
+
+    def test_line_change_copies_only_that_line(self):
+        doc = self.create()
+        copied = doc.copy()
+
+        copied.lines[0].price = 12
+
+        assert 'price' not in doc._src['lines'][0]
+        assert copied.lines[0].price == 12
+        assert copied._src['lines'][1] is doc._src['lines'][1]
+
+    def test_original_change_doesnt_affect_the_copy(self):
+        doc = self.create()
+        copied = doc.copy()
+
+        doc.add_line(name='Soup', qty=1)
+        doc.lines[1].qty = 5
+
+        assert [line.name for line in copied.lines] == ['Pizza', 'Salad']
+        assert copied.lines[1].qty == 2
+        assert doc.lines[2].name == 'Soup'
+
+    def test_copies_from_many_threads(self):
+        doc = self.create()
+        doc.lines[0].qty = 3
+        copies = [[] for _ in range(4)]
+
+        def copy(copied):
+            for indx in range(500):
+                document = doc.copy()
+                document.lines[0].qty = indx
+                document.unknown['nested'].append(indx)
+                copied.append(document)
+
+        threads = [threading.Thread(target=copy, args=(copied, )) for copied in copies]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert doc.lines[0].qty == 3
+        assert doc.unknown == {'nested': [1]}
+        assert [copied[-1].unknown for copied in copies] == [{'nested': [1, 499]}] * 4
+
+
+class TestLines:
+
+    def test_lines_are_reused(self):
+        doc = OrderDocument({'lines': [{'name': 'Pizza', 'qty': 1}]})
+
+        assert doc.lines is doc.lines
+        assert doc.lines[0] is next(iter(doc.lines))
+        assert len(doc.lines) == 1
+
+    def test_add_line_is_visible(self):
+        doc = OrderDocument()
+        lines = doc.lines
+        assert len(lines) == 0
+
+        doc.add_line(name='Pizza', qty=1)
+        doc.add_line(name='Salad', qty=2)
+
+        assert [line.name for line in lines] == ['Pizza', 'Salad']
+
+    def test_replaced_lines_are_visible(self):
+        doc = OrderDocument({'lines': [{'name': 'Pizza', 'qty': 1}]})
+        lines = doc.lines
+
+        doc.lines = [{'name': 'Soup', 'qty': 3}]
+
+        assert lines[0].name == 'Soup'
+        assert not hasattr(lines[0], '__dict__')
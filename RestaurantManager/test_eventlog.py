@@ -0,0 +1,232 @@
+import threading
+import time
+
+import pytest
+
+from eventlog import EventLog, EventLogPubSub
+from messages import Message, OrderPlaced, new_id
+from serialization import JSON
+from documents import OrderDocument
+
+
+class Recorder:
+
+    def __init__(self):
+        self.messages = []
+
+    def handle(self, message):
+        self.messages.append(message)
+
+    def wait_for(self, count, timeout=5):
+        deadline = time.monotonic() + timeout
+        while len(self.messages) < count and time.monotonic() < deadline:
+            time.sleep(.01)
+        return self.messages
+
+
+class TestEventLog:
+
+    def test_append_and_read(self, tmp_path):
+        log = EventLog(str(tmp_path))
+
+        assert log.append('topic', b'first') == 0
+        assert log.append('other', b'second') == 1
+        assert log.read(0) == ('topic', b'first')
+        assert log.read(1) == ('other', b'second')
+        assert len(log) == 2
+        log.close()
+
+    def test_records_survive_reopening(self, tmp_path):
+        log = EventLog(str(tmp_path), segment_size=64)
+        for indx in range(10):
+            log.append('topic', f'record {indx}'.encode())
+        log.close()
+
+        log = EventLog(str(tmp_path), segment_size=64)
+
+        assert len(log) == 10
+        assert [log.read(indx)[1] for indx in range(10)] == [f'record {indx}'.encode() for indx in range(10)]
+        assert log.append('topic', b'next') == 10
+        log.close()
+
+    def test_segments_are_rolled(self, tmp_path):
+        log = EventLog(str(tmp_path), segment_size=64)
+        for indx in range(10):
+            log.append('topic', b'x' * 10)
+        log.close()
+
+        assert len(list(tmp_path.glob('*.log'))) == 5
+
+    def test_torn_record_is_dropped(self, tmp_path):
+        log = EventLog(str(tmp_path))
+        log.append('topic', b'first')
+        log.append('topic', b'second')
+        log.close()
+        path = next(tmp_path.glob('*.log'))
+        data = bytearray(path.read_bytes())
+        data[35] ^= 0xff
+        path.write_bytes(data)
+
+        log = EventLog(str(tmp_path))
+
+        assert len(log) == 1
+        assert log.append('topic', b'third') == 1
+        log.close()
+
+    def test_topic_index(self, tmp_path):
+        log = EventLog(str(tmp_path))
+        for indx in range(6):
+            log.append('even' if indx % 2 == 0 else 'odd', bytes([indx]))
+
+        assert list(log.read_topic('odd')) == [(1, b'\x01'), (3, b'\x03'), (5, b'\x05')]
+        assert list(log.read_topic('even', start=3)) == [(4, b'\x04')]
+        assert log.get_topic_count('even') == 3
+        log.close()
+
+    def test_concurrent_appends_are_committed_together(self, tmp_path):
+        log = EventLog(str(tmp_path), commit_delay=.01)
+
+        def append():
+            for _ in range(20):
+                log.append('topic', b'record')
+
+        publishers = [threading.Thread(target=append) for _ in range(4)]
+        for publisher in publishers:
+            publisher.start()
+        for publisher in publishers:
+            publisher.join()
+
+        assert len(log) == 80
+        assert log.get_commit_count() < 80
+        log.close()
+
+    def test_only_committed_records_are_waited_for(self, tmp_path):
+        log = EventLog(str(tmp_path), commit_delay=.2)
+        publisher = threading.Thread(target=log.append, args=('topic', b'record'))
+        publisher.start()
+        try:
+            deadline = time.monotonic() + 5
+            while len(log) == 0 and time.monotonic() < deadline:
+                time.sleep(.001)
+            assert log.get_durable_count() == 0
+            assert not log.wait(0, timeout=.01)
+        finally:
+            publisher.join()
+
+        assert log.get_durable_count() == 1
+        assert log.wait(0, timeout=0)
+        log.close()
+
+    def test_drop_before(self, tmp_path):
+        log = EventLog(str(tmp_path), segment_size=64)
+        for indx in range(10):
+            log.append('topic', bytes([indx]) * 10)
+
+        log.drop_before(5)
+        log.close()
+        log = EventLog(str(tmp_path), segment_size=64)
+
+        assert log.get_first_offset() == 4
+        assert len(log) == 10
+        assert log.read(9) == ('topic', b'\x09' * 10)
+        assert [offset for offset, _ in log.read_topic('topic')] == [4, 5, 6, 7, 8, 9]
+        log.close()
+
+    def test_too_big_record(self, tmp_path):
+        log = EventLog(str(tmp_path), segment_size=64)
+
+        with pytest.raises(ValueError):
+            log.append('topic', b'x' * 64)
+        log.close()
+
+
+class TestEventLogPubSub:
+
+    def test_published_messages_are_delivered(self, tmp_path):
+        bus = EventLogPubSub(str(tmp_path))
+        by_topic = Recorder()
+        by_correlation = Recorder()
+        bus.subscribe('order_placed', by_topic.handle)
+        bus.subscribe_correlation('ABC', by_correlation.handle)
+        bus.start()
+        try:
+            bus.publish('order_placed', OrderPlaced(OrderDocument({'reference': 'R1'}), correlation_id='ABC'))
+            received = by_topic.wait_for(1)
+        finally:
+            bus.stop()
+        time.sleep(1.1)
+        bus.close()
+
+        assert type(received[0]) is OrderPlaced
+        assert received[0].order.reference == 'R1'
+        assert by_correlation.messages == received
+
+    def test_undelivered_messages_are_delivered_after_restart(self, tmp_path):
+        bus = EventLogPubSub(str(tmp_path))
+        bus.publish('topic', Message(correlation_id='ABC'))
+        bus.publish('topic', Message(correlation_id='DEF'))
+        bus.close()
+
+        bus = EventLogPubSub(str(tmp_path))
+        recorder = Recorder()
+        bus.subscribe('topic', recorder.handle)
+        bus.run_once()
+        bus.close()
+
+        assert [message.correlation_id for message in recorder.messages] == ['ABC', 'DEF']
+
+    def test_delivered_messages_are_not_delivered_again(self, tmp_path):
+        bus = EventLogPubSub(str(tmp_path))
+        bus.publish('topic', Message(correlation_id='ABC'))
+        bus.run_once()
+        bus.close()
+
+        bus = EventLogPubSub(str(tmp_path))
+        recorder = Recorder()
+        bus.subscribe('topic', recorder.handle)
+        bus.publish('topic', Message(correlation_id='DEF'))
+        bus.run_once()
+        bus.close()
+
+        assert [message.correlation_id for message in recorder.messages] == ['DEF']
+
+    def test_json_codec(self, tmp_path):
+        bus = EventLogPubSub(str(tmp_path), codec=JSON)
+        recorder = Recorder()
+        bus.subscribe('topic', recorder.handle)
+        message = Message(correlation_id=new_id())
+        bus.publish_many('topic', [message])
+        bus.run_once()
+        bus.close()
+
+        assert [received.message_id for received in recorder.messages] == [message.message_id]
+
+    def test_cursor_past_the_end_of_the_log_is_reset(self, tmp_path):
+        bus = EventLogPubSub(str(tmp_path))
+        cursor = bus._log.get_cursor('bus')
+        cursor.position = 5
+        cursor.commit()
+        bus.close()
+
+        bus = EventLogPubSub(str(tmp_path))
+        recorder = Recorder()
+        bus.subscribe('topic', recorder.handle)
+        bus.publish('topic', Message(correlation_id='ABC'))
+        bus.run_once()
+        bus.close()
+
+        assert [message.correlation_id for message in recorder.messages] == ['ABC']
+
+
+class TestAppendMany:
+
+    def test_one_commit_for_the_batch(self, tmp_path):
+        log = EventLog(str(tmp_path), segment_size=64)
+
+        first = log.append_many('topic', [bytes([indx]) * 10 for indx in range(5)])
+
+        assert first == 0
+        assert len(log) == 5
+        assert log.read(4) == ('topic', b'\x04' * 10)
+        assert log.get_commit_count() == 1
+        log.close()
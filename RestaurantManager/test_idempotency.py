@@ -0,0 +1,137 @@
+import threading
+
+import pytest
+
+from idempotency import IdempotencyStore, PersistentIdempotencyStore, BloomFilter
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestIdempotencyStore:
+
+    def test_add_tells_whether_the_key_is_new(self):
+        store = IdempotencyStore()
+
+        assert store.add('ABC') is True
+        assert store.add('ABC') is False
+        assert 'ABC' in store
+        assert 'DEF' not in store
+
+    def test_least_recently_seen_key_is_evicted(self):
+        store = IdempotencyStore(max_size=2)
+        store.add('A')
+        store.add('B')
+        store.add('A')
+
+        store.add('C')
+
+        assert list(store) == ['A', 'C']
+        assert store.get_info() == 'IdempotencyStore: 2 (evicted: 1)'
+
+    def test_keys_expire(self):
+        clock = FakeClock()
+        store = IdempotencyStore(ttl=10, clock=clock)
+        store.add('A')
+        clock.now = 5
+        store.add('B')
+
+        clock.now = 11
+
+        assert 'A' not in store
+        assert 'B' in store
+        assert store.add('A') is True
+        assert list(store) == ['B', 'A']
+
+    def test_concurrent_adds(self):
+        store = IdempotencyStore()
+        new = []
+
+        def add():
+            new.extend(key for key in range(1000) if store.add(key))
+
+        threads = [threading.Thread(target=add) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert sorted(new) == list(range(1000))
+
+    def test_bloom_filter_front(self):
+        store = IdempotencyStore(max_size=10, bloom=BloomFilter(20))
+        for key in range(100):
+            assert store.add(key) is True
+
+        assert all(key in store for key in range(90, 100))
+        assert not any(key in store for key in range(90))
+
+    def test_bloom_filter_grows_past_its_capacity(self):
+        bloom = BloomFilter(100)
+        store = IdempotencyStore(bloom=bloom)
+        rebuilds = 0
+        for key in range(10000):
+            assert store.add(key) is True
+            if store._bloom is not bloom:
+                bloom = store._bloom
+                rebuilds += 1
+
+        assert rebuilds < 10
+        assert store._bloom.capacity >= 10000
+        assert all(key in store for key in range(10000))
+
+    def test_bloom_filter_smaller_than_max_size(self):
+        with pytest.raises(ValueError):
+            IdempotencyStore(max_size=1000, bloom=BloomFilter(100))
+
+
+class TestPersistentIdempotencyStore:
+
+    def test_keys_survive_restart(self, tmp_path):
+        path = str(tmp_path / 'cooked')
+        store = PersistentIdempotencyStore(path)
+        store.add('ABC')
+        store.close()
+
+        store = PersistentIdempotencyStore(path)
+
+        assert store.add('ABC') is False
+        assert store.add('DEF') is True
+        store.close()
+
+    def test_file_is_compacted(self, tmp_path):
+        path = tmp_path / 'cooked'
+        store = PersistentIdempotencyStore(str(path), max_size=10)
+        for key in range(2000):
+            store.add(f'ABC-{key}')
+        store.close()
+
+        assert len(path.read_text().splitlines()) < 1100
+        store = PersistentIdempotencyStore(str(path), max_size=10)
+        assert list(store) == [f'ABC-{key}' for key in range(1990, 2000)]
+        store.close()
+
+
+class TestBloomFilter:
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000)
+        for key in range(1000):
+            bloom.add(key)
+
+        assert all(key in bloom for key in range(1000))
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, error_rate=.01)
+        for key in range(1000):
+            bloom.add(key)
+
+        false_positives = sum(key in bloom for key in range(1000, 11000))
+
+        assert false_positives < 300
@@ -0,0 +1,154 @@
+import time
+
+import pytest
+
+from buses import TopicBasedPubSub
+from messages import Message, DelayPublish
+from metrics import Registry, Histogram, FlowLatency
+from reactors import QueueHandler, MoreFairDispatcher, AlarmClock
+
+
+class Recorder:
+
+    def __init__(self):
+        self.messages = []
+
+    def handle(self, message):
+        self.messages.append(message)
+
+
+class TestHistogram:
+
+    def test_small_values_are_exact(self):
+        histogram = Histogram()
+        for value in range(1, 11):
+            histogram.record(value / 1e6)
+
+        assert histogram.percentile(.5) == pytest.approx(5.5e-6)
+        assert histogram.snapshot()['count'] == 10
+
+    @pytest.mark.parametrize('seconds', [.0015, .25, 3.7, 120])
+    def test_relative_error_is_bounded(self, seconds):
+        histogram = Histogram(precision=5)
+        histogram.record(seconds)
+
+        assert histogram.percentile(.99) == pytest.approx(seconds, rel=1 / 32)
+
+    def test_percentiles(self):
+        histogram = Histogram()
+        for value in range(1000):
+            histogram.record(value / 1000)
+
+        snapshot = histogram.snapshot()
+
+        assert snapshot['p50'] == pytest.approx(.5, rel=.05)
+        assert snapshot['p99'] == pytest.approx(.99, rel=.05)
+        assert snapshot['max'] == .999
+
+
+class TestRegistry:
+
+    def test_instruments_are_shared_by_name_and_labels(self):
+        registry = Registry()
+
+        assert registry.counter('published', topic='a') is registry.counter('published', topic='a')
+        assert registry.counter('published', topic='a') is not registry.counter('published', topic='b')
+        with pytest.raises(TypeError):
+            registry.histogram('published', topic='a')
+
+    def test_snapshot_and_exposition(self):
+        registry = Registry()
+        registry.counter('published', topic='a').inc(3)
+        registry.gauge('size', lambda: 7)
+        registry.histogram('wait').record(.002)
+
+        assert registry.snapshot()['published'] == {(('topic', 'a'), ): 3}
+        text = registry.exposition()
+        assert 'published{topic="a"} 3\n' in text
+        assert 'size 7\n' in text
+        assert 'wait_count 1\n' in text
+        assert 'wait{quantile="0.5"} 0.002' in text
+
+
+class TestInstrumentation:
+
+    def test_bus(self):
+        registry = Registry()
+        bus = TopicBasedPubSub(metrics=registry)
+        bus.subscribe('topic', Recorder().handle)
+        bus.subscribe_correlation('ABC', Recorder().handle)
+
+        bus.publish('topic', Message(correlation_id='ABC'))
+        bus.publish_many('topic', [Message(correlation_id='DEF')])
+
+        assert registry.counter('bus_published_total', topic='topic').value == 2
+        assert registry.histogram('bus_handler_seconds', topic='topic').count == 3
+
+    def test_correlation_subscribed_by_topic_handler_gets_the_message(self):
+        bus = TopicBasedPubSub(metrics=Registry())
+        recorder = Recorder()
+        bus.subscribe('topic', lambda message: bus.subscribe_correlation('ABC', recorder.handle))
+
+        bus.publish('topic', Message(correlation_id='ABC'))
+
+        assert len(recorder.messages) == 1
+
+    def test_queue_handler(self):
+        registry = Registry()
+        recorder = Recorder()
+        handler = QueueHandler(recorder, 'Q', metrics=registry)
+        message = Message(correlation_id='ABC')
+
+        handler.handle(message)
+        assert registry.snapshot()['queue_size'] == {(('queue', 'Q'), ): 1}
+        handler.run_once()
+
+        assert recorder.messages == [message]
+        assert registry.histogram('queue_wait_seconds', queue='Q').count == 1
+        assert registry.histogram('queue_handle_seconds', queue='Q').count == 1
+
+    def test_batching_queue_handler(self):
+        registry = Registry()
+        recorder = Recorder()
+        handler = QueueHandler(recorder, 'Q', batch_size=5, metrics=registry)
+        messages = [Message(correlation_id='ABC') for _ in range(3)]
+        for message in messages:
+            handler.handle(message)
+
+        handler.run_once()
+
+        assert recorder.messages == messages
+        assert registry.histogram('queue_wait_seconds', queue='Q').count == 3
+
+    def test_dispatcher(self):
+        registry = Registry()
+        queues = [QueueHandler(Recorder(), 'Q')]
+        dispatcher = MoreFairDispatcher(queues, 5, metrics=registry)
+
+        dispatcher.handle(Message(correlation_id='ABC'))
+
+        assert registry.histogram('dispatcher_wait_seconds').count == 1
+
+    def test_alarm_clock(self):
+        registry = Registry()
+        alarm_clock = AlarmClock(TopicBasedPubSub(), metrics=registry)
+        alarm_clock.handle(DelayPublish(0, 'topic', Message(correlation_id='ABC'), correlation_id='ABC'))
+
+        alarm_clock.run_once()
+
+        assert registry.histogram('alarm_clock_lateness_seconds').count == 1
+
+    def test_flow_latency(self):
+        registry = Registry()
+        latency = FlowLatency(registry, max_flows=1)
+        latency.handle_start(Message(correlation_id='ABC'))
+        latency.handle_start(Message(correlation_id='DEF'))
+        time.sleep(.01)
+
+        latency.handle_end(Message(correlation_id='ABC'))
+        latency.handle_end(Message(correlation_id='DEF'))
+
+        histogram = registry.histogram('order_latency_seconds')
+        assert histogram.count == 1
+        assert histogram.snapshot()['min'] >= .01
+        assert registry.counter('order_latency_seconds_dropped').value == 1
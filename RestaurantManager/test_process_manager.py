@@ -0,0 +1,246 @@
+import threading
+import time
+
+from buses import TopicBasedPubSub
+from documents import OrderDocument
+from fakes import FakeBus
+from messages import OrderPlaced, FoodCooked, OrderCompleted, DelayPublish
+from messages import OrderPriced, OrderPaid, CancelDelayedPublish
+from process_manager import MidgetForRegular, MidgetHouse, MidgetStore
+from serialization import JSON
+
+
+def order_placed():
+    return OrderPlaced(OrderDocument({'reference': 'ABC-1'}), correlation_id='ABC')
+
+
+class TestMidgetForRegular:
+
+    def test_order_placed_schedules_timeout(self):
+        bus = FakeBus()
+        midget = MidgetForRegular(bus)
+
+        midget.handle(order_placed())
+
+        assert bus.topics() == ['delay_publish', 'cook_food']
+
+    def test_food_cooked_cancels_timeout(self):
+        bus = FakeBus()
+        midget = MidgetForRegular(bus)
+        placed = order_placed()
+        midget.handle(placed)
+        _, delay = bus.messages[0]
+
+        midget.handle(FoodCooked(placed.order, correlation_id='ABC'))
+
+        assert bus.topics()[2:] == ['cancel_delayed_publish', 'price_order']
+        _, cancel = bus.messages[2]
+        assert cancel.delay_message_id == delay.message_id
+
+    def test_order_completed_cancels_pending_timeout(self):
+        bus = FakeBus()
+        midget = MidgetForRegular(bus)
+        placed = order_placed()
+        midget.handle(placed)
+
+        midget.handle(OrderCompleted(placed.order, correlation_id='ABC'))
+        midget.handle(OrderCompleted(placed.order, correlation_id='ABC'))
+
+        assert bus.topics()[2:] == ['cancel_delayed_publish']
+
+
+class TestMidgetForRegularState:
+
+    def test_published_messages_are_applied(self):
+        bus = FakeBus()
+        midget = MidgetForRegular(bus)
+        midget.handle(order_placed())
+        _, delay = bus.messages[0]
+
+        assert midget.snapshot() == {'cooked': [], 'timeout': delay.message_id}
+
+    def test_state_is_rebuilt_by_apply(self):
+        bus = FakeBus()
+        applied = []
+        midget = MidgetForRegular(bus, journal=applied.append)
+        placed = order_placed()
+        midget.handle(placed)
+        midget.handle(FoodCooked(placed.order, correlation_id='ABC'))
+
+        rehydrated = MidgetForRegular(FakeBus())
+        for message in applied:
+            rehydrated.apply(message)
+
+        assert rehydrated.snapshot() == midget.snapshot() == {'cooked': ['ABC-1'], 'timeout': None}
+
+    def test_echo_of_published_message_is_ignored(self):
+        bus = FakeBus()
+        applied = []
+        midget = MidgetForRegular(bus, journal=applied.append)
+        midget.handle(order_placed())
+        _, delay = bus.messages[0]
+
+        midget.handle(delay)
+
+        assert [type(message) for message in applied] == [OrderPlaced, DelayPublish]
+
+    def test_echoes_of_commands_are_not_journaled(self):
+        bus = TopicBasedPubSub()
+        applied = []
+        midget = MidgetForRegular(bus, journal=applied.append)
+        bus.subscribe_correlation('ABC', midget.handle)
+        placed = order_placed()
+
+        midget.handle(placed)
+        bus.publish('order_cooked', FoodCooked(placed.order, correlation_id='ABC'))
+        bus.publish('order_priced', OrderPriced(placed.order, correlation_id='ABC'))
+        bus.publish('order_paid', OrderPaid(placed.order, correlation_id='ABC'))
+
+        assert [type(message) for message in applied] == [
+            OrderPlaced, DelayPublish, FoodCooked, CancelDelayedPublish, OrderCompleted
+        ]
+        assert midget._published == set()
+
+
+class TestMidgetHouse:
+
+    def start_flow(self, bus, house, reference):
+        placed = OrderPlaced(OrderDocument({'reference': reference}), correlation_id=reference)
+        bus.subscribe('order_placed', house.handle)
+        bus.publish('order_placed', placed)
+        return placed
+
+    def test_process_managers_are_rehydrated(self, tmp_path):
+        bus = TopicBasedPubSub()
+        store = MidgetStore(str(tmp_path), sync=False)
+        house = MidgetHouse(bus, store)
+        placed = self.start_flow(bus, house, 'ABC')
+        bus.publish('order_cooked', FoodCooked(placed.order, correlation_id='ABC'))
+        store.close()
+
+        house = MidgetHouse(TopicBasedPubSub(), MidgetStore(str(tmp_path), sync=False))
+
+        assert house.count() == 1
+        assert house._midgets['ABC'].snapshot() == {'cooked': ['ABC'], 'timeout': None}
+
+    def test_json_store(self, tmp_path):
+        bus = TopicBasedPubSub()
+        store = MidgetStore(str(tmp_path), codec=JSON, sync=False)
+        house = MidgetHouse(bus, store, snapshot_interval=2)
+        placed = self.start_flow(bus, house, 'ABC')
+        bus.publish('order_cooked', FoodCooked(placed.order, correlation_id='ABC'))
+        store.close()
+
+        house = MidgetHouse(TopicBasedPubSub(), MidgetStore(str(tmp_path), codec=JSON, sync=False))
+
+        assert house._midgets['ABC'].snapshot() == {'cooked': ['ABC'], 'timeout': None}
+
+    def test_rehydration_starts_from_the_snapshot(self, tmp_path):
+        bus = TopicBasedPubSub()
+        store = MidgetStore(str(tmp_path), sync=False, segment_size=1024)
+        house = MidgetHouse(bus, store, snapshot_interval=10)
+        for indx in range(10):
+            self.start_flow(bus, house, f'ABC-{indx}')
+        store.close()
+
+        store = MidgetStore(str(tmp_path), sync=False, segment_size=1024)
+        offset, states = store.load_snapshot()
+        house = MidgetHouse(TopicBasedPubSub(), store)
+
+        assert offset > 0
+        assert store._journal.get_first_offset() > 0
+        assert house.count() == 10
+
+    def test_completed_flows_are_not_rehydrated(self, tmp_path):
+        bus = TopicBasedPubSub()
+        store = MidgetStore(str(tmp_path), sync=False)
+        house = MidgetHouse(bus, store)
+        bus.subscribe('order_completed', house.handle_unsubscribe)
+        placed = self.start_flow(bus, house, 'ABC')
+        bus.publish('order_completed', OrderCompleted(placed.order, correlation_id='ABC'))
+        store.close()
+
+        house = MidgetHouse(TopicBasedPubSub(), MidgetStore(str(tmp_path), sync=False))
+
+        assert house.count() == 0
+
+    def test_idle_process_managers_are_evicted_and_reloaded(self, tmp_path):
+        bus = TopicBasedPubSub()
+        cooked = []
+        bus.subscribe('price_order', cooked.append)
+        house = MidgetHouse(bus, MidgetStore(str(tmp_path), sync=False), idle_time=60)
+        placed = self.start_flow(bus, house, 'ABC')
+
+        house.evict_idle(now=time.monotonic() + 61)
+
+        assert house.get_info() == 'MidgetHouse: 0 (evicted: 1)'
+        bus.publish('order_cooked', FoodCooked(placed.order, correlation_id='ABC'))
+        assert house.get_info() == 'MidgetHouse: 1 (evicted: 0)'
+        assert len(cooked) == 1
+
+    def test_evicted_process_manager_is_rehydrated_once(self, tmp_path):
+        bus = TopicBasedPubSub()
+        store = MidgetStore(str(tmp_path), sync=False)
+        house = MidgetHouse(bus, store, idle_time=60)
+        placed = self.start_flow(bus, house, 'ABC')
+        house.evict_idle(now=time.monotonic() + 61)
+        store.close()
+
+        bus = TopicBasedPubSub()
+        priced = []
+        bus.subscribe('price_order', priced.append)
+        house = MidgetHouse(bus, MidgetStore(str(tmp_path), sync=False), idle_time=60)
+        bus.publish('order_cooked', FoodCooked(placed.order, correlation_id='ABC'))
+
+        assert house.count() == 1
+        assert len(priced) == 1
+
+    def test_process_manager_handling_a_message_is_not_evicted(self, tmp_path):
+        bus = TopicBasedPubSub()
+        house = MidgetHouse(bus, MidgetStore(str(tmp_path), sync=False), idle_time=60)
+        self.start_flow(bus, house, 'ABC')
+        midget = house._midgets['ABC']
+        holder = threading.Thread(target=midget.lock.acquire)
+        holder.start()
+        holder.join()
+
+        house.evict_idle(now=time.monotonic() + 61)
+
+        assert house.get_info() == 'MidgetHouse: 1 (evicted: 0)'
+        assert not midget.evicted
+
+    def test_message_for_process_manager_evicted_meanwhile_is_not_lost(self, tmp_path):
+        bus = TopicBasedPubSub()
+        cooked = []
+        bus.subscribe('price_order', cooked.append)
+        house = MidgetHouse(bus, MidgetStore(str(tmp_path), sync=False), idle_time=60)
+        placed = self.start_flow(bus, house, 'ABC')
+        get = house._get
+
+        def get_then_evict(correlation_id):
+            # The house evicts it right after the lookup
+            midget = get(correlation_id)
+            house._get = get
+            house.evict_idle(now=time.monotonic() + 61)
+            return midget
+
+        house._get = get_then_evict
+        bus.publish('order_cooked', FoodCooked(placed.order, correlation_id='ABC'))
+
+        assert len(cooked) == 1
+        assert house._midgets['ABC'].snapshot()['cooked'] == ['ABC']
+
+    def test_least_recently_used_are_evicted_first(self, tmp_path):
+        bus = TopicBasedPubSub()
+        house = MidgetHouse(bus, MidgetStore(str(tmp_path), sync=False), idle_time=60)
+        first = self.start_flow(bus, house, 'ABC')
+        self.start_flow(bus, house, 'DEF')
+        time.sleep(.01)
+        between = time.monotonic()
+        time.sleep(.01)
+        bus.publish('order_cooked', FoodCooked(first.order, correlation_id='ABC'))
+
+        house.evict_idle(now=between + 60)
+
+        assert list(house._midgets) == ['ABC']
+        assert list(house._last_used) == ['ABC']
@@ -0,0 +1,256 @@
+import threading
+import time
+
+import pytest
+
+from conrurrency import SPILL
+from documents import OrderDocument
+from fakes import FakeBus
+from messages import DelayPublish, CancelDelayedPublish, Message, OrderPlaced
+from reactors import AlarmClock, MoreFairDispatcher, QueueHandler
+from reactors import ShortestExpectedDelayDispatcher
+
+
+class Recorder:
+
+    def __init__(self):
+        self.messages = []
+
+    def handle(self, message):
+        self.messages.append(message)
+
+
+class Sleeper(Recorder):
+
+    def __init__(self, time_to_sleep):
+        self._time_to_sleep = time_to_sleep
+        super().__init__()
+
+    def handle(self, message):
+        time.sleep(self._time_to_sleep)
+        super().handle(message)
+
+
+def delay_publish(delay, message):
+    return DelayPublish(
+        delay=delay,
+        topic='timed_out',
+        message=message,
+        correlation_id='ABC'
+    )
+
+
+class TestAlarmClock:
+
+    def test_publish_due_messages_in_deadline_order(self):
+        bus = FakeBus()
+        alarm_clock = AlarmClock(bus)
+
+        alarm_clock.handle(delay_publish(-1, 'second'))
+        alarm_clock.handle(delay_publish(-2, 'first'))
+        alarm_clock.handle(delay_publish(60, 'later'))
+        alarm_clock.run_once()
+
+        assert bus.messages == [('timed_out', 'first'), ('timed_out', 'second')]
+        assert alarm_clock.get_pending_count() == 1
+
+    def test_cancelled_timer_is_not_published(self):
+        bus = FakeBus()
+        alarm_clock = AlarmClock(bus)
+
+        timer = alarm_clock.handle(delay_publish(0, 'cancelled'))
+        alarm_clock.cancel(timer)
+        alarm_clock.run_once()
+
+        assert bus.messages == []
+        assert alarm_clock.get_pending_count() == 0
+
+    def test_cancel_by_command(self):
+        bus = FakeBus()
+        alarm_clock = AlarmClock(bus)
+        cancelled = delay_publish(0, 'cancelled')
+
+        alarm_clock.handle(cancelled)
+        alarm_clock.handle(delay_publish(0, 'fired'))
+        alarm_clock.handle_cancel(
+            CancelDelayedPublish(cancelled.message_id, correlation_id='ABC')
+        )
+        alarm_clock.run_once()
+
+        assert bus.messages == [('timed_out', 'fired')]
+        assert alarm_clock.get_fired_count() == 1
+        assert alarm_clock.get_cancelled_count() == 1
+
+    def test_cancel_after_fire_is_ignored(self):
+        bus = FakeBus()
+        alarm_clock = AlarmClock(bus)
+
+        timer = alarm_clock.handle(delay_publish(0, 'fired'))
+        alarm_clock.run_once()
+        alarm_clock.cancel(timer)
+
+        assert alarm_clock.get_fired_count() == 1
+        assert alarm_clock.get_cancelled_count() == 0
+
+    def test_wakes_up_for_an_earlier_deadline(self):
+        bus = FakeBus()
+        alarm_clock = AlarmClock(bus)
+        alarm_clock.handle(delay_publish(60, 'later'))
+        alarm_clock.start()
+
+        alarm_clock.handle(delay_publish(.05, 'soon'))
+        time.sleep(.3)
+        alarm_clock.stop()
+
+        assert bus.messages == [('timed_out', 'soon')]
+
+
+class TestMoreFairDispatcher:
+
+    def test_picks_the_least_loaded_handler(self):
+        queues = [QueueHandler(Recorder(), 'Q1'), QueueHandler(Recorder(), 'Q2')]
+        dispatcher = MoreFairDispatcher(queues, 2)
+
+        for _ in range(4):
+            dispatcher.handle(Message(correlation_id='ABC'))
+
+        assert [q.get_queue_size() for q in queues] == [2, 2]
+        assert dispatcher.get_fairness() == 1.0
+
+    def test_waits_until_a_handler_dequeues(self):
+        recorder = Recorder()
+        cook_queue = QueueHandler(recorder, 'Q1')
+        dispatcher = MoreFairDispatcher([cook_queue], 1)
+        dispatcher.handle(Message(correlation_id='ABC'))
+
+        waiting = threading.Thread(
+            target=dispatcher.handle,
+            args=(Message(correlation_id='ABC'), )
+        )
+        waiting.start()
+        time.sleep(.05)
+        assert waiting.is_alive()
+        cook_queue.run_once()
+        waiting.join(1)
+
+        assert not waiting.is_alive()
+        assert cook_queue.get_queue_size() == 1
+        assert dispatcher.get_metrics()['waits'] == 1
+
+
+class TestShortestExpectedDelayDispatcher:
+
+    def test_measures_the_service_time(self):
+        cook_queue = QueueHandler(Sleeper(.01), 'Q')
+
+        cook_queue.handle(Message(correlation_id='ABC'))
+        cook_queue.run_once()
+
+        assert cook_queue.get_service_time() >= .01
+
+    def test_prefers_the_faster_handler(self):
+        fast = QueueHandler(Sleeper(0), 'fast')
+        slow = QueueHandler(Sleeper(.01), 'slow')
+        for handler in (fast, slow):
+            handler.handle(Message(correlation_id='ABC'))
+            handler.run_once()
+        dispatcher = ShortestExpectedDelayDispatcher([slow, fast])
+
+        for _ in range(3):
+            dispatcher.handle(Message(correlation_id='ABC'))
+
+        assert fast.get_queue_size() == 3
+        assert slow.get_queue_size() == 0
+
+    def test_spreads_a_burst_before_the_first_measurement(self):
+        handlers = [QueueHandler(Sleeper(0), f'Q{indx}') for indx in range(3)]
+        dispatcher = ShortestExpectedDelayDispatcher(handlers)
+
+        for _ in range(6):
+            dispatcher.handle(Message(correlation_id='ABC'))
+
+        assert [handler.get_queue_size() for handler in handlers] == [2, 2, 2]
+
+    def test_unmeasured_handler_is_expected_to_be_average(self):
+        measured = QueueHandler(Sleeper(.01), 'measured')
+        measured.handle(Message(correlation_id='ABC'))
+        measured.run_once()
+        unmeasured = QueueHandler(Sleeper(0), 'unmeasured')
+        dispatcher = ShortestExpectedDelayDispatcher([unmeasured, measured])
+
+        for _ in range(4):
+            dispatcher.handle(Message(correlation_id='ABC'))
+
+        assert unmeasured.get_queue_size() == 2
+        assert measured.get_queue_size() == 2
+
+    def test_choices_more_than_the_handlers(self):
+        handlers = [QueueHandler(Sleeper(0), f'Q{indx}') for indx in range(2)]
+
+        with pytest.raises(ValueError):
+            ShortestExpectedDelayDispatcher(handlers, choices=3)
+
+
+class BatchRecorder(Recorder):
+
+    def __init__(self):
+        self.batches = []
+        super().__init__()
+
+    def handle_batch(self, messages):
+        self.batches.append(messages)
+
+
+class TestQueueHandlerBatching:
+
+    def test_forwards_a_batch_to_handle_batch(self):
+        recorder = BatchRecorder()
+        batching_queue = QueueHandler(recorder, 'Q', batch_size=3)
+        messages = [Message(correlation_id='ABC') for _ in range(4)]
+        for message in messages:
+            batching_queue.handle(message)
+
+        batching_queue.run_once()
+        batching_queue.run_once()
+
+        assert recorder.batches == [messages[:3], messages[3:]]
+        assert recorder.messages == []
+
+    def test_falls_back_to_handle(self):
+        recorder = Recorder()
+        batching_queue = QueueHandler(recorder, 'Q', batch_size=3)
+        messages = [Message(correlation_id='ABC') for _ in range(2)]
+        for message in messages:
+            batching_queue.handle(message)
+
+        batching_queue.run_once()
+
+        assert recorder.messages == messages
+
+    def test_waits_for_the_batch_timeout(self):
+        recorder = BatchRecorder()
+        batching_queue = QueueHandler(recorder, 'Q', batch_size=2, batch_timeout=.5)
+        late = Message(correlation_id='ABC')
+        batching_queue.handle(Message(correlation_id='ABC'))
+        timer = threading.Timer(.05, batching_queue.handle, (late, ))
+        timer.start()
+
+        batching_queue.run_once()
+
+        assert len(recorder.batches) == 1
+        assert recorder.batches[0][1] is late
+
+
+class TestBoundedQueueHandler:
+
+    def test_spilled_messages_are_handled(self, tmpdir):
+        recorder = Recorder()
+        bounded_queue = QueueHandler(recorder, 'Q', capacity=1, overflow=SPILL, spill_directory=str(tmpdir))
+        for reference in ('ABC-1', 'ABC-2'):
+            bounded_queue.handle(OrderPlaced(OrderDocument({'reference': reference}), correlation_id='ABC'))
+
+        bounded_queue.run_once()
+        bounded_queue.run_once()
+
+        assert [m.order.reference for m in recorder.messages] == ['ABC-1', 'ABC-2']
+        assert bounded_queue.get_info() == 'Q: 0/1 (high-water: 2, dropped: 0, spilled: 0)'
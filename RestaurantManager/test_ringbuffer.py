@@ -0,0 +1,190 @@
+import multiprocessing
+import queue
+import threading
+import time
+
+import pytest
+
+from actors import Cook
+from buses import TopicBasedPubSub
+from documents import OrderDocument
+from idempotency import IdempotencyStore
+from messages import CookFood, FoodCooked, new_id
+from reactors import QueueHandler
+from ringbuffer import RingBuffer, RingQueue, RingPublisher, RingForwarder
+from serialization import JSON
+
+
+@pytest.fixture
+def ring():
+    ring = RingBuffer(64)
+    yield ring
+    ring.close()
+
+
+@pytest.fixture
+def big_ring():
+    ring = RingBuffer(1024)
+    yield ring
+    ring.close()
+
+
+def cook_food(reference):
+    return CookFood(OrderDocument({'reference': reference}), correlation_id=new_id())
+
+
+def run_remote_cook(inbox, outbox, count):
+    cook = Cook(RingPublisher(outbox), IdempotencyStore(), 0, 'Remote cook')
+    handler = QueueHandler(cook, 'cookQ', backend=RingQueue(inbox))
+    for _ in range(count):
+        handler.run_once()
+
+
+class TestRingBuffer:
+
+    def test_records_are_read_in_order(self, ring):
+        ring.put(b'first')
+        ring.put(b'second')
+
+        assert ring.qsize() == 2
+        assert ring.get() == b'first'
+        assert ring.get() == b'second'
+        assert ring.qsize() == 0
+
+    def test_records_wrap_around(self, ring):
+        for indx in range(20):
+            ring.put(bytes([indx]) * 25)
+            assert ring.get() == bytes([indx]) * 25
+
+    def test_view_points_into_the_buffer(self, ring):
+        ring.put(b'record')
+
+        view = ring.get_view()
+        assert isinstance(view, memoryview)
+        assert view == b'record'
+        ring.release(view)
+
+    def test_space_is_reused_only_after_release(self, ring):
+        ring.put(b'x' * 40)
+        view = ring.get_view()
+
+        with pytest.raises(queue.Full):
+            ring.put(b'y' * 40, timeout=.01)
+        ring.release(view)
+        ring.put(b'y' * 40, timeout=.01)
+
+    def test_empty_get_times_out(self, ring):
+        with pytest.raises(queue.Empty):
+            ring.get(timeout=.01)
+
+    def test_too_big_record_is_rejected(self, ring):
+        with pytest.raises(ValueError):
+            ring.put(b'x' * 64)
+
+    def test_multiple_producers(self):
+        ring = RingBuffer(256, producers=True)
+        received = []
+
+        def produce(name):
+            for indx in range(200):
+                ring.put(f'{name}-{indx}'.encode())
+
+        producers = [threading.Thread(target=produce, args=(name,)) for name in 'abc']
+        for producer in producers:
+            producer.start()
+        for _ in range(600):
+            received.append(ring.get(timeout=5).decode())
+        for producer in producers:
+            producer.join()
+        ring.close()
+
+        for name in 'abc':
+            assert [item for item in received if item[0] == name] == [f'{name}-{indx}' for indx in range(200)]
+
+
+class TestRingQueue:
+
+    def test_messages_round_trip(self, big_ring):
+        backend = RingQueue(big_ring)
+        message = cook_food('ABC')
+
+        backend.put(message)
+        received = backend.get(timeout=1)
+
+        assert type(received) is CookFood
+        assert received.message_id == message.message_id
+        assert received.order.reference == 'ABC'
+
+    def test_json_round_trip(self, big_ring):
+        backend = RingQueue(big_ring, codec=JSON)
+        message = cook_food('ABC')
+
+        backend.put(message)
+        received = backend.get(timeout=1)
+
+        assert type(received) is CookFood
+        assert received.message_id == message.message_id
+        assert received.order.reference == 'ABC'
+
+    def test_get_many(self, big_ring):
+        backend = RingQueue(big_ring)
+        for indx in range(3):
+            backend.put(cook_food(f'ABC-{indx}'))
+
+        received = backend.get_many(5, timeout=1)
+
+        assert [message.order.reference for message in received] == ['ABC-0', 'ABC-1', 'ABC-2']
+
+    def test_json_publisher_and_forwarder(self, big_ring):
+        bus = TopicBasedPubSub()
+        received = []
+        bus.subscribe('cook_food', received.append)
+        message = cook_food('ABC')
+
+        RingPublisher(big_ring, codec=JSON).publish('cook_food', message)
+        RingForwarder(big_ring, bus, codec=JSON).run_once()
+
+        assert [item.message_id for item in received] == [message.message_id]
+
+    def test_queue_handler_backend(self, big_ring):
+        handled = []
+
+        class Handler:
+            def handle(self, message):
+                handled.append(message.order.reference)
+
+        handler = QueueHandler(Handler(), 'ringQ', backend=RingQueue(big_ring))
+        handler.handle(cook_food('ABC'))
+
+        assert handler.get_queue_size() == 1
+        handler.run_once()
+        assert handled == ['ABC']
+
+
+class TestRemoteCook:
+
+    def test_cook_in_another_process(self):
+        inbox, outbox = RingBuffer(4096), RingBuffer(4096)
+        bus = TopicBasedPubSub()
+        cooked = []
+        bus.subscribe('order_cooked', cooked.append)
+        bus.subscribe('cook_food', RingQueue(inbox).handle)
+        forwarder = RingForwarder(outbox, bus)
+        forwarder.start()
+        process = multiprocessing.Process(target=run_remote_cook, args=(inbox, outbox, 3))
+        process.start()
+        try:
+            for indx in range(3):
+                bus.publish('cook_food', cook_food(f'ABC-{indx}'))
+            process.join(10)
+            deadline = time.monotonic() + 5
+            while len(cooked) < 3 and time.monotonic() < deadline:
+                time.sleep(.01)
+        finally:
+            forwarder.stop()
+
+        assert process.exitcode == 0
+        assert [type(message) for message in cooked] == [FoodCooked] * 3
+        assert [message.order.made_it for message in cooked] == ['Remote cook'] * 3
+        inbox.close()
+        outbox.close()
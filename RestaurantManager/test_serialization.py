@@ -0,0 +1,171 @@
+import pytest
+
+from documents import OrderDocument
+import messages
+from messages import OrderPlaced, FoodCooked, CookTimedOut, DelayPublish
+from serialization import JSON, BINARY, get_codec
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    # The message types and the upcasters of a test are forgotten after it
+    monkeypatch.setattr(messages, 'MESSAGE_TYPES', dict(messages.MESSAGE_TYPES))
+    monkeypatch.setattr(messages, 'UPCASTERS', dict(messages.UPCASTERS))
+
+
+class TestBinaryCodec:
+
+    @pytest.mark.parametrize('value', [
+        None, True, False, 0, 127, 128, 255, 65536, 2 ** 40, 2 ** 64 - 1, 2 ** 127,
+        -1, -32, -33, -200, -40000, -2 ** 40,
+        1.5, '', 'a' * 31, 'á' * 40, 'b' * 70000, b'\x00\x01',
+        list(range(20)), {'k%d' % indx: indx for indx in range(20)},
+        {'nested': [{'a': [None, 1.0]}]},
+    ])
+    def test_round_trip(self, value):
+        assert BINARY.decode(BINARY.encode(value)) == value
+
+    def test_small_values_are_compact(self):
+        assert BINARY.encode({'qty': 1}) == b'\x81\xa3qty\x01'
+
+    def test_unknown_type(self):
+        with pytest.raises(TypeError):
+            BINARY.encode(object())
+
+
+class TestDocumentSerialization:
+
+    @pytest.mark.parametrize('codec', [JSON, BINARY])
+    def test_unknown_fields_are_kept(self, codec):
+        doc = OrderDocument({'reference': 'ABC-1', 'unknown': {'deep': [1, 2]}})
+
+        copied = OrderDocument.deserialize(doc.serialize(codec), codec)
+
+        assert copied.serialize() == doc.serialize()
+
+    @pytest.mark.parametrize('codec', [JSON, BINARY])
+    def test_message_envelope(self, codec):
+        order = OrderDocument({'reference': 'ABC-1', 'lines': [{'name': 'Pizza'}]})
+        message = OrderPlaced(order, correlation_id='ABC', causation_id='XYZ')
+
+        decoded = OrderPlaced.deserialize(message.serialize(codec), codec)
+
+        assert decoded.message_id == message.message_id
+        assert decoded.correlation_id == 'ABC'
+        assert decoded.causation_id == 'XYZ'
+        assert decoded.order.lines[0].name == 'Pizza'
+
+    def test_message_type_is_checked(self):
+        message = OrderPlaced(OrderDocument(), correlation_id='ABC')
+
+        with pytest.raises(TypeError):
+            FoodCooked.deserialize(message.serialize())
+
+    def test_codecs_by_name(self):
+        assert get_codec('binary') is BINARY
+
+
+class TestMessageRegistry:
+
+    @pytest.mark.parametrize('codec', [JSON, BINARY])
+    def test_delay_publish_with_the_delayed_message(self, codec):
+        timeout = CookTimedOut(OrderDocument({'reference': 'ABC-1'}), correlation_id='ABC')
+        delay = DelayPublish(10, 'timed_out', timeout, correlation_id='ABC')
+
+        decoded = messages.deserialize(delay.serialize(codec), codec)
+
+        assert type(decoded) is DelayPublish
+        assert decoded.delay == 10
+        assert type(decoded.message) is CookTimedOut
+        assert decoded.message.message_id == timeout.message_id
+        assert decoded.message.order.reference == 'ABC-1'
+
+    def test_batch(self):
+        batch = [
+            OrderPlaced(OrderDocument({'reference': f'ABC-{indx}'}), correlation_id=indx)
+            for indx in range(3)
+        ]
+
+        decoded = messages.deserialize_many(messages.serialize_many(batch, BINARY), BINARY)
+
+        assert [type(message) for message in decoded] == [OrderPlaced] * 3
+        assert [message.correlation_id for message in decoded] == [0, 1, 2]
+
+    def test_unknown_type(self):
+        with pytest.raises(ValueError):
+            messages.decode_envelope({'type': 'Unknown'})
+
+    def test_old_versions_are_upcasted(self, registry):
+
+        class TableBooked(messages.Event):
+            version = 2
+
+            def __init__(self, table, correlation_id, causation_id=None, message_id=None):
+                super().__init__(correlation_id, causation_id, message_id)
+                self.table = table
+
+            @classmethod
+            def from_envelope(cls, envelope):
+                return cls(envelope['table'], envelope['correlation_id'])
+
+        @messages.register_upcaster('TableBooked', 1)
+        def table_number_to_table(envelope):
+            envelope = dict(envelope)
+            envelope['table'] = {'number': envelope.pop('table_number')}
+            return envelope
+
+        decoded = messages.decode_envelope({
+            'type': 'TableBooked', 'version': 1, 'correlation_id': 'ABC',
+            'causation_id': None, 'message_id': 'XYZ', 'table_number': 4,
+        })
+
+        assert decoded.table == {'number': 4}
+
+    def test_message_type_is_registered_once(self, registry):
+
+        class TableBooked(messages.Event):
+            pass
+
+        with pytest.raises(TypeError):
+            class TableBooked(messages.Event):
+                pass
+
+        assert messages.MESSAGE_TYPES['TableBooked'] is TableBooked
+
+    def test_upcaster_is_registered_once(self, registry):
+        messages.register_upcaster('TableBooked', 1)(dict)
+
+        with pytest.raises(ValueError):
+            messages.register_upcaster('TableBooked', 1)(dict)
+
+    def test_registrations_of_a_test_are_forgotten(self):
+        assert 'TableBooked' not in messages.MESSAGE_TYPES
+        assert ('TableBooked', 1) not in messages.UPCASTERS
+
+
+class TestMessageIds:
+
+    def test_ids_are_unique_integers(self):
+        first = OrderPlaced(OrderDocument(), correlation_id='ABC')
+        second = OrderPlaced(OrderDocument(), correlation_id='ABC')
+
+        assert isinstance(first.message_id, int)
+        assert first.message_id != second.message_id
+
+    def test_ids_are_formatted_on_serialization(self):
+        message = OrderPlaced(OrderDocument(), correlation_id=messages.new_id(), causation_id='XYZ')
+
+        envelope = message.to_envelope()
+        decoded = messages.decode_envelope(envelope)
+
+        assert envelope['message_id'] == messages.format_id(message.message_id)
+        assert len(envelope['message_id']) == 36
+        assert decoded.message_id == message.message_id
+        assert decoded.correlation_id == message.correlation_id
+        assert decoded.causation_id == 'XYZ'
+
+    def test_messages_have_no_dict(self):
+        message = OrderPlaced(OrderDocument(), correlation_id='ABC')
+
+        with pytest.raises(AttributeError):
+            message.unknown = 1
@@ -0,0 +1,21 @@
+from actors import Waiter
+from buses import TopicBasedPubSub
+from sharding import ShardedRestaurant
+
+
+class TestShardedRestaurant:
+
+    def test_every_flow_is_completed(self):
+        bus = TopicBasedPubSub()
+        waiter = Waiter(bus)
+        restaurant = ShardedRestaurant(2, cook_times=(0, 0))
+        bus.subscribe('order_placed', restaurant.handle)
+        restaurant.start()
+        try:
+            for indx in range(20):
+                waiter.place_order(reference=f'ABC-{indx}', lines=[{'name': 'Pizza', 'qty': 1}])
+            completed = restaurant.wait_for_completed(20, timeout=10)
+        finally:
+            restaurant.stop()
+
+        assert completed == 20
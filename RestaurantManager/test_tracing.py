@@ -0,0 +1,151 @@
+import pytest
+
+from buses import TopicBasedPubSub
+from messages import Message, new_id
+from tracing import Tracer
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def child(parent):
+    return Message(parent.correlation_id, causation_id=parent.message_id)
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def tracer(clock):
+    return Tracer(clock=clock)
+
+
+class TestTracer:
+
+    def test_hops_of_a_flow_make_a_tree(self, tracer, clock):
+        placed = Message(1)
+        cook = child(placed)
+        price = child(placed)
+        cooked = child(cook)
+        for topic, message in [('placed', placed), ('cook', cook), ('price', price), ('cooked', cooked)]:
+            tracer.start(topic, message)
+            clock.now += 1
+
+        trace = tracer.get_trace(1)
+
+        assert [hop.topic for hop in trace.roots] == ['placed']
+        assert [hop.topic for hop in trace.get_children(trace.roots[0])] == ['cook', 'price']
+        assert [hop.topic for hop in trace.get_children(trace.hops[1])] == ['cooked']
+        assert tracer.get_trace(2) is None
+
+    def test_critical_path_ends_at_the_last_published_leaf(self, tracer, clock):
+        placed = Message(1)
+        cook = child(placed)
+        price = child(placed)
+        cooked = child(cook)
+        tracer.start('placed', placed)
+        clock.now = 1
+        tracer.start('cook', cook)
+        tracer.start('price', price).duration = 1
+        clock.now = 5
+        tracer.start('cooked', cooked)
+
+        trace = tracer.get_trace(1)
+        path = trace.get_critical_path()
+        parent, slowest = trace.get_slowest_step()
+
+        assert [hop.topic for hop in path] == ['placed', 'cook', 'cooked']
+        assert (parent.topic, slowest.topic) == ('cook', 'cooked')
+        assert trace.get_duration() == 5
+        marked = [line.split()[2] for line in trace.format().splitlines() if line.startswith('*')]
+        assert marked == ['placed', 'cook', 'cooked']
+
+    def test_critical_path_reaches_the_children_of_the_slowest_hop(self, tracer, clock):
+        placed = Message(1)
+        cooked = child(placed)
+        hop = tracer.start('placed', placed)
+        clock.now = 1
+        tracer.start('cooked', cooked).duration = 1
+        # Synchronous handlers, the parent's duration covers its child
+        hop.duration = 3
+
+        trace = tracer.get_trace(1)
+
+        assert [hop.topic for hop in trace.get_critical_path()] == ['placed', 'cooked']
+        parent, slowest = trace.get_slowest_step()
+        assert (parent.topic, slowest.topic) == ('placed', 'cooked')
+
+    def test_stages_of_the_critical_paths(self, tracer, clock):
+        for correlation_id in (1, 2):
+            placed = Message(correlation_id)
+            clock.now = 0
+            tracer.start('placed', placed)
+            clock.now = correlation_id
+            tracer.start('cooked', child(placed))
+
+        assert tracer.get_stages() == {'placed -> cooked': (2, 3)}
+
+    def test_ring_is_bounded(self, clock):
+        tracer = Tracer(max_hops=3, clock=clock)
+        for correlation_id in range(5):
+            tracer.start('placed', Message(correlation_id))
+
+        assert [trace.correlation_id for trace in tracer.get_traces()] == [2, 3, 4]
+        assert tracer.get_info() == 'Tracer: 3 hops (recorded: 5)'
+
+    def test_flows_are_sampled_as_a_whole(self, clock):
+        tracer = Tracer(sample_every=4, clock=clock)
+        for correlation_id in range(8):
+            placed = Message(correlation_id)
+            tracer.start('placed', placed)
+            tracer.start('cooked', child(placed))
+
+        sampled = [correlation_id for correlation_id in range(8) if tracer.is_sampled(correlation_id)]
+        assert sorted(trace.correlation_id for trace in tracer.get_traces()) == sampled
+        assert all(len(trace.hops) == 2 for trace in tracer.get_traces())
+
+    def test_sequential_ids_are_sampled_evenly(self):
+        tracer = Tracer(sample_every=10)
+
+        for stride in (1, 7, 10):
+            ids = [new_id() for _ in range(1000 * stride)][::stride]
+            assert 50 < sum(tracer.is_sampled(correlation_id) for correlation_id in ids) < 150
+
+
+class TestBusTracing:
+
+    def test_handlers_are_timed_and_nested_publishes_traced(self):
+        tracer = Tracer()
+        bus = TopicBasedPubSub(tracer=tracer)
+        placed = Message(1)
+        bus.subscribe('placed', lambda message: bus.publish('cooked', child(message)))
+
+        bus.publish('placed', placed)
+
+        trace = tracer.get_trace(1)
+        root, = trace.roots
+        cooked, = trace.get_children(root)
+        assert root.message_type == 'Message'
+        assert cooked.topic == 'cooked'
+        assert root.duration >= cooked.duration >= 0
+
+    def test_not_sampled_flows_are_delivered(self):
+        tracer = Tracer(sample_every=2)
+        bus = TopicBasedPubSub(tracer=tracer)
+        received = []
+        bus.subscribe('placed', received.append)
+        correlation_id = next(value for value in range(10) if not tracer.is_sampled(value))
+        bus.subscribe_correlation(correlation_id, received.append)
+
+        bus.publish('placed', Message(correlation_id))
+
+        assert len(received) == 2
+        assert tracer.get_traces() == []
@@ -0,0 +1,202 @@
+"""
+Tracing: the hops of the message flows by correlation id.
+
+The bus takes a `Tracer` as an optional `tracer` argument, every
+published message of a sampled flow is a hop: the type of the message,
+the topic, the time it was published and the time its handlers took.
+The hops are kept in a bounded ring, the oldest ones are dropped.
+
+The `causation_id` of a message is the `message_id` of its parent,
+so the hops of a flow make a tree (`Trace`). The time between the
+parent and the child is where the flow spent its time, eg. in the
+queue of the cooks, the critical path is the chain of hops to the
+last published leaf. (The handlers are synchronous, the duration of a
+hop includes the handlers of its children, so it ends the flow by the
+publish of the last step, not by the end of its handlers.)
+
+    tracer = Tracer(sample_every=10)
+    bus = TopicBasedPubSub(tracer=tracer)
+    ...
+    print(tracer.get_trace(correlation_id).format())
+    tracer.get_stages()     # {'cook_food -> order_cooked': (count, seconds)}
+
+The sampling is decided by the correlation id, so a flow is traced
+as a whole or not at all, the other flows cost a hash, a multiplication and a modulo.
+"""
+import collections
+import time
+
+
+class Hop:
+
+    __slots__ = (
+        'message_id', 'causation_id', 'correlation_id',
+        'message_type', 'topic', 'published', 'duration'
+    )
+
+    def __init__(self, topic, message, published):
+        self.message_id = message.message_id
+        self.causation_id = message.causation_id
+        self.correlation_id = message.correlation_id
+        self.message_type = type(message).__name__
+        self.topic = topic
+        self.published = published
+        # Until the handlers finish
+        self.duration = None
+
+    @property
+    def end(self):
+        return self.published + (self.duration or 0)
+
+
+class Tracer:
+    """
+    Every `sample_every`-th flow is traced (by the hash of the
+    correlation id), at most `max_hops` hops are kept.
+    """
+
+    def __init__(self, max_hops=100000, sample_every=1, clock=time.perf_counter):
+        self._hops = collections.deque(maxlen=max_hops)
+        self._sample_every = sample_every
+        self._clock = clock
+        self._recorded = 0
+
+    def is_sampled(self, correlation_id):
+        # The ids are sequential (every flow takes a few of them),
+        # their hash is scattered, otherwise the modulo would
+        # pick the same few flows or none of them
+        return (hash(correlation_id) * 0x9E3779B97F4A7C15 >> 32) % self._sample_every == 0
+
+    def start(self, topic, message):
+        """
+        The hop of a published message, or None if its flow
+        is not sampled. The publisher sets its `duration`.
+        """
+        # `is_sampled`, inlined
+        if (hash(message.correlation_id) * 0x9E3779B97F4A7C15 >> 32) % self._sample_every:
+            return None
+        hop = Hop(topic, message, self._clock())
+        self._hops.append(hop)
+        self._recorded += 1
+        return hop
+
+    def _get_hops(self):
+        # Copied in one step, the publishers might append meanwhile
+        return list(self._hops)
+
+    def get_trace(self, correlation_id):
+        hops = [hop for hop in self._get_hops() if hop.correlation_id == correlation_id]
+        if not hops:
+            return None
+        return Trace(correlation_id, hops)
+
+    def get_traces(self):
+        flows = collections.defaultdict(list)
+        for hop in self._get_hops():
+            flows[hop.correlation_id].append(hop)
+        return [Trace(correlation_id, hops) for correlation_id, hops in flows.items()]
+
+    def get_stages(self):
+        """
+        The time spent between the hops of the critical paths of all
+        of the traces, by `parent topic -> child topic`,
+        as `(count, seconds)`, the most expensive first
+        """
+        stages = collections.defaultdict(lambda: [0, 0])
+        for trace in self.get_traces():
+            for parent, hop in trace.get_critical_path_steps():
+                stage = stages[f'{parent.topic} -> {hop.topic}']
+                stage[0] += 1
+                stage[1] += hop.published - parent.published
+        return dict(sorted(
+            ((name, tuple(stage)) for name, stage in stages.items()),
+            key=lambda item: item[1][1],
+            reverse=True
+        ))
+
+    def get_info(self):
+        return f'Tracer: {len(self._hops)} hops (recorded: {self._recorded})'
+
+
+class Trace:
+    """
+    The causal tree of the hops of a flow. A hop without a known
+    parent (the first one, or its parent was dropped) is a root.
+    """
+
+    def __init__(self, correlation_id, hops):
+        self.correlation_id = correlation_id
+        self.hops = sorted(hops, key=lambda hop: hop.published)
+        self._by_id = {hop.message_id: hop for hop in self.hops}
+        self._children = collections.defaultdict(list)
+        self.roots = []
+        for hop in self.hops:
+            if hop.causation_id in self._by_id:
+                self._children[hop.causation_id].append(hop)
+            else:
+                self.roots.append(hop)
+
+    def get_children(self, hop):
+        return self._children.get(hop.message_id, [])
+
+    def get_parent(self, hop):
+        return self._by_id.get(hop.causation_id)
+
+    def get_duration(self):
+        return max(hop.end for hop in self.hops) - self.hops[0].published
+
+    def get_critical_path(self):
+        """
+        The hops from a root to the last published hop
+        without children
+        """
+        hop = max(
+            (hop for hop in self.hops if not self.get_children(hop)),
+            key=lambda hop: hop.published
+        )
+        path = [hop]
+        while True:
+            hop = self.get_parent(hop)
+            if hop is None:
+                return path[::-1]
+            path.append(hop)
+
+    def get_critical_path_steps(self):
+        """
+        `(parent, child)` pairs of the critical path
+        """
+        path = self.get_critical_path()
+        return list(zip(path, path[1:]))
+
+    def get_slowest_step(self):
+        """
+        The `(parent, child)` pair of the critical path with
+        the longest time between them, None for a single hop
+        """
+        steps = self.get_critical_path_steps()
+        if not steps:
+            return None
+        return max(steps, key=lambda step: step[1].published - step[0].published)
+
+    def format(self):
+        """
+        The tree, one hop per line: the time from the start of the
+        flow, the time of the handlers, `*` marks the critical path
+        """
+        start = self.hops[0].published
+        critical = {hop.message_id for hop in self.get_critical_path()}
+        lines = []
+
+        def add(hop, depth):
+            mark = '*' if hop.message_id in critical else ' '
+            duration = '-' if hop.duration is None else f'{hop.duration * 1000:.3f}ms'
+            lines.append(
+                f'{mark} {(hop.published - start) * 1000:10.3f}ms {"  " * depth}'
+                f'{hop.topic} {hop.message_type} (handlers: {duration})'
+            )
+            for child in self.get_children(hop):
+                add(child, depth + 1)
+
+        for root in self.roots:
+            add(root, 0)
+        return '\n'.join(lines)